@@ -31,6 +31,7 @@ import time
 import re
 import urlparse
 import errno
+import fcntl
 import subprocess
 import glob
 import pwd
@@ -1365,6 +1366,28 @@ def app_ssowatconf(auth):
     Regenerate SSOwat configuration file
 
 
+    """
+    # Several app scripts may regenerate the conf at the same time (e.g.
+    # during a parallel restore), so this takes the lock of the
+    # ynh_exec_with_lock helper of the same name
+    with open('/var/lock/yunohost-ssowat.lock', 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+
+        conf_dict = _get_ssowat_conf(auth)
+
+        # Replace the conf at once, so that it's never read partially written
+        tmp_conf_file = '/etc/ssowat/conf.json.%d' % os.getpid()
+        with open(tmp_conf_file, 'w') as f:
+            json.dump(conf_dict, f, sort_keys=True, indent=4)
+        os.rename(tmp_conf_file, '/etc/ssowat/conf.json')
+
+    logger.success(m18n.n('ssowat_conf_generated'))
+
+
+def _get_ssowat_conf(auth):
+    """
+    Build the SSOwat configuration from the domains, apps and users
+
     """
     from yunohost.domain import domain_list, _get_maindomain
     from yunohost.user import user_list
@@ -1449,10 +1472,7 @@ def app_ssowatconf(auth):
                   for username in user_list(auth)['users'].keys()},
     }
 
-    with open('/etc/ssowat/conf.json', 'w+') as f:
-        json.dump(conf_dict, f, sort_keys=True, indent=4)
-
-    logger.success(m18n.n('ssowat_conf_generated'))
+    return conf_dict
 
 
 def app_change_label(auth, app, new_label):
@@ -27,15 +27,29 @@ import os
 import re
 import json
 import errno
+import fcntl
 import time
+import calendar
+import copy
 import tarfile
 import shutil
+import zlib
+import struct
+import threading
 import subprocess
 import csv
+import hashlib
 import tempfile
+import heapq
+import random
+import psutil
 from datetime import datetime
 from glob import glob
+from stat import S_ISREG, S_ISDIR
+from StringIO import StringIO
 from collections import OrderedDict
+from contextlib import contextmanager
+from multiprocessing.pool import ThreadPool
 
 from moulinette import msignals, m18n
 from moulinette.core import MoulinetteError
@@ -47,19 +61,42 @@ from yunohost.app import (
     app_info, _is_installed, _parse_app_instance_name, _patch_php5
 )
 from yunohost.hook import (
-    hook_list, hook_info, hook_callback, hook_exec, CUSTOM_HOOK_FOLDER
+    hook_list, hook_info, hook_callback, hook_exec, CUSTOM_HOOK_FOLDER,
+    _init_worker_thread
 )
 from yunohost.monitor import binary_to_human
 from yunohost.tools import tools_postinstall
 from yunohost.service import service_regen_conf
-from yunohost.log import OperationLogger
+from yunohost.log import OperationLogger, is_unit_operation
+from yunohost.settings import settings_get
 
 BACKUP_PATH = '/home/yunohost.backup'
 ARCHIVES_PATH = '%s/archives' % BACKUP_PATH
+CATALOG_PATH = '%s/catalog.json' % ARCHIVES_PATH
+CATALOG_LOCK_PATH = '%s/catalog.json.lock' % ARCHIVES_PATH
+SCHEDULES_PATH = '/etc/yunohost/backup_schedules.json'
+SCHEDULES_CRON_PATH = '/etc/cron.d/yunohost-backup-schedules'
+SCHEDULES_LOCK_PATH = '/var/run/yunohost-backup-schedule.lock'
+CHECKSUMS_FILE = 'checksums.json'
+CHECKPOINT_FILE = 'checkpoint.json'
+CHECKPOINT_CHECKSUMS_FILE = 'checkpoint_checksums.csv'
+ARCHIVE_CHECKPOINT_SIZE = 64  # In MB
 APP_MARGIN_SPACE_SIZE = 100  # In MB
 CONF_MARGIN_SPACE_SIZE = 10  # IN MB
 POSTINSTALL_ESTIMATE_SPACE_SIZE = 5  # In MB
 MB_ALLOWED_TO_ORGANIZE = 10
+COMPRESSION_SAMPLES = 16  # Number of samples per path to backup
+COMPRESSION_SAMPLE_SIZE = 16 * 1024  # In bytes
+COMPRESSION_ESTIMATE_MARGIN = 1.1
+DB_DUMP_EXTENSIONS = ('.sql', '.ldif', '.dump')
+DB_DUMP_SAMPLES = 16  # Number of samples per database dump
+DB_STORAGE_OVERHEAD = 2  # Space used by loaded rows, compared to their text
+DB_DUMP_SCHEMA_PREFIXES = ('--', '/*', '#', 'CREATE', 'DROP', 'ALTER', 'SET',
+                           'LOCK', 'UNLOCK', 'USE', 'COPY', '\\.', 'SELECT',
+                           'GRANT', 'REVOKE', 'COMMENT', 'BEGIN', 'COMMIT',
+                           'START')
+SEEK_DATA = 3  # os.SEEK_DATA and os.SEEK_HOLE are missing in python 2
+SEEK_HOLE = 4
 logger = getActionLogger('yunohost.backup')
 
 
@@ -176,6 +213,47 @@ class BackupRestoreTargetsManager(object):
                     if self.results[category][target] not in exclude]
 
 
+class BackupPath(object):
+    """
+    A path to backup: the source path on the system and the destination path
+    in the archive
+
+    Backups of data like home directories may list a lot of paths, so this
+    record is much lighter than a dict. It can still be read like a dict
+    (path['source']) for backward compatibility.
+    """
+
+    __slots__ = ('source', 'dest')
+
+    def __init__(self, source, dest):
+        self.source = source
+        self.dest = dest
+
+    def __getitem__(self, key):
+        if key not in self.__slots__:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def __setitem__(self, key, value):
+        if key not in self.__slots__:
+            raise KeyError(key)
+        setattr(self, key, value)
+
+    def __eq__(self, other):
+        return isinstance(other, BackupPath) and \
+            (self.source, self.dest) == (other.source, other.dest)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return 'BackupPath(%r, %r)' % (self.source, self.dest)
+
+    def to_list(self):
+        """ Return the path as a list, to serialize it in JSON """
+        return [self.source, self.dest]
+
+
 class BackupManager():
     """
     This class collect files to backup in a list and apply one or several
@@ -203,8 +281,11 @@ class BackupManager():
         work_dir (getter) # FIXME currently it's not a getter
         is_tmp_work_dir (getter)
         paths_to_backup (getter) # FIXME not a getter and list is not protected
+                                 # Once collected, the paths are iterated
+                                 # from the CSV instead of kept in memory
         name (getter) # FIXME currently it's not a getter
         size (getter) # FIXME currently it's not a getter
+        compressed_size (getter) # FIXME currently it's not a getter
 
     Public methods:
         add(self, method)
@@ -212,6 +293,7 @@ class BackupManager():
         set_apps_targets(self, apps=[])
         collect_files(self)
         backup(self)
+        save_checkpoint(self, key, value)
 
     Usage:
         backup_manager = BackupManager(name="mybackup", description="bkp things")
@@ -229,9 +311,15 @@ class BackupManager():
 
         # Apply backup methods
         backup_manager.backup()
+
+    The progress of the backup is saved in a checkpoint file in the work_dir
+    (system hooks and apps already collected, archive already written). If
+    the backup is interrupted (power loss, OOM killer, ...), it can be
+    resumed by creating a BackupManager with the same name and resume=True.
     """
 
-    def __init__(self, name=None, description='', work_dir=None):
+    def __init__(self, name=None, description='', work_dir=None,
+                 resume=False):
         """
         BackupManager constructor
 
@@ -244,6 +332,9 @@ class BackupManager():
 
         work_dir    -- (None|string) A path where prepare the archive. If None,
                         temporary work_dir will be created (default: None)
+
+        resume      -- (bool) Resume the interrupted backup with this name
+                        (default: False)
         """
         self.description = description or ''
         self.created_at = int(time.time())
@@ -255,7 +346,17 @@ class BackupManager():
             'system': {},
             'apps': {}
         }
+        self.durations = {
+            'system': {},
+            'apps': {}
+        }
+        self.dumps_size = {
+            'system': {},
+            'apps': {}
+        }
         self.targets = BackupRestoreTargetsManager()
+        self.checkpoint = {}
+        self._checkpoint_lock = threading.Lock()
 
         # Define backup name if needed
         if not name:
@@ -266,7 +367,14 @@ class BackupManager():
         self.work_dir = work_dir
         if self.work_dir is None:
             self.work_dir = os.path.join(BACKUP_PATH, 'tmp', name)
-        self._init_work_dir()
+        self._init_work_dir(resume)
+
+        if resume:
+            self.created_at = self.checkpoint['created_at']
+            self.description = self.checkpoint['description']
+        else:
+            self.save_checkpoint('created_at', self.created_at)
+            self.save_checkpoint('description', self.description)
 
     ###########################################################################
     #   Misc helpers                                                          #
@@ -280,6 +388,8 @@ class BackupManager():
             'created_at': self.created_at,
             'size': self.size,
             'size_details': self.size_details,
+            'compressed_size': self.compressed_size,
+            'dumps_size': self.dumps_size,
             'apps': self.apps_return,
             'system': self.system_return
         }
@@ -302,12 +412,19 @@ class BackupManager():
         # FIXME: case where this name already exist
         return time.strftime('%Y%m%d-%H%M%S', time.gmtime())
 
-    def _init_work_dir(self):
+    def _init_work_dir(self, resume=False):
         """Initialize preparation directory
 
-        Ensure the working directory exists and is empty
+        Ensure the working directory exists and is empty, or load the
+        checkpoint it contains if the backup is resumed
+
+        Args:
+        resume -- (bool) Resume the backup prepared in this directory
 
         exception:
+        backup_nothing_to_resume -- (MoulinetteError) Raised if the backup is
+            resumed but the directory doesn't contain any checkpoint
+
         backup_output_directory_not_empty -- (MoulinetteError) Raised if the
             directory was given by the user and isn't empty
 
@@ -319,9 +436,22 @@ class BackupManager():
             if iyunohost can't create the working directory
         """
 
+        checkpoint_path = os.path.join(self.work_dir, CHECKPOINT_FILE)
+
+        if resume:
+            try:
+                with open(checkpoint_path) as f:
+                    self.checkpoint = _byteify(json.load(f))
+            except (IOError, ValueError):
+                logger.debug("unable to load the checkpoint '%s'",
+                             checkpoint_path, exc_info=1)
+                raise MoulinetteError(errno.EINVAL, m18n.n(
+                    'backup_nothing_to_resume', name=self.name))
+            logger.info(m18n.n('backup_resuming', name=self.name))
+
         # FIXME replace isdir by exists ? manage better the case where the path
         # exists
-        if not os.path.isdir(self.work_dir):
+        elif not os.path.isdir(self.work_dir):
             filesystem.mkdir(self.work_dir, 0750, parents=True, uid='admin')
         elif self.is_tmp_work_dir:
             logger.debug("temporary directory for backup '%s' already exists",
@@ -330,6 +460,44 @@ class BackupManager():
             raise MoulinetteError(
                 errno.EIO, m18n.n('backup_output_directory_not_empty'))
 
+    def save_checkpoint(self, key, value):
+        """
+        Save a step of the backup in the checkpoint file of the work_dir
+
+        The file is replaced atomically, so that it is always consistent if
+        the backup is interrupted. As the checkpoint is only needed to resume
+        an interrupted backup, a failure to save it isn't fatal.
+
+        Args:
+        key   -- (string|tuple) The key of the step in the checkpoint. A tuple
+                 is the path of the key in nested dicts (e.g. ('apps', app))
+
+        value -- The data (serializable in JSON) to save for this step
+        """
+        checkpoint_path = os.path.join(self.work_dir, CHECKPOINT_FILE)
+        if not isinstance(key, tuple):
+            key = (key,)
+
+        with self._checkpoint_lock:
+            parent = self.checkpoint
+            for k in key[:-1]:
+                parent = parent.setdefault(k, {})
+            parent[key[-1]] = value
+
+            try:
+                with open(checkpoint_path + '.tmp', 'w') as f:
+                    json.dump(self.checkpoint, f, default=BackupPath.to_list)
+                    f.flush()
+                    os.fsync(f.fileno())
+                os.rename(checkpoint_path + '.tmp', checkpoint_path)
+            except (IOError, OSError, TypeError, ValueError, UnicodeError):
+                logger.warning(m18n.n('backup_checkpoint_failed'), exc_info=1)
+
+    def clean_checkpoint(self):
+        """Remove the checkpoint files once the backup is done"""
+        for filename in (CHECKPOINT_FILE, CHECKPOINT_CHECKSUMS_FILE):
+            filesystem.rm(os.path.join(self.work_dir, filename), force=True)
+
     ###########################################################################
     #   Backup target management                                              #
     ###########################################################################
@@ -386,17 +554,35 @@ class BackupManager():
     #   Management of files to backup / "The CSV"                             #
     ###########################################################################
 
-    def _import_to_list_to_backup(self, tmp_csv):
+    def _import_to_list_to_backup(self, tmp_csv, paths=None, offset=0):
         """
         Commit collected path from system hooks or app scripts
 
         Args:
         tmp_csv -- (string) Path to a temporary csv file with source and
                    destinations column to add to the list of paths to backup
+
+        paths   -- (list|None) The list to add the paths to. If None, the
+                   "paths_to_backup" list is used (default: None)
+
+        offset  -- (int) Position in the csv file where to start reading, to
+                   only import the rows added since a previous import
+                   (default: 0)
+
+        Return:
+            (int) The position of the end of the csv file
         """
-        _call_for_each_path(self, BackupManager._add_to_list_to_backup, tmp_csv)
+        with open(tmp_csv, 'r') as csv_file:
+            csv_file.seek(offset)
+            # readline() doesn't read ahead, so that tell() is right at the end
+            for row in csv.reader(iter(csv_file.readline, '')):
+                if not row:
+                    continue
+                source, dest = (row + [None])[:2]
+                self._add_to_list_to_backup(source, dest, paths)
+            return csv_file.tell()
 
-    def _add_to_list_to_backup(self, source, dest=None):
+    def _add_to_list_to_backup(self, source, dest=None, paths=None):
         """
         Mark file or directory to backup
 
@@ -411,6 +597,9 @@ class BackupManager():
                   at the same place and with same name than on the system.
                   (default: None)
 
+        paths  -- (list|None) The list to add the couple to. If None, the
+                  "paths_to_backup" list is used (default: None)
+
         Usage:
         self._add_to_list_to_backup('/var/www/wordpress', 'sources')
         # => "wordpress" dir will be move and rename as "sources"
@@ -424,7 +613,9 @@ class BackupManager():
             source = os.path.join(self.work_dir, source)
         if dest.endswith("/"):
             dest = os.path.join(dest, os.path.basename(source))
-        self.paths_to_backup.append({'source': source, 'dest': dest})
+        if paths is None:
+            paths = self.paths_to_backup
+        paths.append(BackupPath(source, dest))
 
     def _write_csv(self):
         """
@@ -453,20 +644,27 @@ class BackupManager():
         """
         self.csv_path = os.path.join(self.work_dir, 'backup.csv')
         try:
-            self.csv_file = open(self.csv_path, 'a')
+            self.csv_file = open(self.csv_path, 'w')
             self.fieldnames = ['source', 'dest']
             self.csv = csv.DictWriter(self.csv_file, fieldnames=self.fieldnames,
                                       quoting=csv.QUOTE_ALL)
         except (IOError, OSError, csv.Error):
             logger.error(m18n.n('backup_csv_creation_failed'))
 
+        written = True
         for row in self.paths_to_backup:
             try:
-                self.csv.writerow(row)
+                self.csv.writerow({'source': row.source, 'dest': row.dest})
             except csv.Error:
                 logger.error(m18n.n('backup_csv_addition_failed'))
+                written = False
         self.csv_file.close()
 
+        # The paths are read again from the CSV when needed, instead of being
+        # kept in memory during the whole backup
+        if written:
+            self.paths_to_backup = _BackupCsvPaths(self.csv_path)
+
     ###########################################################################
     #   File collection from system parts and apps                            #
     ###########################################################################
@@ -498,6 +696,24 @@ class BackupManager():
         nothing has been listed.
         """
 
+        # The files have already been collected before the backup was
+        # interrupted
+        if 'collected' in self.checkpoint:
+            collected = self.checkpoint['collected']
+            self.csv_path = os.path.join(self.work_dir, 'backup.csv')
+            self.paths_to_backup = _BackupCsvPaths(self.csv_path)
+            self.apps_return = collected['apps_return']
+            self.system_return = collected['system_return']
+            self.size = collected['size']
+            self.size_details = collected['size_details']
+            self.compressed_size = collected['compressed_size']
+            self.dumps_size = collected['dumps_size']
+            self.durations = collected['durations']
+            for category, results in collected['results'].items():
+                for target, result in results.items():
+                    self.targets.set_result(category, target, result)
+            return
+
         self._collect_system_files()
         self._collect_apps_files()
 
@@ -510,8 +726,12 @@ class BackupManager():
             raise MoulinetteError(errno.EINVAL, m18n.n('backup_nothings_done'))
 
         # Add unlisted files from backup tmp dir
-        self._add_to_list_to_backup('backup.csv')
-        self._add_to_list_to_backup('info.json')
+        # backup.csv and info.json are put at the beginning of the archive, so
+        # that the restore knows its layout before reaching any data
+        archive_header = []
+        self._add_to_list_to_backup('backup.csv', paths=archive_header)
+        self._add_to_list_to_backup('info.json', paths=archive_header)
+        self.paths_to_backup[0:0] = archive_header
         if len(self.apps_return) > 0:
             self._add_to_list_to_backup('apps')
         if os.path.isdir(os.path.join(self.work_dir, 'conf')):
@@ -529,6 +749,18 @@ class BackupManager():
         with open("%s/info.json" % self.work_dir, 'w') as f:
             f.write(json.dumps(self.info))
 
+        # The paths to backup are in the CSV file, so they aren't saved again
+        self.save_checkpoint('collected', {
+            'apps_return': self.apps_return,
+            'system_return': self.system_return,
+            'size': self.size,
+            'size_details': self.size_details,
+            'compressed_size': self.compressed_size,
+            'dumps_size': self.dumps_size,
+            'durations': self.durations,
+            'results': self.targets.results,
+        })
+
     def _get_env_var(self, app=None):
         """
         Define environment variables for apps or system backup scripts.
@@ -571,6 +803,10 @@ class BackupManager():
                           defined by the user)
         YNH_BACKUP_CSV -- A temporary CSV where the script whould list paths toi
                           backup
+
+        Each hook is saved in the checkpoint with the paths it listed once it
+        has been executed. When the backup is resumed, hooks which succeeded
+        are not executed again.
         """
 
         system_targets = self.targets.list("system", exclude=["Skipped"])
@@ -584,21 +820,66 @@ class BackupManager():
         # Prepare environnement
         env_dict = self._get_env_var()
 
+        # Hooks executed before the backup was interrupted, failed ones are
+        # executed again
+        hooks_done = [hook for hook in self.checkpoint.get('system', [])
+                      if hook['succeed']]
+        for hook in hooks_done:
+            hook['paths'] = [BackupPath(*row) for row in hook['paths']]
+        csv_offset = [0]
+
+        # Keep track of the time spent in each hook
+        started_at = {}
+
+        def _start_timer(name, priority, path, args):
+            started_at[path] = time.time()
+            return args
+
+        def _save_hook(name, priority, path, succeed):
+            duration = time.time() - started_at.pop(path)
+
+            # The paths listed by this hook are the ones added to the CSV
+            # since the previous hook
+            rows = []
+            csv_offset[0] = self._import_to_list_to_backup(
+                env_dict["YNH_BACKUP_CSV"], rows, csv_offset[0])
+            hooks_done.append({
+                'name': name,
+                'path': path,
+                'succeed': succeed,
+                'paths': rows,
+                'duration': round(duration, 3),
+            })
+            self.save_checkpoint('system', hooks_done)
+
         # Actual call to backup scripts/hooks
+        # They are executed one by one, as the paths listed by each hook are
+        # found from their position in the shared CSV
+
+        hook_callback('backup',
+                      system_targets,
+                      args=[self.work_dir],
+                      env=env_dict,
+                      chdir=self.work_dir,
+                      pre_callback=_start_timer,
+                      post_callback=_save_hook,
+                      skip_paths=[hook['path'] for hook in hooks_done],
+                      jobs=1)
+        filesystem.rm(env_dict["YNH_BACKUP_CSV"], force=True)
 
-        ret = hook_callback('backup',
-                            system_targets,
-                            args=[self.work_dir],
-                            env=env_dict,
-                            chdir=self.work_dir)
+        # Add files from targets (which they put in the CSV) to the list of
+        # files to backup
+        ret = {'succeed': {}, 'failed': {}}
+        for hook in hooks_done:
+            state = 'succeed' if hook['succeed'] else 'failed'
+            ret[state].setdefault(hook['name'], []).append(hook['path'])
+            self.paths_to_backup.extend(hook['paths'])
+            self.durations['system'][hook['name']] = \
+                self.durations['system'].get(hook['name'], 0) + hook['duration']
 
         if ret["succeed"] != []:
             self.system_return = ret["succeed"]
 
-        # Add files from targets (which they put in the CSV) to the list of
-        # files to backup
-        self._import_to_list_to_backup(env_dict["YNH_BACKUP_CSV"])
-
         # Save restoration hooks for each part that suceeded (and which have
         # a restore hook available)
 
@@ -624,19 +905,56 @@ class BackupManager():
             self.targets.set_result("system", part, "Error")
 
     def _collect_apps_files(self):
-        """ Prepare backup for each selected apps """
+        """
+        Prepare backup for each selected apps
+
+        App backup scripts spend most of their time in database dumps, which
+        are independent from one app to another. So up to
+        "backup.collect.parallel_jobs" scripts are run at the same time. Each
+        of them lists its paths in its own CSV, and the paths are then added
+        to the paths_to_backup list in the order of the targets, so the
+        archive layout doesn't depend on which script finished first.
+        """
 
         apps_targets = self.targets.list("apps", exclude=["Skipped"])
 
-        for app_instance_name in apps_targets:
-            self._collect_app_files(app_instance_name)
+        # If nothing to backup, return immediately
+        if apps_targets == []:
+            return
+
+        jobs = min(max(settings_get('backup.collect.parallel_jobs'), 1),
+                   len(apps_targets))
+
+        if jobs == 1:
+            apps_paths = [self._collect_app_files(app) for app in apps_targets]
+        else:
+            # Create the common parent directory now to avoid races between
+            # app scripts
+            apps_dir = os.path.join(self.work_dir, 'apps')
+            if not os.path.isdir(apps_dir):
+                filesystem.mkdir(apps_dir, 0750, True, uid='admin')
+
+            pool = ThreadPool(jobs, initializer=_init_worker_thread)
+            try:
+                # map() keeps the order of the targets
+                apps_paths = pool.map(self._collect_app_files, apps_targets)
+            finally:
+                pool.close()
+                pool.join()
+
+        for paths in apps_paths:
+            self.paths_to_backup.extend(paths)
 
     def _collect_app_files(self, app):
         """
-        List files to backup for the app into the paths_to_backup dict.
+        List files to backup for the app
 
         If the app backup script fails, paths from this app already listed for
-        backup aren't added to the general list and will be ignored
+        backup aren't returned and will be ignored
+
+        Once the app backup script succeeded, the app is saved in the
+        checkpoint, so that the script isn't executed again if the backup is
+        resumed
 
         Environment variables:
         YNH_BACKUP_DIR -- The backup working directory (in
@@ -656,11 +974,29 @@ class BackupManager():
         Args:
         app -- (string) an app instance name (already installed) to backup
 
+        Return:
+            (list) The paths to backup listed by the app backup script
+
         Exceptions:
         backup_app_failed -- Raised at the end if the app backup script
                              execution failed
         """
         app_setting_path = os.path.join('/etc/yunohost/apps/', app)
+        abs_tmp_app_dir = os.path.join(self.work_dir, 'apps/', app)
+        app_paths = []
+        started_at = time.time()
+
+        # The app has already been backuped before the backup was interrupted
+        if app in self.checkpoint.get('apps', {}):
+            app_done = self.checkpoint['apps'][app]
+            self.apps_return[app] = app_done['info']
+            self.targets.set_result("apps", app, "Success")
+            self.durations['apps'][app] = app_done['duration']
+            return [BackupPath(*row) for row in app_done['paths']]
+
+        # Remove what an interrupted backup script could have left
+        if os.path.exists(abs_tmp_app_dir):
+            shutil.rmtree(abs_tmp_app_dir, ignore_errors=True)
 
         # Prepare environment
         env_dict = self._get_env_var(app)
@@ -683,12 +1019,13 @@ class BackupManager():
             hook_exec(tmp_script, args=[tmp_app_bkp_dir, app],
                       raise_on_error=True, chdir=tmp_app_bkp_dir, env=env_dict)
 
-            self._import_to_list_to_backup(env_dict["YNH_BACKUP_CSV"])
+            self._import_to_list_to_backup(env_dict["YNH_BACKUP_CSV"],
+                                           app_paths)
         except:
-            abs_tmp_app_dir = os.path.join(self.work_dir, 'apps/', app)
             shutil.rmtree(abs_tmp_app_dir, ignore_errors=True)
             logger.exception(m18n.n('backup_app_failed', app=app))
             self.targets.set_result("apps", app, "Error")
+            app_paths = []
         else:
             # Add app info
             i = app_info(app)
@@ -703,6 +1040,16 @@ class BackupManager():
         finally:
             filesystem.rm(tmp_script, force=True)
             filesystem.rm(env_dict["YNH_BACKUP_CSV"], force=True)
+            self.durations['apps'][app] = round(time.time() - started_at, 3)
+
+        if app in self.apps_return:
+            self.save_checkpoint(('apps', app), {
+                'info': self.apps_return[app],
+                'paths': app_paths,
+                'duration': self.durations['apps'][app],
+            })
+
+        return app_paths
 
     ###########################################################################
     #   Actual backup archive creation / method management                    #
@@ -728,49 +1075,57 @@ class BackupManager():
             method.mount_and_backup(self)
             logger.debug(m18n.n('backup_method_' + method.method_name + '_finished'))
 
+        self.clean_checkpoint()
+
     def _compute_backup_size(self):
         """
         Compute backup global size and details size for each apps and system
         parts
 
-        Update self.size and self.size_details
+        Update self.size, self.size_details, self.compressed_size and
+        self.dumps_size
 
         Note: currently, these sizes are the size in this archive, not really
         the size of needed to restore the archive. To know the size needed to
-        restore we should consider apt/npm/pip dependencies space and database
-        dump restore operations.
+        restore we should consider apt/npm/pip dependencies space. The space
+        needed to load the database dumps is estimated from samples of them.
+
+        The size of the compressed archive is estimated by compressing a few
+        samples of each path to backup, read during the walk which sizes it.
 
         Return:
             (int) The global size of the archive in bytes
         """
-        # FIXME Database dump will be loaded, so dump should use almost the
-        # double of their space
         # FIXME Some archive will set up dependencies, those are not in this
         # size info
         self.size = 0
+        self.compressed_size = 0
         for system_key in self.system_return:
             self.size_details['system'][system_key] = 0
+            self.dumps_size['system'][system_key] = _dumps_size(
+                os.path.join(self.work_dir, system_key.replace('_', '/')))
         for app_key in self.apps_return:
             self.size_details['apps'][app_key] = 0
+            self.dumps_size['apps'][app_key] = _dumps_size(
+                os.path.join(self.work_dir, 'apps', app_key))
+
+        targets = _TargetTrie(self.apps_return, self.system_return)
 
         for row in self.paths_to_backup:
-            if row['dest'] != "info.json":
-                size = disk_usage(row['source'])
+            if row.dest != "info.json":
+                size, compressed_size = _estimate_sizes(row.source)
+                self.compressed_size += compressed_size
 
-                # Add size to apps details
-                splitted_dest = row['dest'].split('/')
-                category = splitted_dest[0]
-                if category == 'apps':
+                if row.dest == 'apps':
+                    # Files generated by the app backup scripts
                     for app_key in self.apps_return:
-                        if row['dest'].startswith('apps/' + app_key):
-                            self.size_details['apps'][app_key] += size
-                            break
-                # OR Add size to the correct system element
-                elif category == 'data' or category == 'conf':
-                    for system_key in self.system_return:
-                        if row['dest'].startswith(system_key.replace('_', '/')):
-                            self.size_details['system'][system_key] += size
-                            break
+                        self.size_details['apps'][app_key] += disk_usage(
+                            os.path.join(row.source, app_key))
+                else:
+                    # Add size to the app or system element of the path
+                    target = targets.lookup(row.dest)
+                    if target is not None:
+                        self.size_details[target[0]][target[1]] += size
 
                 self.size += size
 
@@ -1066,6 +1421,14 @@ class RestoreManager():
                     size += self.info['size_details']['apps'][app]
                     margin = APP_MARGIN_SPACE_SIZE * 1024 * 1024
 
+        # Database dumps are loaded into the databases, which need space on
+        # top of the extracted dumps
+        dumps_size = self.info.get('dumps_size', {})
+        for system_element in system or []:
+            size += dumps_size.get('system', {}).get(system_element, 0)
+        for app in apps or []:
+            size += dumps_size.get('apps', {}).get(app, 0)
+
         if not os.path.isfile('/etc/yunohost/installed'):
             size += POSTINSTALL_ESTIMATE_SPACE_SIZE * 1024 * 1024
         return (size, margin)
@@ -1183,11 +1546,14 @@ class RestoreManager():
         env_dict = self._get_env_var()
         operation_logger.extra['env'] = env_dict
         operation_logger.flush()
+        # System parts are restored one by one, as some of them regenerate
+        # the configuration of the same services
         ret = hook_callback('restore',
                             system_targets,
                             args=[self.work_dir],
                             env=env_dict,
-                            chdir=self.work_dir)
+                            chdir=self.work_dir,
+                            jobs=1)
 
         for part in ret['succeed'].keys():
             self.targets.set_result("system", part, "Success")
@@ -1206,12 +1572,32 @@ class RestoreManager():
         service_regen_conf()
 
     def _restore_apps(self):
-        """Restore all apps targeted"""
+        """
+        Restore all apps targeted
+
+        Apps are restored one by one unless "backup.restore.parallel_jobs" is
+        greater than 1. In this case, several restore scripts run at the same
+        time: files and databases restorations overlap while the helpers
+        serialize the steps which can't (apt/dpkg, nginx reload) with locks.
+        SSOwat configuration is regenerated only once, when cleaning.
+        """
 
         apps_targets = self.targets.list("apps", exclude=["Skipped"])
 
-        for app in apps_targets:
-            self._restore_app(app)
+        jobs = min(settings_get('backup.restore.parallel_jobs'),
+                   len(apps_targets))
+
+        if jobs <= 1:
+            for app in apps_targets:
+                self._restore_app(app)
+            return
+
+        pool = ThreadPool(jobs, initializer=_init_worker_thread)
+        try:
+            pool.map(self._restore_app, apps_targets)
+        finally:
+            pool.close()
+            pool.join()
 
     def _restore_app(self, app_instance_name):
         """
@@ -1474,8 +1860,11 @@ class BackupMethod(object):
         or to organize after mounting the archive before the restoring
         operation.
 
-        The default behaviour is to return False. To change it override the
-        method.
+        The default behaviour is to return False, meaning that the method
+        streams files straight from their `source` path and renames them to
+        their `dest` path on the fly (like tar does with arcname). Nothing but
+        the files generated by the backup scripts are then read from the
+        working directory. To change it override the method.
 
         Note it's not a property because some overrided methods could do long
         treatment to get this info
@@ -1560,7 +1949,7 @@ class BackupMethod(object):
         not_enough_disk_space -- Raise if there isn't enough space.
         """
         # TODO How to do with distant repo or with deduplicated backup ?
-        backup_size = self.manager.size
+        backup_size = self._estimate_output_size()
 
         free_space = free_space_in_directory(self.repo)
 
@@ -1570,6 +1959,12 @@ class BackupMethod(object):
             raise MoulinetteError(errno.EIO, m18n.n(
                 'not_enough_disk_space', path=self.repo))
 
+    def _estimate_output_size(self):
+        """
+        Return the space that the backup will use in the repository, in bytes
+        """
+        return self.manager.size
+
     def _organize_files(self):
         """
         Mount all csv src in their related path
@@ -1784,6 +2179,18 @@ class TarBackupMethod(BackupMethod):
         """Return the compress archive path"""
         return os.path.join(self.repo, self.name + '.tar.gz')
 
+    def _estimate_output_size(self):
+        """
+        Return the estimated size of the compressed archive, with a margin for
+        the inaccuracy of the estimation
+        """
+        return int(self.manager.compressed_size * COMPRESSION_ESTIMATE_MARGIN)
+
+    @property
+    def _archive_part_file(self):
+        """Return the path of the compress archive while it is written"""
+        return self._archive_file + '.part'
+
     def backup(self):
         """
         Compress prepared files
@@ -1791,6 +2198,15 @@ class TarBackupMethod(BackupMethod):
         It adds the info.json in /home/yunohost.backup/archives and if the
         compress archive isn't located here, add a symlink to the archive to.
 
+        The sha256 checksum of each file is computed while it is read to be
+        compressed, and the checksums are added at the end of the archive in
+        a checksums.json file, to be able to verify the archive later.
+
+        The archive is written in a ".part" file, which is renamed once the
+        archive is complete. Every ARCHIVE_CHECKPOINT_SIZE MB, the compressor
+        is flushed and the position in the archive is saved in the
+        checkpoint, so that a resumed backup continues the archive from there.
+
         Exceptions:
            backup_archive_open_failed -- Raised if we can't open the archive
            backup_creation_failed     -- Raised if we can't write in the
@@ -1803,26 +2219,56 @@ class TarBackupMethod(BackupMethod):
         # Check free space in output
         self._check_is_enough_free_space()
 
-        # Open archive file for writing
+        # Open archive file for writing, or reopen it where it was at the
+        # last checkpoint
+        # The checksum of the archive is computed while writing it
+        checkpoint = self.manager.checkpoint.get('archive')
         try:
-            tar = tarfile.open(self._archive_file, "w:gz")
+            archive, tar = self._open_archive(checkpoint)
         except:
             logger.debug("unable to open '%s' for writing",
-                         self._archive_file, exc_info=1)
+                         self._archive_part_file, exc_info=1)
             raise MoulinetteError(errno.EIO,
                                   m18n.n('backup_archive_open_failed'))
 
         # Add files to the archive
         try:
-            for path in self.manager.paths_to_backup:
+            for index, path in enumerate(self.manager.paths_to_backup):
+                # Skip what was already in the archive at the last checkpoint
+                if checkpoint is not None and index < checkpoint['row']:
+                    continue
+
+                self._current_row = index
+                tar.row_members = 0
+
+                if checkpoint is not None and index == checkpoint['row']:
+                    tar.skip_members(checkpoint.get('members', 0),
+                                     checkpoint['member'])
+                    tar.add(path['source'], arcname=path['dest'])
+                    if tar.end_skip():
+                        continue
+
+                    # The files of the row changed since the interruption, so
+                    # it is added again entirely. The members added twice are
+                    # extracted and verified from their last copy.
+                    logger.warning(m18n.n('backup_resume_row_changed',
+                                          path=path['source']))
+                    tar.row_members = 0
+
                 # Add the "source" into the archive and transform the path into
                 # "dest"
                 tar.add(path['source'], arcname=path['dest'])
+            tar.add_checksums()
             tar.close()
+            tar.fileobj.close()
         except IOError:
             logger.error(m18n.n('backup_archive_writing_error'), exc_info=1)
             raise MoulinetteError(errno.EIO,
                                   m18n.n('backup_creation_failed'))
+        finally:
+            archive.close()
+
+        os.rename(self._archive_part_file, self._archive_file)
 
         # Move info file
         shutil.copy(os.path.join(self.work_dir, 'info.json'),
@@ -1834,71 +2280,182 @@ class TarBackupMethod(BackupMethod):
         if not os.path.isfile(link):
             os.symlink(self._archive_file, link)
 
+        info = self.manager.info
+        _update_catalog({self.name: {
+            'path': self._archive_file,
+            'created_at': info['created_at'],
+            'description': info['description'],
+            'size': info['size'],
+            'apps': sorted(info['apps'].keys()),
+            'system': sorted(info['system'].keys()),
+            'codec': 'gz',
+            'checksum': 'sha256:' + archive.hexdigest(),
+        }})
+
+    def _open_archive(self, checkpoint=None):
+        """
+        Open the archive for writing
+
+        Args:
+        checkpoint -- (dict|None) The last archive checkpoint of an
+                      interrupted backup. If None, a new archive is created.
+
+        Return:
+            (tuple) The archive file (_ChecksumFile) and the tar file
+                    (_ChecksumTarFile) to add files to
+        """
+        checksums_path = os.path.join(self.work_dir, CHECKPOINT_CHECKSUMS_FILE)
+        checksums = {}
+
+        if checkpoint is None:
+            archive = _ChecksumFile(open(self._archive_part_file, 'wb'))
+            gzip_file = _GzipWriter(archive)
+            filesystem.rm(checksums_path, force=True)
+        else:
+            # Drop what has been written after the checkpoint
+            archive = _ChecksumFile(open(self._archive_part_file, 'r+b'))
+            archive.fileobj.truncate(checkpoint['offset'])
+
+            # Compute again the checksum of the part already written
+            for data in iter(lambda: archive.read(1024 * 1024), ''):
+                pass
+            archive.fileobj.seek(0, os.SEEK_END)
+            gzip_file = _GzipWriter(archive, checkpoint['gzip'])
+
+            # Checksums of the files already in the archive
+            with open(checksums_path, 'r+b') as f:
+                f.truncate(checkpoint['checksums_size'])
+                for name, checksum in csv.reader(f):
+                    checksums[name] = checksum
+
+        tar = _ChecksumTarFile(self._archive_file, 'w', fileobj=gzip_file)
+        tar.checksums = checksums
+
+        read_bandwidth = settings_get('backup.throttle.read_bandwidth')
+        if read_bandwidth > 0:
+            tar.limiter = _BandwidthLimiter(read_bandwidth * 1024 * 1024)
+        tar.member_callback = self._checkpoint_archive
+        self._checkpointed_size = gzip_file.size
+        self._checksums_to_save = []
+
+        return archive, tar
+
+    def clean(self):
+        """
+        Remove the partial archive of a failed backup along with the
+        temporary working directory, as the checkpoint to resume it is lost
+        """
+        super(TarBackupMethod, self).clean()
+
+        if self.manager.is_tmp_work_dir and \
+                os.path.exists(self._archive_part_file):
+            os.remove(self._archive_part_file)
+
+    def _checkpoint_archive(self, tar, tarinfo):
+        """
+        Save the position in the archive in the checkpoint, if enough data has
+        been written since the last one
+
+        Args:
+        tar     -- (_ChecksumTarFile) The tar file being written
+
+        tarinfo -- (TarInfo) The last member added to the archive
+        """
+        if tarinfo.name in tar.checksums:
+            self._checksums_to_save.append(
+                (tarinfo.name, tar.checksums[tarinfo.name]))
+
+        gzip_file = tar.fileobj
+        if gzip_file.size - self._checkpointed_size < \
+                ARCHIVE_CHECKPOINT_SIZE * 1024 * 1024:
+            return
+
+        # Ensure all the data is on the disk before saving the checkpoint
+        gzip_state = gzip_file.flush_checkpoint()
+        archive = gzip_file.fileobj
+        archive.flush()
+        os.fsync(archive.fileno())
+
+        checksums_path = os.path.join(self.work_dir, CHECKPOINT_CHECKSUMS_FILE)
+        with open(checksums_path, 'ab') as f:
+            csv.writer(f).writerows(self._checksums_to_save)
+            f.flush()
+            os.fsync(f.fileno())
+            checksums_size = f.tell()
+
+        self.manager.save_checkpoint('archive', {
+            'row': self._current_row,
+            'members': tar.row_members,
+            'member': tarinfo.name,
+            'offset': archive.tell(),
+            'gzip': gzip_state,
+            'checksums_size': checksums_size,
+        })
+        self._checkpointed_size = gzip_file.size
+        self._checksums_to_save = []
+
     def mount(self, restore_manager):
         """
         Mount the archive. We avoid copy to be able to restore on system without
         too many space.
 
+        The compressed archive is read once, sequentially: members are sorted
+        by target as they stream by and only the wanted ones are extracted.
+        As archives put backup.csv first, the reading stops as soon as the
+        last path related to the wanted targets has been extracted. Only
+        hardlinks to files of the other targets need to read the archive
+        again, until the last of these files.
+
         Exceptions:
         backup_archive_open_failed -- Raised if the archive can't be open
         """
         super(TarBackupMethod, self).mount(restore_manager)
 
-        # Check the archive can be open
         try:
-            tar = tarfile.open(self._archive_file, "r:gz")
+            tar = tarfile.open(self._archive_file, "r|gz")
         except:
             logger.debug("cannot open backup archive '%s'",
                          self._archive_file, exc_info=1)
             raise MoulinetteError(errno.EIO,
                                   m18n.n('backup_archive_open_failed'))
-        tar.close()
 
-        # Mount the tarball
         logger.debug(m18n.n("restore_extracting"))
-        tar = tarfile.open(self._archive_file, "r:gz")
-        tar.extract('info.json', path=self.work_dir)
 
         try:
-            tar.extract('backup.csv', path=self.work_dir)
-        except KeyError:
-            # Old backup archive have no backup.csv file
-            pass
+            links = _extract_tar_stream(tar, self.work_dir,
+                                        self._get_prefixes_to_extract())
+        finally:
+            tar.close()
 
-        # Extract system parts backup
-        conf_extracted = False
+        if links:
+            tar = tarfile.open(self._archive_file, "r|gz")
+            try:
+                _extract_link_targets(tar, self.work_dir, links)
+            finally:
+                tar.close()
 
+    def _get_prefixes_to_extract(self):
+        """
+        Return the paths inside the archive which are needed to restore the
+        targets of the RestoreManager
+        """
         system_targets = self.manager.targets.list("system", exclude=["Skipped"])
         apps_targets = self.manager.targets.list("apps", exclude=["Skipped"])
 
+        prefixes = ["backup.csv", "info.json", "hooks/restore"]
+
         for system_part in system_targets:
             # Caution: conf_ynh_currenthost helpers put its files in
             # conf/ynh
             if system_part.startswith("conf_"):
-                if conf_extracted:
-                    continue
-                system_part = "conf/"
-                conf_extracted = True
+                prefixes.append("conf")
             else:
-                system_part = system_part.replace("_", "/") + "/"
-            subdir_and_files = [
-                tarinfo for tarinfo in tar.getmembers()
-                if tarinfo.name.startswith(system_part)
-            ]
-            tar.extractall(members=subdir_and_files, path=self.work_dir)
-        subdir_and_files = [
-            tarinfo for tarinfo in tar.getmembers()
-            if tarinfo.name.startswith("hooks/restore/")
-        ]
-        tar.extractall(members=subdir_and_files, path=self.work_dir)
-
-        # Extract apps backup
+                prefixes.append(system_part.replace("_", "/"))
+
         for app in apps_targets:
-            subdir_and_files = [
-                tarinfo for tarinfo in tar.getmembers()
-                if tarinfo.name.startswith("apps/" + app)
-            ]
-            tar.extractall(members=subdir_and_files, path=self.work_dir)
+            prefixes.append("apps/" + app)
+
+        return list(set(prefixes))
 
 
 class BorgBackupMethod(BackupMethod):
@@ -1940,6 +2497,11 @@ class CustomBackupMethod(BackupMethod):
     def need_mount(self):
         """Call the backup_method hook to know if we need to organize files
 
+        A custom method which is able to read the YNH_BACKUP_CSV file given in
+        its environment should fail on this step: it will then stream each
+        `source` path to its `dest` path by itself and no bind mount or copy
+        will be done in the working directory.
+
         Exceptions:
         backup_custom_need_mount_error -- Raised if the hook failed
         """
@@ -1947,7 +2509,8 @@ class CustomBackupMethod(BackupMethod):
             return self._need_mount
 
         ret = hook_callback('backup_method', [self.method],
-                            args=self._get_args('need_mount'))
+                            args=self._get_args('need_mount'),
+                            env=self._get_env_var())
 
         self._need_mount = True if ret['succeed'] else False
         return self._need_mount
@@ -1961,7 +2524,8 @@ class CustomBackupMethod(BackupMethod):
         """
 
         ret = hook_callback('backup_method', [self.method],
-                            args=self._get_args('backup'))
+                            args=self._get_args('backup'),
+                            env=self._get_env_var())
         if ret['failed']:
             raise MoulinetteError(errno.EIO,
                                   m18n.n('backup_custom_backup_error'))
@@ -1985,6 +2549,22 @@ class CustomBackupMethod(BackupMethod):
         return [action, self.work_dir, self.name, self.repo, self.manager.size,
                 self.manager.description]
 
+    def _get_env_var(self):
+        """
+        Define environment variables for the custom script
+
+        YNH_BACKUP_CSV lists the source and dest of each path to backup, so
+        that the script can read files directly from their source.
+        YNH_BACKUP_READ_BANDWIDTH is the maximum speed at which the script
+        should read files, in MB/s (0 means no limit).
+        """
+        return {
+            'YNH_BACKUP_DIR': self.work_dir,
+            'YNH_BACKUP_CSV': os.path.join(self.work_dir, 'backup.csv'),
+            'YNH_BACKUP_READ_BANDWIDTH':
+                str(settings_get('backup.throttle.read_bandwidth')),
+        }
+
 
 ###############################################################################
 #   "Front-end"                                                               #
@@ -1992,7 +2572,7 @@ class CustomBackupMethod(BackupMethod):
 
 def backup_create(name=None, description=None, methods=[],
                   output_directory=None, no_compress=False,
-                  system=[], apps=[]):
+                  system=[], apps=[], resume=False):
     """
     Create a backup local archive
 
@@ -2004,6 +2584,7 @@ def backup_create(name=None, description=None, methods=[],
         no_compress -- Do not create an archive file
         system -- List of system elements to backup
         apps -- List of application names to backup
+        resume -- Resume the interrupted backup with this name
     """
 
     # TODO: Add a 'clean' argument to clean output directory
@@ -2012,6 +2593,11 @@ def backup_create(name=None, description=None, methods=[],
     #   Validate / parse arguments                                            #
     ###########################################################################
 
+    # An interrupted backup can only be resumed with its name
+    if resume and not name:
+        raise MoulinetteError(errno.EINVAL,
+                              m18n.n('backup_resume_name_required'))
+
     # Validate there is no archive with the same name
     if name and name in backup_list()['archives']:
         raise MoulinetteError(errno.EINVAL,
@@ -2029,7 +2615,7 @@ def backup_create(name=None, description=None, methods=[],
                                   m18n.n('backup_output_directory_forbidden'))
 
         # Check that output directory is empty
-        if os.path.isdir(output_directory) and no_compress and \
+        if os.path.isdir(output_directory) and no_compress and not resume and \
                 os.listdir(output_directory):
             raise MoulinetteError(errno.EIO,
                                   m18n.n('backup_output_directory_not_empty'))
@@ -2059,9 +2645,21 @@ def backup_create(name=None, description=None, methods=[],
     # Prepare files to backup
     if no_compress:
         backup_manager = BackupManager(name, description,
-                                       work_dir=output_directory)
+                                       work_dir=output_directory,
+                                       resume=resume)
+    else:
+        backup_manager = BackupManager(name, description, resume=resume)
+
+    # Backup the same targets with the same methods than the interrupted
+    # backup
+    if resume:
+        system = backup_manager.checkpoint['targets']['system']
+        apps = backup_manager.checkpoint['targets']['apps']
+        methods = backup_manager.checkpoint['targets'].get('methods', methods)
     else:
-        backup_manager = BackupManager(name, description)
+        backup_manager.save_checkpoint('targets', {'system': system,
+                                                   'apps': apps,
+                                                   'methods': methods})
 
     # Add backup methods
     if output_directory:
@@ -2080,18 +2678,27 @@ def backup_create(name=None, description=None, methods=[],
     #   Collect files and put them in the archive                             #
     ###########################################################################
 
-    # Collect files to be backup (by calling app backup script / system hooks)
-    backup_manager.collect_files()
+    # Lower the priority of the backup so that it doesn't slow down the
+    # services, backup scripts and hooks inherit it
+    previous_priority = _set_backup_priority()
 
-    # Apply backup methods on prepared files
-    backup_manager.backup()
+    try:
+        # Collect files to be backup (by calling app backup script / system
+        # hooks)
+        backup_manager.collect_files()
+
+        # Apply backup methods on prepared files
+        backup_manager.backup()
+    finally:
+        _restore_priority(previous_priority)
 
     logger.success(m18n.n('backup_created'))
 
     return {
         'name': backup_manager.name,
         'size': backup_manager.size,
-        'results': backup_manager.targets.results
+        'results': backup_manager.targets.results,
+        'durations': backup_manager.durations
     }
 
 
@@ -2174,6 +2781,7 @@ def backup_list(with_info=False, human_readable=False):
 
     """
     result = []
+    catalog = _get_catalog()
 
     try:
         # Retrieve local archives
@@ -2183,20 +2791,51 @@ def backup_list(with_info=False, human_readable=False):
     else:
         # Iterate over local archives
         for f in archives:
+            # Skip archives which are still being written
+            if f.endswith('.part'):
+                continue
             try:
                 name = f[:f.rindex('.tar.gz')]
             except ValueError:
                 continue
             result.append(name)
-        result.sort(key=lambda x: os.path.getctime(os.path.join(ARCHIVES_PATH, x+".tar.gz")))
+
+        # Archives known by the catalog are sorted without touching them, as
+        # they may be on a slow external storage
+        def _created_at(name):
+            if name in catalog:
+                return catalog[name]['created_at']
+            return os.path.getctime(os.path.join(ARCHIVES_PATH, name + ".tar.gz"))
+
+        result.sort(key=_created_at)
 
     if result and with_info:
         d = OrderedDict()
+        new_entries = {}
         for a in result:
-            try:
-                d[a] = backup_info(a, human_readable=human_readable)
-            except MoulinetteError, e:
-                logger.warning('%s: %s' % (a, e.strerror))
+            if a in catalog:
+                entry = catalog[a]
+            else:
+                # The info of the archive are read once, for both the output
+                # and the catalog
+                try:
+                    entry = new_entries[a] = _get_catalog_entry(a)
+                except MoulinetteError, e:
+                    logger.warning('%s: %s' % (a, e.strerror))
+                    continue
+
+            size = entry['size']
+            if human_readable:
+                size = binary_to_human(size) + 'B'
+            d[a] = {
+                'path': entry['path'],
+                'created_at': datetime.utcfromtimestamp(entry['created_at']),
+                'description': entry['description'],
+                'size': size,
+            }
+
+        if new_entries:
+            _update_catalog(new_entries)
 
         result = d
 
@@ -2283,6 +2922,137 @@ def backup_info(name, with_details=False, human_readable=False):
     return result
 
 
+def backup_verify(name=[], jobs=1):
+    """
+    Verify the integrity of local backup archives
+
+    Each archive is read once, sequentially, and the checksum of each file is
+    compared to the one recorded when the archive was created.
+
+    Keyword arguments:
+        name -- Names of the local backup archives to verify (all if empty)
+        jobs -- Number of archives to verify at the same time
+
+    """
+    archives = backup_list()['archives']
+
+    for archive in name:
+        if archive not in archives:
+            raise MoulinetteError(errno.EIO,
+                                  m18n.n('backup_archive_name_unknown',
+                                         name=archive))
+
+    names = name or archives
+    if not names:
+        return {'archives': {}}
+
+    jobs = min(max(jobs or 1, 1), len(names))
+    if jobs == 1:
+        results = [_verify_archive(archive) for archive in names]
+    else:
+        pool = ThreadPool(jobs)
+        try:
+            results = pool.map(_verify_archive, names)
+        finally:
+            pool.close()
+            pool.join()
+
+    return {'archives': OrderedDict(zip(names, results))}
+
+
+def _verify_archive(name):
+    """
+    Verify an archive in a single streaming pass
+
+    Return:
+        (dict) The status of the archive ('ok', 'damaged', 'unreadable' or
+        'unverifiable') and the damaged files sorted by app and system part
+    """
+    archive_file = os.path.realpath(os.path.join(ARCHIVES_PATH,
+                                                 name + '.tar.gz'))
+    result = {'status': 'ok'}
+    checksums = {}
+    expected = None
+    info = {}
+
+    try:
+        archive = _ChecksumFile(open(archive_file, 'rb'))
+        try:
+            tar = tarfile.open(archive_file, "r|gz", fileobj=archive)
+            for tarinfo in tar:
+                if not tarinfo.isreg():
+                    continue
+
+                f = tar.extractfile(tarinfo)
+                if tarinfo.name == CHECKSUMS_FILE:
+                    expected = _byteify(json.load(f)['files'])
+                    continue
+                if tarinfo.name == 'info.json':
+                    data = f.read()
+                    info = json.loads(data)
+                    checksums[tarinfo.name] = hashlib.sha256(data).hexdigest()
+                    continue
+
+                checksum = hashlib.sha256()
+                for chunk in iter(lambda: f.read(1024 * 1024), ''):
+                    checksum.update(chunk)
+                checksums[tarinfo.name] = checksum.hexdigest()
+            tar.close()
+        finally:
+            archive.close()
+    except (IOError, EOFError, tarfile.TarError, zlib.error, ValueError) as e:
+        logger.error(m18n.n('backup_verify_unreadable', name=name,
+                            error=str(e)))
+        return {'status': 'unreadable', 'error': str(e)}
+
+    catalog_checksum = _get_catalog().get(name, {}).get('checksum')
+    if catalog_checksum and \
+            catalog_checksum != 'sha256:' + archive.hexdigest():
+        result['status'] = 'damaged'
+
+    if expected is None:
+        logger.warning(m18n.n('backup_verify_no_checksums', name=name))
+        if result['status'] == 'ok':
+            result['status'] = 'unverifiable'
+        return result
+
+    damaged = [path for path, checksum in expected.items()
+               if checksums.get(path) != checksum]
+
+    if damaged or result['status'] == 'damaged':
+        result['status'] = 'damaged'
+        result['damaged'] = _sort_paths_by_target(
+            damaged, info.get('apps', {}).keys(),
+            info.get('system', info.get('hooks', {})).keys())
+        logger.error(m18n.n('backup_verify_damaged', name=name,
+                            count=len(damaged)))
+    else:
+        logger.success(m18n.n('backup_verify_ok', name=name))
+
+    return result
+
+
+def _sort_paths_by_target(paths, apps, system_parts):
+    """
+    Sort paths of an archive by the app or system part they belong to
+
+    Return:
+        (dict) Lists of paths, by app and by system part. Paths which belong
+        to no target (like info.json) are listed in 'other'
+    """
+    result = {'apps': {}, 'system': {}, 'other': []}
+    targets = _TargetTrie(apps, system_parts)
+
+    for path in sorted(paths):
+        target = targets.lookup(path)
+        if target is None:
+            result['other'].append(path)
+        else:
+            result[target[0]].setdefault(target[1], []).append(path)
+
+    return result
+
+
 def backup_delete(name):
     """
     Delete a backup
@@ -2307,36 +3077,1259 @@ def backup_delete(name):
             logger.debug("unable to delete '%s'", backup_file, exc_info=1)
             logger.warning(m18n.n('backup_delete_error', path=backup_file))
 
+    _remove_from_catalog(name)
+
     hook_callback('post_backup_delete', args=[name])
 
     logger.success(m18n.n('backup_deleted'))
 
-###############################################################################
-#   Misc helpers                                                              #
-###############################################################################
 
+def backup_schedule_add(name, system=[], apps=[], methods=[],
+                        window='02:00-05:00', keep_daily=7, keep_weekly=4,
+                        keep_monthly=6):
+    """
+    Add a backup schedule
 
-def _create_archive_dir():
-    """ Create the YunoHost archives directory if doesn't exist """
-    if not os.path.isdir(ARCHIVES_PATH):
-        if os.path.lexists(ARCHIVES_PATH):
+    Keyword arguments:
+        name -- Name of the backup schedule
+        system -- List of system elements to backup
+        apps -- List of application names to backup
+        methods -- List of backup methods to use, it must include tar
+        window -- Time window (HH:MM-HH:MM) in which the backup may run
+        keep_daily -- Number of daily archives to keep
+        keep_weekly -- Number of weekly archives to keep
+        keep_monthly -- Number of monthly archives to keep
+
+    Only the local tar archives are pruned by the retention policy, the
+    copies made by the other methods are kept.
+
+    """
+    schedules = _get_backup_schedules()
+
+    if name in schedules:
+        raise MoulinetteError(errno.EEXIST,
+                              m18n.n('backup_schedule_already_exists',
+                                     name=name))
+
+    # If no --system or --apps given, backup everything
+    if system is None and apps is None:
+        system = []
+        apps = []
+
+    # The retention policy prunes the archives listed by backup_list, which
+    # are the ones of the tar method
+    if methods and 'tar' not in methods:
+        raise MoulinetteError(errno.EINVAL,
+                              m18n.n('backup_schedule_tar_method_required'))
+
+    _parse_backup_schedule_window(window)
+
+    for keep in [keep_daily, keep_weekly, keep_monthly]:
+        if keep < 0:
             raise MoulinetteError(errno.EINVAL,
-                                  m18n.n('backup_output_symlink_dir_broken',
-                                         path=ARCHIVES_PATH))
+                                  m18n.n('backup_schedule_invalid_retention'))
+
+    schedules[name] = {
+        'system': system,
+        'apps': apps,
+        'methods': methods or [],
+        'window': window,
+        'keep': {
+            'daily': keep_daily,
+            'weekly': keep_weekly,
+            'monthly': keep_monthly,
+        },
+    }
 
-        os.mkdir(ARCHIVES_PATH, 0750)
+    _save_backup_schedules(schedules)
 
+    logger.success(m18n.n('backup_schedule_added', name=name))
 
-def _call_for_each_path(self, callback, csv_path=None):
-    """ Call a callback for each path in csv """
-    if csv_path is None:
-        csv_path = self.csv_path
-    with open(csv_path, "r") as backup_file:
-        backup_csv = csv.DictReader(backup_file, fieldnames=['source', 'dest'])
+
+def backup_schedule_list():
+    """
+    List backup schedules and the archives they have created
+
+    """
+    schedules = _get_backup_schedules()
+    archives = backup_list()['archives']
+
+    for name, schedule in schedules.items():
+        schedule['archives'] = sorted(
+            archive for archive in archives
+            if _backup_schedule_archive_date(name, archive) is not None)
+
+    return {'schedules': schedules}
+
+
+def backup_schedule_remove(name):
+    """
+    Remove a backup schedule, its archives are kept
+
+    Keyword arguments:
+        name -- Name of the backup schedule
+
+    """
+    schedules = _get_backup_schedules()
+
+    if name not in schedules:
+        raise MoulinetteError(errno.EINVAL,
+                              m18n.n('backup_schedule_unknown', name=name))
+
+    del schedules[name]
+
+    _save_backup_schedules(schedules)
+
+    logger.success(m18n.n('backup_schedule_removed', name=name))
+
+
+@is_unit_operation(entities=[('name', 'backup_schedule')])
+def backup_schedule_run(operation_logger, name, force=False):
+    """
+    Run a backup schedule then prune its old archives
+
+    Keyword arguments:
+        name -- Name of the backup schedule
+        force -- Run the schedule even outside of its time window
+
+    """
+    schedules = _get_backup_schedules()
+
+    if name not in schedules:
+        raise MoulinetteError(errno.EINVAL,
+                              m18n.n('backup_schedule_unknown', name=name))
+
+    schedule = schedules[name]
+
+    if not force and \
+            not _is_in_backup_schedule_window(schedule['window']):
+        logger.info(m18n.n('backup_schedule_outside_window', name=name,
+                           window=schedule['window']))
+        return {'archive': None, 'pruned': []}
+
+    # Only one scheduled backup at a time, a long backup must not be
+    # overlapped by the next one started by cron
+    lock = open(SCHEDULES_LOCK_PATH, 'w')
+    try:
+        fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except IOError:
+        lock.close()
+        raise MoulinetteError(errno.EBUSY,
+                              m18n.n('backup_schedule_already_running'))
+
+    try:
+        operation_logger.start()
+
+        archive = _run_backup_schedule(name, schedule)
+        operation_logger.extra['archive'] = archive
+        operation_logger.flush()
+
+        pruned = _prune_backup_schedule(name, schedule['keep'])
+        operation_logger.extra['pruned'] = pruned
+        operation_logger.flush()
+    finally:
+        fcntl.flock(lock, fcntl.LOCK_UN)
+        lock.close()
+
+    return {'archive': archive, 'pruned': pruned}
+
+
+def _run_backup_schedule(name, schedule):
+    """
+    Create the archive of a schedule, resuming the last interrupted one if any
+
+    Return the name of the created archive
+    """
+    interrupted = []
+    for tmp_dir in glob('%s/tmp/%s-*' % (BACKUP_PATH, name)):
+        archive = os.path.basename(tmp_dir)
+        if _backup_schedule_archive_date(name, archive) is not None and \
+                os.path.isfile(os.path.join(tmp_dir, CHECKPOINT_FILE)):
+            interrupted.append(archive)
+
+    # Archive names contain their date, so the last one is the newest
+    interrupted.sort()
+    for archive in interrupted[:-1]:
+        _clean_interrupted_backup(archive)
+
+    if interrupted:
+        archive = interrupted[-1]
+        logger.info(m18n.n('backup_resuming', name=archive))
+        try:
+            backup_create(name=archive, methods=schedule['methods'],
+                          resume=True)
+        except:
+            _clean_interrupted_backup(archive)
+            raise
+        return archive
+
+    archive = '%s-%s' % (name, time.strftime('%Y%m%d-%H%M%S', time.gmtime()))
+    backup_create(name=archive,
+                  description=m18n.n('backup_schedule_description', name=name),
+                  methods=schedule['methods'],
+                  system=schedule['system'], apps=schedule['apps'])
+    return archive
+
+
+def _clean_interrupted_backup(name):
+    """ Remove the working directory and the partial archive of a backup """
+    tmp_dir = '%s/tmp/%s' % (BACKUP_PATH, name)
+    if os.path.isdir(tmp_dir):
+        filesystem.rm(tmp_dir, recursive=True, force=True)
+
+    part_file = '%s/%s.tar.gz.part' % (ARCHIVES_PATH, name)
+    if os.path.exists(part_file):
+        os.remove(part_file)
+
+
+def _prune_backup_schedule(name, keep):
+    """
+    Delete the archives of a schedule which are not kept by its
+    grandfather-father-son retention policy
+
+    Only the local tar archives listed by backup_list are pruned, the copies
+    made by the other methods of the schedule are left to them.
+
+    Return the list of deleted archives
+    """
+    archives = []
+    for archive in backup_list()['archives']:
+        date = _backup_schedule_archive_date(name, archive)
+        if date is not None:
+            archives.append((date, archive))
+
+    kept = set(_select_backups_to_keep(archives, keep))
+
+    pruned = []
+    for date, archive in sorted(archives):
+        if archive in kept:
+            continue
+        backup_delete(archive)
+        logger.info(m18n.n('backup_schedule_archive_pruned', name=archive))
+        pruned.append(archive)
+
+    return pruned
+
+
+def _select_backups_to_keep(archives, keep):
+    """
+    Select the archives to keep among (date, name) tuples: the newest archive
+    of each of the last keep['daily'] days, keep['weekly'] ISO weeks and
+    keep['monthly'] months which have one. The newest archive is always kept.
+    """
+    if not archives:
+        return []
+
+    archives = sorted(archives, reverse=True)
+    kept = [archives[0][1]]
+
+    periods = [
+        (keep['daily'], lambda date: date.date()),
+        (keep['weekly'], lambda date: date.isocalendar()[:2]),
+        (keep['monthly'], lambda date: (date.year, date.month)),
+    ]
+    for count, period_of in periods:
+        seen = set()
+        for date, archive in archives:
+            if len(seen) >= count:
+                break
+            period = period_of(date)
+            if period in seen:
+                continue
+            seen.add(period)
+            kept.append(archive)
+
+    return kept
+
+
+def _backup_schedule_archive_date(name, archive):
+    """
+    Return the local date of an archive created by a schedule, or None
+
+    Archive names contain the UTC date, which is converted to the local time
+    like the schedule window, so that archives are kept by local day, week
+    and month.
+    """
+    match = re.match(r'^%s-(\d{8}-\d{6})$' % re.escape(name), archive)
+    if match is None:
+        return None
+
+    try:
+        date = datetime.strptime(match.group(1), '%Y%m%d-%H%M%S')
+    except ValueError:
+        return None
+
+    return datetime.fromtimestamp(calendar.timegm(date.timetuple()))
+
+
+def _parse_backup_schedule_window(window):
+    """ Return the start and end of a HH:MM-HH:MM window as (hour, minute) """
+    match = re.match(r'^(\d{1,2}):(\d{2})-(\d{1,2}):(\d{2})$', window)
+    if match is None:
+        raise MoulinetteError(errno.EINVAL,
+                              m18n.n('backup_schedule_invalid_window',
+                                     window=window))
+
+    hours_minutes = [int(x) for x in match.groups()]
+    if any(hour > 23 for hour in hours_minutes[::2]) or \
+            any(minute > 59 for minute in hours_minutes[1::2]):
+        raise MoulinetteError(errno.EINVAL,
+                              m18n.n('backup_schedule_invalid_window',
+                                     window=window))
+
+    return tuple(hours_minutes[:2]), tuple(hours_minutes[2:])
+
+
+def _is_in_backup_schedule_window(window, now=None):
+    """ Check if the current local time is in a (possibly overnight) window """
+    start, end = _parse_backup_schedule_window(window)
+    now = now or datetime.now()
+    current = (now.hour, now.minute)
+
+    if start <= end:
+        return start <= current <= end
+    return current >= start or current <= end
+
+
+def _get_backup_schedules():
+    """ Return the backup schedules configuration """
+    if not os.path.exists(SCHEDULES_PATH):
+        return {}
+
+    try:
+        with open(SCHEDULES_PATH) as f:
+            return json.load(f)
+    except IOError as e:
+        logger.debug("unable to read '%s'", SCHEDULES_PATH, exc_info=1)
+        raise MoulinetteError(errno.EIO,
+                              m18n.n('backup_schedules_read_error',
+                                     error=str(e)))
+
+
+def _save_backup_schedules(schedules):
+    """ Save the backup schedules and install their cron jobs """
+    with open(SCHEDULES_PATH, 'w') as f:
+        json.dump(schedules, f, indent=4)
+
+    if not schedules:
+        if os.path.exists(SCHEDULES_CRON_PATH):
+            os.remove(SCHEDULES_CRON_PATH)
+        return
+
+    # Each schedule is started at the beginning of its window
+    with open(SCHEDULES_CRON_PATH, 'w') as f:
+        for name, schedule in sorted(schedules.items()):
+            (hour, minute), _ = _parse_backup_schedule_window(
+                schedule['window'])
+            f.write('%d %d * * * root yunohost backup schedule run %s '
+                    '>> /dev/null 2>&1\n' % (minute, hour, name))
+
+###############################################################################
+#   Misc helpers                                                              #
+###############################################################################
+
+
+def _create_archive_dir():
+    """ Create the YunoHost archives directory if doesn't exist """
+    if not os.path.isdir(ARCHIVES_PATH):
+        if os.path.lexists(ARCHIVES_PATH):
+            raise MoulinetteError(errno.EINVAL,
+                                  m18n.n('backup_output_symlink_dir_broken',
+                                         path=ARCHIVES_PATH))
+
+        os.mkdir(ARCHIVES_PATH, 0750)
+
+
+def _get_catalog():
+    """
+    Return the catalog of the archives
+
+    The catalog is a json file in ARCHIVES_PATH with, for each archive, its
+    path, creation date, description, size, apps, system parts, compression
+    codec and checksum. It allows to list archives without reading them.
+    Entries are invalidated when the archive file in ARCHIVES_PATH (or the
+    symlink to it) is modified.
+    """
+    try:
+        with open(CATALOG_PATH) as f:
+            catalog = json.load(f)
+    except (IOError, ValueError):
+        return {}
+
+    for name, entry in catalog.items():
+        try:
+            mtime = os.lstat(os.path.join(ARCHIVES_PATH, name + '.tar.gz')).st_mtime
+        except OSError:
+            mtime = None
+        if entry.get('mtime') != mtime:
+            del catalog[name]
+
+    return catalog
+
+
+def _save_catalog(catalog):
+    """ Atomically write the catalog of the archives """
+    # Several processes may update the catalog at the same time (e.g. the
+    # scheduler, the monitoring and the CLI), see _lock_catalog()
+    tmp_catalog = '%s.%d' % (CATALOG_PATH, os.getpid())
+    try:
+        with open(tmp_catalog, 'w') as f:
+            json.dump(catalog, f)
+        os.rename(tmp_catalog, CATALOG_PATH)
+    except (IOError, OSError):
+        logger.warning(m18n.n('backup_catalog_update_failed'), exc_info=1)
+
+
+@contextmanager
+def _lock_catalog():
+    """
+    Lock the catalog of the archives against the other processes while it is
+    loaded, updated and saved, so that concurrent updates aren't lost
+    """
+    # The catalog is replaced when saved, so the lock is another file
+    try:
+        lock = open(CATALOG_LOCK_PATH, 'w')
+    except IOError:
+        logger.debug("unable to lock the catalog", exc_info=1)
+        yield
+        return
+
+    try:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        yield
+    finally:
+        lock.close()
+
+
+def _update_catalog(entries):
+    """ Add or replace the entries of some archives in the catalog """
+    with _lock_catalog():
+        catalog = _get_catalog()
+        for name, entry in entries.items():
+            archive_file = os.path.join(ARCHIVES_PATH, name + '.tar.gz')
+            entry['mtime'] = os.lstat(archive_file).st_mtime
+            catalog[name] = entry
+        _save_catalog(catalog)
+
+
+def _remove_from_catalog(name):
+    """ Remove the entry of an archive from the catalog """
+    with _lock_catalog():
+        catalog = _get_catalog()
+        if catalog.pop(name, None) is not None:
+            _save_catalog(catalog)
+
+
+def _get_catalog_entry(name):
+    """
+    Build the catalog entry of an archive which isn't known by the catalog
+    (e.g. copied by hand in ARCHIVES_PATH or created before the catalog
+    existed)
+    """
+    info = backup_info(name, with_details=True)
+    created_at = info['created_at'] - datetime(1970, 1, 1)
+    return {
+        'path': info['path'],
+        'created_at': int(created_at.total_seconds()),
+        'description': info['description'],
+        'size': info['size'],
+        'apps': sorted(info['apps'].keys()),
+        'system': sorted(info['system'].keys()),
+        'codec': 'gz',
+        'checksum': None,
+    }
+
+
+class _ChecksumFile(object):
+    """
+    File object which computes the sha256 checksum of what is written to it
+    or read from it, and optionally limits the read speed with a
+    _BandwidthLimiter
+    """
+
+    def __init__(self, fileobj, limiter=None):
+        self.fileobj = fileobj
+        self.name = fileobj.name
+        self.checksum = hashlib.sha256()
+        self.limiter = limiter
+
+    def read(self, size=-1):
+        data = self.fileobj.read(size)
+        self.checksum.update(data)
+        if self.limiter is not None:
+            self.limiter.consume(len(data))
+        return data
+
+    def write(self, data):
+        self.checksum.update(data)
+        self.fileobj.write(data)
+
+    def tell(self):
+        return self.fileobj.tell()
+
+    def flush(self):
+        self.fileobj.flush()
+
+    def fileno(self):
+        return self.fileobj.fileno()
+
+    def close(self):
+        self.fileobj.close()
+
+    def hexdigest(self):
+        return self.checksum.hexdigest()
+
+
+class _BandwidthLimiter(object):
+    """
+    Token bucket limiting the rate of the data read, by sleeping when it is
+    read too fast. Bursts are limited to one second of data.
+    """
+
+    def __init__(self, rate):
+        self.rate = float(rate)
+        self.allowance = self.rate
+        self.last_check = time.time()
+
+    def consume(self, size):
+        now = time.time()
+        self.allowance = min(self.rate, self.allowance +
+                             (now - self.last_check) * self.rate)
+        self.last_check = now
+
+        self.allowance -= size
+        if self.allowance < 0:
+            time.sleep(-self.allowance / self.rate)
+
+
+class _GzipWriter(object):
+    """
+    Write-only gzip file object which can be resumed after an interruption
+
+    flush_checkpoint() flushes the compressor so that the compressed data
+    written so far doesn't depend on what comes next, and returns the state
+    of the gzip stream at this point. With this state, a new _GzipWriter
+    continues the same gzip stream in a file truncated at the checkpoint, so
+    the archive remains a standard single gzip member.
+    """
+
+    def __init__(self, fileobj, state=None, compresslevel=9):
+        self.fileobj = fileobj
+        self.compressor = zlib.compressobj(compresslevel, zlib.DEFLATED,
+                                           -zlib.MAX_WBITS, zlib.DEF_MEM_LEVEL,
+                                           0)
+        if state is None:
+            self.crc = zlib.crc32('') & 0xffffffffL
+            self.size = 0
+            # Magic, deflate method, no flags, mtime, maximum compression, unknown OS
+            self.fileobj.write('\037\213\010\000' +
+                               struct.pack('<L', long(time.time())) +
+                               '\002\377')
+        else:
+            self.crc = state['crc']
+            self.size = state['size']
+
+    def write(self, data):
+        self.crc = zlib.crc32(data, self.crc) & 0xffffffffL
+        self.size += len(data)
+        self.fileobj.write(self.compressor.compress(data))
+
+    def tell(self):
+        return self.size
+
+    def flush_checkpoint(self):
+        self.fileobj.write(self.compressor.flush(zlib.Z_FULL_FLUSH))
+        return {'crc': self.crc, 'size': self.size}
+
+    def close(self):
+        self.fileobj.write(self.compressor.flush())
+        self.fileobj.write(struct.pack('<LL', self.crc,
+                                       self.size & 0xffffffffL))
+
+
+class _ChecksumTarFile(tarfile.TarFile):
+    """
+    TarFile which computes the sha256 checksum of each file added to it,
+    while reading it to put it in the archive
+
+    Sparse files are added as GNU sparse members: only their data regions
+    are read and stored. Hardlinks are stored once for the whole archive by TarFile.
+    """
+
+    def __init__(self, *args, **kwargs):
+        tarfile.TarFile.__init__(self, *args, **kwargs)
+        self.checksums = {}
+        # Number of members added (or skipped) since it was last reset, i.e.
+        # in the current row of the CSV
+        self.row_members = 0
+        # Members already in a resumed archive, see skip_members()
+        self._skip_count = 0
+        self._skip_last_name = None
+        self._skip_mismatch = False
+        # Called with (tar, tarinfo) after each member added
+        self.member_callback = None
+        # _BandwidthLimiter for the files read
+        self.limiter = None
+
+    def add(self, name, arcname=None, recursive=True):
+        """
+        Add a file, and the content of a directory sorted by name, so that
+        the members of a resumed archive come in the same order as in the
+        interrupted one (os.listdir() order is arbitrary)
+        """
+        if arcname is None:
+            arcname = name
+        tarfile.TarFile.add(self, name, arcname, recursive=False)
+
+        if recursive and os.path.isdir(name) and not os.path.islink(name):
+            for f in sorted(os.listdir(name)):
+                self.add(os.path.join(name, f), os.path.join(arcname, f))
+
+    def skip_members(self, count, last_name):
+        """
+        Skip the next members, which are already in a resumed archive
+
+        Args:
+        count     -- (int) The number of members to skip
+        last_name -- (string) The name the last skipped member should have,
+                     to check that the files didn't change meanwhile
+        """
+        self._skip_count = count
+        self._skip_last_name = last_name
+        self._skip_mismatch = count == 0
+        # Files are registered for hardlinks even when skipped
+        self._inodes_before_skip = dict(self.inodes)
+
+    def end_skip(self):
+        """
+        Stop skipping members
+
+        Return:
+            (bool) Whether the skipped members were the expected ones. If not,
+                   some of the members which should have been skipped may
+                   have been missed, and they should be added again.
+        """
+        matched = self._skip_count == 0 and not self._skip_mismatch
+        if not matched:
+            # Otherwise the files added again would be hardlinks to themselves
+            self.inodes = self._inodes_before_skip
+        self._skip_count = 0
+        self._skip_mismatch = False
+        return matched
+
+    def addfile(self, tarinfo, fileobj=None):
+        self.row_members += 1
+        if self._skip_count > 0:
+            self._skip_count -= 1
+            if self._skip_count == 0 and tarinfo.name != self._skip_last_name:
+                self._skip_mismatch = True
+            return
+        sparse = False
+        if fileobj is not None and tarinfo.isreg():
+            fileobj = _ChecksumFile(fileobj, self.limiter)
+            data_regions = _get_data_regions(fileobj.fileobj, tarinfo.size)
+            if data_regions is not None:
+                self._addfile_sparse(tarinfo, fileobj, data_regions)
+                sparse = True
+        if not sparse:
+            tarfile.TarFile.addfile(self, tarinfo, fileobj)
+        if isinstance(fileobj, _ChecksumFile):
+            self.checksums[tarinfo.name] = fileobj.hexdigest()
+        if self.member_callback is not None:
+            self.member_callback(self, tarinfo)
+
+    def _addfile_sparse(self, tarinfo, fileobj, data_regions):
+        """
+        Add a sparse file as a GNU sparse member (the old GNU format, which
+        python 2 can read)
+
+        The (offset, size) of the data regions are stored in the header, and
+        in extension blocks if there are more than 4 regions. The data of the
+        member is the concatenation of the data regions.
+
+        Args:
+        tarinfo      -- (TarInfo) The member, as returned by gettarinfo()
+        fileobj      -- (_ChecksumFile) The file opened for reading
+        data_regions -- (list) The (offset, size) data regions of the file
+        """
+        def sparse_entries(regions, count):
+            entries = ''.join(tarfile.itn(offset, 12, tarfile.GNU_FORMAT) +
+                              tarfile.itn(size, 12, tarfile.GNU_FORMAT)
+                              for offset, size in regions[:count])
+            return entries.ljust(count * 24, tarfile.NUL)
+
+        # As GNU tar does, end the map with an empty region at the end of the
+        # file, otherwise a trailing hole would be lost on extraction
+        data_regions = data_regions + [(tarinfo.size, 0)]
+
+        # The sparse fields are in the "prefix" field of the GNU header:
+        # atime, ctime, offset, longnames, unused, 4 entries, isextended and
+        # realsize
+        regions = data_regions[4:]
+        info = tarinfo.get_info(self.encoding, self.errors)
+        info['type'] = tarfile.GNUTYPE_SPARSE
+        info['size'] = sum(size for _, size in data_regions)
+        info['prefix'] = (tarfile.NUL * 41 +
+                          sparse_entries(data_regions, 4) +
+                          ('\001' if regions else tarfile.NUL) +
+                          tarfile.itn(tarinfo.size, 12, tarfile.GNU_FORMAT))
+        buf = tarinfo.create_gnu_header(info)
+
+        # Extension blocks of 21 entries
+        while regions:
+            buf += sparse_entries(regions, 21)
+            regions = regions[21:]
+            buf += ('\001' if regions else tarfile.NUL).ljust(8, tarfile.NUL)
+
+        self.fileobj.write(buf)
+        self.offset += len(buf)
+
+        # Read the data regions, the holes are only added to the checksum
+        position = 0
+        zeros = tarfile.NUL * (1024 * 1024)
+        for offset, size in data_regions:
+            while position < offset:
+                length = min(offset - position, len(zeros))
+                fileobj.checksum.update(zeros[:length])
+                position += length
+            fileobj.fileobj.seek(offset)
+            tarfile.copyfileobj(fileobj, self.fileobj, size)
+            position += size
+
+        blocks, remainder = divmod(info['size'], tarfile.BLOCKSIZE)
+        if remainder > 0:
+            self.fileobj.write(tarfile.NUL * (tarfile.BLOCKSIZE - remainder))
+            blocks += 1
+        self.offset += blocks * tarfile.BLOCKSIZE
+        self.members.append(tarinfo)
+
+    def add_checksums(self):
+        """ Add the checksums of the files as the last file of the archive """
+        data = json.dumps({'algorithm': 'sha256', 'files': self.checksums})
+        tarinfo = tarfile.TarInfo(CHECKSUMS_FILE)
+        tarinfo.size = len(data)
+        tarinfo.mtime = time.time()
+        tarfile.TarFile.addfile(self, tarinfo, StringIO(data))
+
+
+def _get_data_regions(fileobj, size):
+    """
+    Find the data regions of a sparse file with SEEK_DATA and SEEK_HOLE
+
+    Args:
+    fileobj -- (file) The file opened for reading
+    size    -- (int) The size of the file
+
+    Return:
+        (list|None) The (offset, size) data regions of the file, or None if
+                    the file isn't sparse or the filesystem can't tell
+    """
+    try:
+        fd = fileobj.fileno()
+        # Files without holes use at least as many blocks as their size
+        if os.fstat(fd).st_blocks * 512 >= size:
+            return None
+    except (AttributeError, EnvironmentError):
+        return None
+
+    data_regions = []
+    offset = 0
+    try:
+        while offset < size:
+            try:
+                data = os.lseek(fd, offset, SEEK_DATA)
+            except OSError as e:
+                # No data after this offset
+                if e.errno == errno.ENXIO:
+                    break
+                raise
+            hole = min(os.lseek(fd, data, SEEK_HOLE), size)
+            if hole > data:
+                data_regions.append((data, hole - data))
+            offset = hole
+    except OSError:
+        return None
+    finally:
+        os.lseek(fd, 0, os.SEEK_SET)
+
+    if data_regions == [(0, size)]:
+        return None
+    return data_regions
+
+
+def _byteify(data):
+    """ Convert the unicode strings loaded from JSON into utf-8 strings """
+    if isinstance(data, dict):
+        return dict((_byteify(key), _byteify(value))
+                    for key, value in data.items())
+    elif isinstance(data, list):
+        return [_byteify(value) for value in data]
+    elif isinstance(data, unicode):
+        return data.encode('utf-8')
+    return data
+
+
+def _call_for_each_path(self, callback, csv_path=None):
+    """ Call a callback for each path in csv """
+    if csv_path is None:
+        csv_path = self.csv_path
+    with open(csv_path, "r") as backup_file:
+        backup_csv = csv.DictReader(backup_file, fieldnames=['source', 'dest'])
         for row in backup_csv:
             callback(self, row['source'], row['dest'])
 
 
+class _BackupCsvPaths(object):
+    """
+    The paths to backup listed in a backup.csv file
+
+    The file is read again at each iteration, so that the paths don't need to
+    be kept in memory. Backup methods only iterate over the paths in order.
+    """
+
+    def __init__(self, csv_path):
+        self.csv_path = csv_path
+
+    def __iter__(self):
+        with open(self.csv_path, 'r') as csv_file:
+            for row in csv.reader(csv_file):
+                if row:
+                    yield BackupPath(row[0], row[1])
+
+
+class _TargetTrie(object):
+    """
+    Prefix tree of the archive directories of apps and system parts
+
+    It finds the app or system part a path of the archive belongs to in
+    O(path length), instead of comparing the path with each target. Paths
+    are compared by components, and the deepest matching target is used.
+    """
+
+    def __init__(self, apps=[], system_parts=[]):
+        self._root = {}
+        for app in apps:
+            self._insert('apps/' + app, ('apps', app))
+        for part in system_parts:
+            path = part.replace('_', '/')
+            if path.split('/')[0] in ('conf', 'data'):
+                self._insert(path, ('system', part))
+
+    def _insert(self, path, target):
+        node = self._root
+        for component in path.split('/'):
+            node = node.setdefault(component, {})
+        # None can't be a path component, so it is used as the target key
+        node[None] = target
+
+    def lookup(self, path):
+        """
+        Return the target of a path as a (category, name) tuple, or None if
+        the path belongs to no app nor system part
+        """
+        target = None
+        node = self._root
+        for component in path.strip('/').split('/'):
+            node = node.get(component)
+            if node is None:
+                break
+            target = node.get(None, target)
+        return target
+
+
+def _match_prefixes(path, prefixes):
+    """ Return True if the path is one of the prefixes or is inside of one """
+    for prefix in prefixes:
+        if path == prefix or path.startswith(prefix + '/'):
+            return True
+    return False
+
+
+def _extract_tar_stream(tar, path, prefixes):
+    """
+    Extract the members of an archive opened as a stream which are in some
+    prefixes
+
+    The reading stops as soon as the last path related to the prefixes has
+    been extracted, according to the backup.csv file at the beginning of the
+    archive.
+
+    A hardlink can't be extracted from a stream if its target hasn't been
+    extracted: tarfile would then load the whole archive to find it, and
+    could not read any other member afterwards. Such hardlinks are returned
+    to be extracted by _extract_link_targets().
+
+    Args:
+    tar      -- (TarFile) The archive, opened in "r|" mode
+    path     -- (string) The directory where to extract the members
+    prefixes -- (list) The paths inside the archive to extract
+
+    Return:
+        (dict) The hardlinks which haven't been extracted, as lists of
+               TarInfo by name of their target
+    """
+    layout = None
+    directories = []
+    extracted = set()
+    links = {}
+
+    for tarinfo in tar:
+        name = tarinfo.name
+
+        if name == 'backup.csv' and layout is None:
+            tar.extract(tarinfo, path=path)
+            layout = _ArchiveLayout(os.path.join(path, 'backup.csv'), prefixes)
+            continue
+
+        if layout is None:
+            # Old backup archives have no backup.csv file, or not at the
+            # beginning, so they are read until the end
+            layout = _ArchiveLayout(None, prefixes)
+
+        if layout.is_after_last_wanted_path(name):
+            logger.debug("no more files to extract, stop reading '%s'",
+                         tar.name)
+            break
+
+        if name != 'info.json' and not _match_prefixes(name, prefixes):
+            continue
+
+        if tarinfo.islnk() and tarinfo.linkname not in extracted:
+            links.setdefault(tarinfo.linkname, []).append(tarinfo)
+            continue
+
+        # Directories permissions are set at the end, like extractall does,
+        # to be able to extract read-only ones
+        if tarinfo.isdir():
+            directories.append(tarinfo)
+            tarinfo = copy.copy(tarinfo)
+            tarinfo.mode = 0700
+
+        tar.extract(tarinfo, path=path)
+        extracted.add(name)
+
+    directories.sort(key=lambda d: d.name, reverse=True)
+    for tarinfo in directories:
+        dirpath = os.path.join(path, tarinfo.name)
+        tar.chown(tarinfo, dirpath)
+        tar.utime(tarinfo, dirpath)
+        tar.chmod(tarinfo, dirpath)
+
+    return links
+
+
+def _extract_link_targets(tar, path, links):
+    """
+    Extract hardlinks whose target hasn't been extracted, by reading the
+    archive as a stream again until the last of their targets
+
+    The data of a target is extracted to the first of its hardlinks, the
+    other ones are linked to it.
+
+    Args:
+    tar   -- (TarFile) The archive, opened in "r|" mode
+    path  -- (string) The directory where to extract the hardlinks
+    links -- (dict) The hardlinks as returned by _extract_tar_stream()
+    """
+    links = dict(links)
+    for tarinfo in tar:
+        if not links:
+            break
+        if tarinfo.name not in links:
+            continue
+
+        first = links.pop(tarinfo.name)
+        member = copy.copy(tarinfo)
+        member.name = first[0].name
+        tar.extract(member, path=path)
+
+        for link in first[1:]:
+            link_path = os.path.join(path, link.name)
+            if os.path.lexists(link_path):
+                os.remove(link_path)
+            os.link(os.path.join(path, member.name), link_path)
+
+    for target in links:
+        logger.warning("unable to find '%s' in the archive '%s'", target,
+                       tar.name)
+
+
+class _ArchiveLayout(object):
+    """
+    Order of the paths inside an archive, read from its backup.csv file
+
+    Archives contain the paths listed in backup.csv, in the same order. This
+    allows to know, while reading an archive sequentially, when all the
+    paths needed by a restore have been read.
+    """
+
+    def __init__(self, csv_path, prefixes):
+        self.dests = []
+        self.last_wanted = -1
+        self.current = 0
+
+        if csv_path is None or not os.path.isfile(csv_path):
+            return
+
+        with open(csv_path) as csv_file:
+            for row in csv.DictReader(csv_file, fieldnames=['source', 'dest']):
+                self.dests.append(row['dest'].strip('/'))
+
+        for index, dest in enumerate(self.dests):
+            # A row is wanted if it contains a wanted path or is inside of one
+            if _match_prefixes(dest, prefixes) or \
+                    any(_match_prefixes(prefix, [dest]) for prefix in prefixes):
+                self.last_wanted = index
+
+    def is_after_last_wanted_path(self, path):
+        """
+        Return True if the path comes from a row after the last wanted one.
+
+        The rows are followed in order; if a path matches no row from the
+        current one, the layout is not the expected one and False is always
+        returned from then on.
+        """
+        if self.last_wanted < 0:
+            return False
+
+        for index in range(self.current, len(self.dests)):
+            if _match_prefixes(path, [self.dests[index]]):
+                self.current = index
+                return index > self.last_wanted
+
+        self.last_wanted = -1
+        return False
+
+
+def _set_backup_priority():
+    """
+    Lower the CPU and I/O priorities of the current process according to the
+    "backup.throttle.*" settings. Threads and scripts started afterwards
+    inherit them.
+
+    Return:
+        (tuple|None) The previous niceness and I/O priority, to give to
+                     _restore_priority()
+    """
+    nice = min(max(settings_get('backup.throttle.nice'), 0), 19)
+    ionice_class = settings_get('backup.throttle.ionice_class')
+    process = psutil.Process()
+
+    try:
+        previous = (process.nice(), process.ionice())
+        if nice > previous[0]:
+            process.nice(nice)
+        if ionice_class == 'best-effort':
+            process.ionice(psutil.IOPRIO_CLASS_BE, 7)
+        elif ionice_class == 'idle':
+            process.ionice(psutil.IOPRIO_CLASS_IDLE)
+    except (psutil.Error, EnvironmentError, ValueError):
+        logger.warning(m18n.n('backup_priority_change_failed'), exc_info=1)
+        return None
+
+    return previous
+
+
+def _restore_priority(previous):
+    """
+    Restore the CPU and I/O priorities of the current process
+
+    Args:
+    previous -- (tuple|None) The priorities returned by _set_backup_priority()
+    """
+    if previous is None:
+        return
+
+    nice, ionice = previous
+    process = psutil.Process()
+
+    try:
+        process.nice(nice)
+        if ionice.ioclass == psutil.IOPRIO_CLASS_NONE:
+            process.ionice(psutil.IOPRIO_CLASS_NONE)
+        else:
+            process.ionice(ionice.ioclass, ionice.value)
+    except (psutil.Error, EnvironmentError, ValueError):
+        logger.warning(m18n.n('backup_priority_change_failed'), exc_info=1)
+
+
+def _estimate_sizes(path):
+    """
+    Compute the size of a path, and estimate its size once compressed in the
+    archive by compressing a few samples of its files
+
+    Args:
+    path -- (string) Path of a file or a directory
+
+    Return:
+        (tuple) The size and the estimated compressed size, in bytes
+    """
+    size, samples = _read_samples(path)
+
+    # Compression ratio of the samples, weighted by the size of their file
+    total_weight = 0
+    weighted_ratio = 0.0
+    for sample, weight in samples:
+        if sample:
+            total_weight += weight
+            weighted_ratio += weight * \
+                float(len(zlib.compress(sample, 6))) / len(sample)
+
+    if total_weight == 0:
+        return size, size
+    return size, int(size * weighted_ratio / total_weight)
+
+
+def _read_samples(path, count=COMPRESSION_SAMPLES):
+    """
+    Compute the size of a path like `du -sb` does, and read up to count
+    samples of COMPRESSION_SAMPLE_SIZE bytes from its files in the same walk
+
+    Samples of a single file are evenly spread over it. In a directory, the
+    largest files are sampled, as they weigh the most in the archive, and
+    files picked at random among the other ones represent the rest.
+
+    Return:
+        (tuple) The size of the path in bytes, and a list of tuples of a
+                sample and its weight (the number of bytes it represents)
+    """
+    samples = []
+    try:
+        path_stat = os.lstat(path)
+    except OSError:
+        logger.debug("unable to read samples from '%s'", path, exc_info=1)
+        return 0, samples
+
+    size = path_stat.st_size
+    if S_ISREG(path_stat.st_mode):
+        step = max(size - COMPRESSION_SAMPLE_SIZE, 0) / max(count - 1, 1)
+        try:
+            with open(path, 'rb') as f:
+                for i in range(count):
+                    f.seek(i * step)
+                    samples.append((f.read(COMPRESSION_SAMPLE_SIZE), 1))
+                    if step == 0:
+                        break
+        except IOError:
+            logger.debug("unable to read samples from '%s'", path,
+                         exc_info=1)
+        return size, samples
+    elif not S_ISDIR(path_stat.st_mode):
+        return size, samples
+
+    def _walk_error(e):
+        logger.debug("unable to list '%s': %s", e.filename, e)
+
+    # Keep the largest files, and a uniform random sample of the files
+    # (reservoir sampling) in the walk which computes the size. The files
+    # which can't be read, e.g. removed during the walk, are skipped.
+    largest = []
+    picked = []
+    files_size = 0
+    files_count = 0
+    hardlinks = set()
+    for root, dirs, files in os.walk(path, onerror=_walk_error):
+        for name in dirs + files:
+            file_path = os.path.join(root, name)
+            try:
+                file_stat = os.lstat(file_path)
+            except OSError:
+                logger.debug("unable to stat '%s'", file_path, exc_info=1)
+                continue
+            if file_stat.st_nlink > 1 and not S_ISDIR(file_stat.st_mode):
+                # Hard links are stored once in the archive
+                inode = (file_stat.st_dev, file_stat.st_ino)
+                if inode in hardlinks:
+                    continue
+                hardlinks.add(inode)
+            size += file_stat.st_size
+            if not S_ISREG(file_stat.st_mode):
+                continue
+            entry = (file_stat.st_size, file_path)
+            files_size += file_stat.st_size
+            files_count += 1
+
+            heapq.heappush(largest, entry)
+            if len(largest) > count / 2:
+                heapq.heappop(largest)
+
+            if len(picked) < count / 2:
+                picked.append(entry)
+            else:
+                i = random.randrange(files_count)
+                if i < len(picked):
+                    picked[i] = entry
+
+    picked = [entry for entry in picked if entry not in largest]
+    others_size = files_size - sum(s for s, _ in largest)
+
+    for file_size, file_path in largest + picked:
+        try:
+            with open(file_path, 'rb') as f:
+                f.seek(max(file_size - COMPRESSION_SAMPLE_SIZE, 0) / 2)
+                sample = f.read(COMPRESSION_SAMPLE_SIZE)
+        except IOError:
+            logger.debug("unable to read a sample of '%s'", file_path,
+                         exc_info=1)
+            continue
+        if (file_size, file_path) in largest:
+            samples.append((sample, file_size))
+        else:
+            samples.append((sample, float(others_size) / len(picked)))
+
+    return size, samples
+
+
+def _dumps_size(directory):
+    """
+    Estimate the space needed to load the database dumps of a directory into
+    the databases, in bytes
+
+    Only the rows of a dump take space once loaded: the share of rows in each
+    dump is estimated from samples of it, and weighted by the storage overhead
+    of the databases (indexes, page and row headers).
+    """
+    size = 0
+    for root, dirs, files in os.walk(directory):
+        for f in files:
+            if f.endswith(DB_DUMP_EXTENSIONS):
+                size += _dump_loaded_size(os.path.join(root, f))
+    return size
+
+
+def _dump_loaded_size(path):
+    """
+    Estimate the space needed to load a database dump, in bytes, from the
+    share of rows in samples of it
+    """
+    dump_size, samples = _read_samples(path, DB_DUMP_SAMPLES)
+    if not samples:
+        return 0
+
+    rows_bytes = 0
+    sampled_bytes = 0
+    for sample, _ in samples:
+        lines = sample.split('\n')
+        if len(lines) == 1:
+            # Only a long line (e.g. an extended INSERT) goes through a
+            # whole sample
+            rows_bytes += len(sample)
+            sampled_bytes += len(sample)
+            continue
+        # The first and last lines are cut, and can't be classified
+        for line in lines[1:-1]:
+            sampled_bytes += len(line) + 1
+            if line.strip() and \
+                    not line.lstrip().upper().startswith(
+                        DB_DUMP_SCHEMA_PREFIXES):
+                rows_bytes += len(line) + 1
+
+    if sampled_bytes == 0:
+        return dump_size * DB_STORAGE_OVERHEAD
+    return int(dump_size * DB_STORAGE_OVERHEAD *
+               float(rows_bytes) / sampled_bytes)
+
+
 def free_space_in_directory(dirpath):
     stat = os.statvfs(dirpath)
     return stat.f_frsize * stat.f_bavail
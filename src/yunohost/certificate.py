@@ -24,6 +24,10 @@
 
 import os
 import sys
+import json
+import fcntl
+import binascii
+import time
 import errno
 import shutil
 import pwd
@@ -32,8 +36,13 @@ import smtplib
 import subprocess
 import dns.resolver
 import glob
+import threading
+import traceback
 
+from contextlib import contextmanager
 from datetime import datetime
+from multiprocessing import cpu_count
+from multiprocessing.pool import ThreadPool
 
 from yunohost.vendor.acme_tiny.acme_tiny import get_crt as sign_certificate
 
@@ -46,9 +55,18 @@ from moulinette import m18n
 from yunohost.app import app_ssowatconf
 from yunohost.service import _run_service_command, service_regen_conf
 from yunohost.log import OperationLogger
+from yunohost.settings import settings_get
 
 logger = getActionLogger('yunohost.certmanager')
 
+# Held while reading or updating the log of the ACME orders, which may be
+# placed concurrently, along with a flock for the other processes, see
+# _lock_acme_orders()
+_acme_orders_lock = threading.Lock()
+
+# Process filling the key pool in background, see _fill_key_pool_in_background()
+_key_pool_filler = None
+
 CERT_FOLDER = "/etc/yunohost/certs/"
 TMP_FOLDER = "/tmp/acme-challenge-private/"
 WEBROOT_FOLDER = "/tmp/acme-challenge-public/"
@@ -59,9 +77,44 @@ ACCOUNT_KEY_FILE = "/etc/yunohost/letsencrypt_account.pem"
 SSL_DIR = '/usr/share/yunohost/yunohost-config/ssl/yunoCA'
 
 KEY_SIZE = 3072
+KEY_CURVE = "prime256v1"  # ECDSA P-256
+
+# Private keys generated in advance, by key type. It is kept out of
+# CERT_FOLDER, which is backed up.
+KEY_POOL_FOLDER = "/var/lib/yunohost/key_pool/"
+KEY_POOL_LOG = "/var/log/yunohost/key_pool.log"
 
 VALIDITY_LIMIT = 15  # days
 
+ACME_ELIGIBILITY_CACHE = "/var/cache/yunohost/certificate/acme_eligibility.json"
+CERT_METADATA_CACHE = "/var/cache/yunohost/certificate/metadata.json"
+ACME_ELIGIBILITY_TTL = 600  # seconds
+ACME_CHECKS_POOL_SIZE = 8
+
+ACME_ORDERS_LOG = "/var/cache/yunohost/certificate/acme_orders.json"
+
+# Maximum number of domains in a SAN certificate
+ACME_MAX_NAMES_PER_CERTIFICATE = 100
+
+# Public suffixes of two labels, under which each domain is a registered
+# domain of its own for the rate limits: the YunoHost DynDNS domains and the
+# most common second-level country domains
+ACME_PUBLIC_SUFFIXES = (
+    "nohost.me", "noho.st",
+    "co.uk", "org.uk", "me.uk", "ac.uk", "com.au", "net.au", "org.au",
+    "co.nz", "co.jp", "co.za", "com.br", "com.cn", "co.in",
+)
+
+# Let's Encrypt rate limits as (number of orders, period in seconds), see
+# https://letsencrypt.org/docs/rate-limits/ . No more order is attempted for
+# an hour once the certification authority refused one for hitting a limit.
+ACME_RATE_LIMITS = {
+    "certificates per registered domain": (50, 7 * 24 * 3600),
+    "duplicate certificate": (5, 7 * 24 * 3600),
+    "failed validation": (5, 3600),
+    "previous rate limit": (1, 3600),
+}
+
 # For tests
 STAGING_CERTIFICATION_AUTHORITY = "https://acme-staging.api.letsencrypt.org"
 # For prod
@@ -111,13 +164,15 @@ def certificate_status(auth, domain_list, full=False):
 
     certificates = {}
 
+    # Eligibility for ACME is only shown in full
+    statuses = _get_statuses(domain_list, check_acme=full)
+
     for domain in domain_list:
-        status = _get_status(domain)
+        status = statuses[domain]
 
         if not full:
             del status["subject"]
             del status["CA_name"]
-            del status["ACME_eligible"]
             status["CA_type"] = status["CA_type"]["verbose"]
             status["summary"] = status["summary"]["verbose"]
 
@@ -169,7 +224,7 @@ def _certificate_install_selfsigned(domain_list, force=False):
         # Check we ain't trying to overwrite a good cert !
         current_cert_file = os.path.join(CERT_FOLDER, domain, "crt.pem")
         if not force and os.path.isfile(current_cert_file):
-            status = _get_status(domain)
+            status = _get_status(domain, check_acme=False)
 
             if status["summary"]["code"] in ('good', 'great'):
                 raise MoulinetteError(errno.EINVAL, m18n.n(
@@ -186,10 +241,13 @@ def _certificate_install_selfsigned(domain_list, force=False):
             for line in template:
                 f.write(line.replace("yunohost.org", domain))
 
+        # Generate the key, possibly taken from the key pool
+        _generate_key(key_file, settings_get("certificate.key.type"))
+
         # Use OpenSSL command line to create a certificate signing request,
         # and self-sign the cert
         commands = [
-            "openssl req -new -config %s -days 3650 -out %s -keyout %s -nodes -batch"
+            "openssl req -new -config %s -days 3650 -out %s -key %s -batch"
             % (conf_file, csr_file, key_file),
             "openssl ca -config %s -days 3650 -in %s -out %s -batch"
             % (conf_file, csr_file, crt_file),
@@ -228,7 +286,7 @@ def _certificate_install_selfsigned(domain_list, force=False):
         _enable_certificate(domain, new_cert_folder)
 
         # Check new status indicate a recently created self-signed certificate
-        status = _get_status(domain)
+        status = _get_status(domain, check_acme=False)
 
         if status and status["CA_type"]["code"] == "self-signed" and status["validity"] > 3648:
             logger.success(
@@ -251,7 +309,7 @@ def _certificate_install_letsencrypt(auth, domain_list, force=False, no_checks=F
     if domain_list == []:
         for domain in yunohost.domain.domain_list(auth)['domains']:
 
-            status = _get_status(domain)
+            status = _get_status(domain, check_acme=False)
             if status["CA_type"]["code"] != "self-signed":
                 continue
 
@@ -266,7 +324,7 @@ def _certificate_install_letsencrypt(auth, domain_list, force=False, no_checks=F
                     'certmanager_domain_unknown', domain=domain))
 
             # Is it self-signed?
-            status = _get_status(domain)
+            status = _get_status(domain, check_acme=False)
             if not force and status["CA_type"]["code"] != "self-signed":
                 raise MoulinetteError(errno.EINVAL, m18n.n(
                     'certmanager_domain_cert_not_selfsigned', domain=domain))
@@ -275,6 +333,9 @@ def _certificate_install_letsencrypt(auth, domain_list, force=False, no_checks=F
         logger.warning(
             "Please note that you used the --staging option, and that no new certificate will actually be enabled !")
 
+    # The public IP is the same for all the domains
+    public_ip = get_public_ip() if not no_checks and domain_list else None
+
     # Actual install steps
     for domain in domain_list:
 
@@ -286,12 +347,13 @@ def _certificate_install_letsencrypt(auth, domain_list, force=False, no_checks=F
 
         try:
             if not no_checks:
-                _check_domain_is_ready_for_ACME(domain)
+                _check_domain_is_ready_for_ACME(domain, public_ip)
 
             operation_logger.start()
 
             _configure_for_acme_challenge(auth, domain)
-            _fetch_and_enable_new_certificate(domain, staging, no_checks=no_checks)
+            _fetch_and_enable_new_certificate(domain, staging, no_checks=no_checks,
+                                              key_type=settings_get("certificate.key.type"))
             _install_cron()
 
             logger.success(
@@ -324,7 +386,7 @@ def certificate_renew(auth, domain_list, force=False, no_checks=False, email=Fal
         for domain in yunohost.domain.domain_list(auth)['domains']:
 
             # Does it have a Let's Encrypt cert?
-            status = _get_status(domain)
+            status = _get_status(domain, check_acme=False)
             if status["CA_type"]["code"] != "lets-encrypt":
                 continue
 
@@ -352,7 +414,7 @@ def certificate_renew(auth, domain_list, force=False, no_checks=False, email=Fal
                 raise MoulinetteError(errno.EINVAL, m18n.n(
                     'certmanager_domain_unknown', domain=domain))
 
-            status = _get_status(domain)
+            status = _get_status(domain, check_acme=False)
 
             # Does it expire soon?
             if status["validity"] > VALIDITY_LIMIT and not force:
@@ -374,42 +436,9 @@ def certificate_renew(auth, domain_list, force=False, no_checks=False, email=Fal
             "Please note that you used the --staging option, and that no new certificate will actually be enabled !")
 
     # Actual renew steps
-    for domain in domain_list:
-
-        operation_logger = OperationLogger('letsencrypt_cert_renew', [('domain', domain)],
-                           args={'force': force, 'no_checks': no_checks,
-                                 'staging': staging, 'email': email})
-
-        logger.info(
-            "Now attempting renewing of certificate for domain %s !", domain)
-
-        try:
-            if not no_checks:
-                _check_domain_is_ready_for_ACME(domain)
-
-            operation_logger.start()
-
-            _fetch_and_enable_new_certificate(domain, staging, no_checks=no_checks)
-
-            logger.success(
-                m18n.n("certmanager_cert_renew_success", domain=domain))
-
-            operation_logger.success()
-
-        except Exception as e:
-            import traceback
-            from StringIO import StringIO
-            stack = StringIO()
-            traceback.print_exc(file=stack)
-            msg = "Certificate renewing for %s failed !" % (domain)
-            logger.error(msg)
-            operation_logger.error(msg)
-            logger.error(stack.getvalue())
-            logger.error(str(e))
-
-            if email:
-                logger.error("Sending email with details to root ...")
-                _email_renewing_failed(domain, e, stack.getvalue())
+    if domain_list:
+        _renew_certificates(domain_list, force=force, no_checks=no_checks,
+                            email=email, staging=staging)
 
 ###############################################################################
 #   Back-end stuff                                                            #
@@ -518,7 +547,271 @@ def _check_acme_challenge_configuration(domain):
         return True
 
 
-def _fetch_and_enable_new_certificate(domain, staging=False, no_checks=False):
+def _renew_certificates(domain_list, force=False, no_checks=False, email=False, staging=False):
+    """
+    Renew the Let's Encrypt certificates of several domains at once
+
+    The checks of the domains and the generation of their keys and CSR are
+    done in parallel, then the ACME orders are run concurrently according to
+    the "certificate.renew.parallel_jobs" setting, unless they would hit a
+    rate limit. The new certificates are enabled together so that the
+    services using them are restarted and reloaded only once. If the
+    "certificate.renew.group_subdomains" setting is enabled, the subdomains
+    are renewed in a SAN certificate along with their parent domain, and
+    each domain of a group is ordered on its own if the certificate request
+    of the group fails to be signed.
+
+    Keyword argument:
+        domain_list -- Domains for which to renew the certificates
+        force       -- Whether the validity threshold was ignored
+        no_checks   -- Disable the checks of the reachability of the domains
+        email       -- Emails root if some renewing failed
+        staging     -- Use the fake/staging certification authority
+    """
+    # Failures by domain, as (exception, traceback)
+    failures = {}
+
+    # Check the domains, the public IP being the same for all of them
+    if not no_checks:
+        public_ip = get_public_ip()
+        checks = _map_concurrently(
+            lambda domain: _check_domain_is_ready_for_ACME(domain, public_ip),
+            domain_list, ACME_CHECKS_POOL_SIZE)
+        for domain, (_, error) in zip(domain_list, checks):
+            if error is not None:
+                failures[domain] = error
+
+    remaining = [domain for domain in domain_list if domain not in failures]
+
+    checked = remaining
+    operation_logger = OperationLogger('letsencrypt_cert_renew',
+                                       [('domain', domain) for domain in checked],
+                                       args={'force': force, 'no_checks': no_checks,
+                                             'staging': staging, 'email': email})
+
+    if remaining:
+        operation_logger.start()
+
+        try:
+            _prepare_acme_folders()
+            intermediate_certificate = _fetch_intermediate_certificate()
+        except Exception as e:
+            error = (e, traceback.format_exc())
+            failures.update((domain, error) for domain in remaining)
+            remaining = []
+
+    # Group the domains in orders, the first domain of an order being the
+    # common name of its certificate
+    if settings_get("certificate.renew.group_subdomains"):
+        orders = _group_subdomains(remaining)
+    else:
+        orders = [[domain] for domain in remaining]
+
+    # Orders whose certificate request failed to be signed, as tuples of
+    # domains
+    unsigned = set()
+
+    def _fetch_certificate(order):
+        domains, (key_file, csr_file) = order
+        logger.info(
+            "Now attempting renewing of certificate for domain %s !", ", ".join(domains))
+
+        try:
+            signed_certificate = _sign_certificate_request(domains, csr_file,
+                                                           staging, no_checks)
+        except Exception:
+            unsigned.add(tuple(domains))
+            raise
+
+        return _save_certificate(domains[0], key_file, signed_certificate,
+                                 intermediate_certificate, staging)
+
+    def _run_orders(orders):
+        """
+        Prepare the keys and CSR of orders, then fetch their certificates
+
+        Generating keys is CPU bound while ACME orders mostly wait for the
+        certification authority, hence the different number of jobs. The
+        renewed certificates keep the type of their current key.
+
+        Returns:
+            A list of (domains, new certificate folder, error)
+        """
+        results = []
+        prepared = []
+        for domains, (files, error) in zip(orders, _map_concurrently(
+                lambda domains: _prepare_key_and_csr(domains, _get_key_type(domains[0])),
+                orders, cpu_count())):
+            if error is not None:
+                results.append((domains, None, error))
+            else:
+                prepared.append((domains, files))
+
+        fetched = _map_concurrently(_fetch_certificate, prepared,
+                                    settings_get("certificate.renew.parallel_jobs"))
+
+        for (domains, _), (new_cert_folder, error) in zip(prepared, fetched):
+            results.append((domains, new_cert_folder, error))
+
+        return results
+
+    results = _run_orders(orders)
+
+    # A single domain failing its validation makes the order of its whole
+    # group fail, so the domains of the groups which failed to be signed are
+    # ordered on their own. The other failures happen before the order or
+    # once the certificate is issued, and ordering again would only waste
+    # the rate limits.
+    def _split(result):
+        domains, _, error = result
+        return (error is not None and len(domains) > 1 and
+                tuple(domains) in unsigned)
+
+    retried = [[domain] for result in results if _split(result)
+               for domain in result[0]]
+    if retried:
+        logger.info("Retrying the failed groups of domains one by one: %s",
+                    ", ".join(domains[0] for domains in retried))
+        results = [result for result in results if not _split(result)]
+        results += _run_orders(retried)
+
+    new_cert_folders = {}
+    for domains, new_cert_folder, error in results:
+        for domain in domains:
+            if error is not None:
+                failures[domain] = error
+            else:
+                new_cert_folders[domain] = new_cert_folder
+
+    # Enable the new certificates
+    enabled = []
+    if not staging:
+        for domain in remaining:
+            if domain not in new_cert_folders:
+                continue
+            try:
+                _enable_certificate(domain, new_cert_folders[domain],
+                                    reload_services=False)
+            except Exception as e:
+                failures[domain] = (e, traceback.format_exc())
+            else:
+                enabled.append(domain)
+
+    if enabled:
+        try:
+            _reload_certificate_services(enabled)
+        except Exception as e:
+            error = (e, traceback.format_exc())
+            failures.update((domain, error) for domain in enabled)
+
+    # Check the status of the certificates is now good
+    for domain in enabled:
+        if domain in failures:
+            continue
+        try:
+            status_summary = _get_status(domain, check_acme=False)["summary"]
+            if status_summary["code"] != "great":
+                raise MoulinetteError(errno.EINVAL, m18n.n(
+                    'certmanager_certificate_fetching_or_enabling_failed', domain=domain))
+        except Exception as e:
+            failures[domain] = (e, traceback.format_exc())
+
+    for domain in domain_list:
+        if domain not in failures:
+            logger.success(
+                m18n.n("certmanager_cert_renew_success", domain=domain))
+            continue
+
+        e, stack = failures[domain]
+        logger.error("Certificate renewing for %s failed !" % (domain))
+        logger.error(stack)
+        logger.error(str(e))
+
+        if email:
+            logger.error("Sending email with details to root ...")
+            _email_renewing_failed(domain, e, stack)
+
+    failed = [domain for domain in checked if domain in failures]
+    if failed:
+        operation_logger.error(
+            "Certificate renewing for %s failed !" % ", ".join(failed))
+    else:
+        operation_logger.success()
+
+
+def _group_subdomains(domains):
+    """
+    Group the domains with their subdomains, the parent domain first, in
+    lists of at most ACME_MAX_NAMES_PER_CERTIFICATE domains
+    """
+    groups = []
+
+    # Parent domains have less labels than their subdomains
+    for domain in sorted(domains, key=lambda d: d.count(".")):
+        for group in groups:
+            if domain.endswith("." + group[0]) and \
+                    len(group) < ACME_MAX_NAMES_PER_CERTIFICATE:
+                group.append(domain)
+                break
+        else:
+            groups.append([domain])
+
+    return groups
+
+
+def _map_concurrently(function, items, jobs):
+    """
+    Call a function on each item from a pool of threads
+
+    Returns:
+        A list of (result, error) in the order of the items, error being
+        None or the raised exception with its traceback
+    """
+    def _call(item):
+        try:
+            return function(item), None
+        except Exception as e:
+            return None, (e, traceback.format_exc())
+
+    if not items:
+        return []
+
+    pool = ThreadPool(max(1, min(jobs, len(items))))
+    try:
+        return pool.map(_call, items)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def _fetch_and_enable_new_certificate(domain, staging=False, no_checks=False, key_type="rsa"):
+    _prepare_acme_folders()
+
+    domain_key_file, domain_csr_file = _prepare_key_and_csr([domain], key_type)
+
+    signed_certificate = _sign_certificate_request([domain], domain_csr_file,
+                                                   staging, no_checks)
+
+    intermediate_certificate = _fetch_intermediate_certificate()
+
+    new_cert_folder = _save_certificate(domain, domain_key_file,
+                                        signed_certificate,
+                                        intermediate_certificate, staging)
+
+    if staging:
+        return
+
+    _enable_certificate(domain, new_cert_folder)
+
+    # Check the status of the certificate is now good
+    status_summary = _get_status(domain, check_acme=False)["summary"]
+
+    if status_summary["code"] != "great":
+        raise MoulinetteError(errno.EINVAL, m18n.n(
+            'certmanager_certificate_fetching_or_enabling_failed', domain=domain))
+
+
+def _prepare_acme_folders():
     # Make sure tmp folder exists
     logger.debug("Making sure tmp folders exists...")
 
@@ -534,26 +827,35 @@ def _fetch_and_enable_new_certificate(domain, staging=False, no_checks=False):
     # Regen conf for dnsmasq if needed
     _regen_dnsmasq_if_needed()
 
+
+def _prepare_key_and_csr(domains, key_type="rsa"):
+    domain = domains[0]
+
     # Prepare certificate signing request
     logger.debug(
         "Prepare key and certificate signing request (CSR) for %s...", domain)
 
     domain_key_file = "%s/%s.pem" % (TMP_FOLDER, domain)
-    _generate_key(domain_key_file)
+    _generate_key(domain_key_file, key_type)
     _set_permissions(domain_key_file, "root", "ssl-cert", 0640)
 
-    _prepare_certificate_signing_request(domain, domain_key_file, TMP_FOLDER)
+    _prepare_certificate_signing_request(domain, domain_key_file, TMP_FOLDER,
+                                         alt_names=domains[1:])
+
+    return domain_key_file, "%s/%s.csr" % (TMP_FOLDER, domain)
 
+
+def _sign_certificate_request(domains, domain_csr_file, staging=False, no_checks=False):
     # Sign the certificate
     logger.debug("Now using ACME Tiny to sign the certificate...")
 
-    domain_csr_file = "%s/%s.csr" % (TMP_FOLDER, domain)
-
     if staging:
         certification_authority = STAGING_CERTIFICATION_AUTHORITY
     else:
         certification_authority = PRODUCTION_CERTIFICATION_AUTHORITY
 
+    order_id = _reserve_acme_order(domains, certification_authority)
+
     try:
         signed_certificate = sign_certificate(ACCOUNT_KEY_FILE,
                                               domain_csr_file,
@@ -563,26 +865,38 @@ def _fetch_and_enable_new_certificate(domain, staging=False, no_checks=False):
                                               CA=certification_authority)
     except ValueError as e:
         if "urn:acme:error:rateLimited" in str(e):
+            _record_acme_order(order_id, "rate-limited")
             raise MoulinetteError(errno.EINVAL, m18n.n(
-                'certmanager_hit_rate_limit', domain=domain))
+                'certmanager_hit_rate_limit', domain=", ".join(domains)))
         else:
+            _record_acme_order(order_id, "failed")
             logger.error(str(e))
-            _display_debug_information(domain)
+            for domain in domains:
+                _display_debug_information(domain)
             raise MoulinetteError(errno.EINVAL, m18n.n(
                 'certmanager_cert_signing_failed'))
 
     except Exception as e:
+        _record_acme_order(order_id, None)
         logger.error(str(e))
 
         raise MoulinetteError(errno.EINVAL, m18n.n(
             'certmanager_cert_signing_failed'))
 
+    _record_acme_order(order_id, "issued")
+
+    return signed_certificate
+
+
+def _fetch_intermediate_certificate():
     import requests # lazy loading this module for performance reasons
     try:
-        intermediate_certificate = requests.get(INTERMEDIATE_CERTIFICATE_URL, timeout=30).text
+        return requests.get(INTERMEDIATE_CERTIFICATE_URL, timeout=30).text
     except requests.exceptions.Timeout as e:
         raise MoulinetteError(errno.EINVAL, m18n.n('certmanager_couldnt_fetch_intermediate_cert'))
 
+
+def _save_certificate(domain, domain_key_file, signed_certificate, intermediate_certificate, staging=False):
     # Now save the key and signed certificate
     logger.debug("Saving the key and signed certificate...")
 
@@ -615,20 +929,10 @@ def _fetch_and_enable_new_certificate(domain, staging=False, no_checks=False):
 
     _set_permissions(domain_cert_file, "root", "ssl-cert", 0640)
 
-    if staging:
-        return
-
-    _enable_certificate(domain, new_cert_folder)
-
-    # Check the status of the certificate is now good
-    status_summary = _get_status(domain)["summary"]
-
-    if status_summary["code"] != "great":
-        raise MoulinetteError(errno.EINVAL, m18n.n(
-            'certmanager_certificate_fetching_or_enabling_failed', domain=domain))
+    return new_cert_folder
 
 
-def _prepare_certificate_signing_request(domain, key_file, output_folder):
+def _prepare_certificate_signing_request(domain, key_file, output_folder, alt_names=[]):
     from OpenSSL import crypto # lazy loading this module for performance reasons
     # Init a request
     csr = crypto.X509Req()
@@ -636,6 +940,12 @@ def _prepare_certificate_signing_request(domain, key_file, output_folder):
     # Set the domain
     csr.get_subject().CN = domain
 
+    # Set the other domains of a SAN certificate
+    if alt_names:
+        csr.add_extensions([crypto.X509Extension(
+            "subjectAltName", False,
+            ", ".join("DNS:%s" % name for name in [domain] + alt_names))])
+
     # Set the key
     with open(key_file, 'rt') as f:
         key = crypto.load_privatekey(crypto.FILETYPE_PEM, f.read())
@@ -653,7 +963,38 @@ def _prepare_certificate_signing_request(domain, key_file, output_folder):
         f.write(crypto.dump_certificate_request(crypto.FILETYPE_PEM, csr))
 
 
-def _get_status(domain):
+def _get_status(domain, check_acme=True):
+    return _get_statuses([domain], check_acme)[domain]
+
+
+def _get_statuses(domains, check_acme=True):
+    """
+    Get the status of the certificates of several domains
+
+    Keyword argument:
+        domains -- Domains of the certificates
+        check_acme -- Check whether the domains are ready for ACME, all at
+                      once, in "ACME_eligible"
+    """
+    metadata_cache = _get_json_cache(CERT_METADATA_CACHE)
+    cached_metadata = dict(metadata_cache)
+
+    statuses = dict((domain, _get_certificate_status(domain, metadata_cache))
+                    for domain in domains)
+
+    # Save the metadata of the certificates which have been parsed
+    if metadata_cache != cached_metadata:
+        _save_json_cache(CERT_METADATA_CACHE, metadata_cache)
+
+    if check_acme:
+        eligibility = _check_domains_are_ready_for_ACME(domains)
+        for domain, status in statuses.items():
+            status["ACME_eligible"] = eligibility[domain]
+
+    return statuses
+
+
+def _get_certificate_status(domain, metadata_cache):
 
     cert_file = os.path.join(CERT_FOLDER, domain, "crt.pem")
 
@@ -661,19 +1002,11 @@ def _get_status(domain):
         raise MoulinetteError(errno.EINVAL, m18n.n(
             'certmanager_no_cert_file', domain=domain, file=cert_file))
 
-    from OpenSSL import crypto # lazy loading this module for performance reasons
-    try:
-        cert = crypto.load_certificate(
-            crypto.FILETYPE_PEM, open(cert_file).read())
-    except Exception as exception:
-        import traceback
-        traceback.print_exc(file=sys.stdout)
-        raise MoulinetteError(errno.EINVAL, m18n.n(
-            'certmanager_cannot_read_cert', domain=domain, file=cert_file, reason=exception))
+    metadata = _get_certificate_metadata(domain, cert_file, metadata_cache)
 
-    cert_subject = cert.get_subject().CN
-    cert_issuer = cert.get_issuer().CN
-    valid_up_to = datetime.strptime(cert.get_notAfter(), "%Y%m%d%H%M%SZ")
+    cert_subject = metadata["subject"]
+    cert_issuer = metadata["issuer"]
+    valid_up_to = datetime.strptime(metadata["not_after"], "%Y%m%d%H%M%SZ")
     days_remaining = (valid_up_to - datetime.utcnow()).days
 
     if cert_issuer == _name_self_CA():
@@ -736,12 +1069,6 @@ def _get_status(domain):
             "verbose": "Unknown?",
         }
 
-    try:
-        _check_domain_is_ready_for_ACME(domain)
-        ACME_eligible = True
-    except:
-        ACME_eligible = False
-
     return {
         "domain": domain,
         "subject": cert_subject,
@@ -749,9 +1076,50 @@ def _get_status(domain):
         "CA_type": CA_type,
         "validity": days_remaining,
         "summary": status_summary,
-        "ACME_eligible": ACME_eligible
     }
 
+
+def _get_certificate_metadata(domain, cert_file, metadata_cache):
+    """
+    Get the subject, issuer and expiration date of a certificate
+
+    The certificate is only parsed - and OpenSSL loaded - if its file has
+    changed since its metadata was put in the cache, according to its
+    inode, modification time and size.
+
+    Keyword argument:
+        domain -- Domain of the certificate
+        cert_file -- Path of the certificate
+        metadata_cache -- Dict of the cached metadata by domain, updated
+                          with the parsed certificate
+    """
+    cert_stat = os.stat(cert_file)
+    file_key = [cert_stat.st_ino, cert_stat.st_mtime, cert_stat.st_size]
+
+    metadata = metadata_cache.get(domain)
+    if metadata and metadata["file_key"] == file_key:
+        return metadata
+
+    from OpenSSL import crypto # lazy loading this module for performance reasons
+    try:
+        cert = crypto.load_certificate(
+            crypto.FILETYPE_PEM, open(cert_file).read())
+    except Exception as exception:
+        import traceback
+        traceback.print_exc(file=sys.stdout)
+        raise MoulinetteError(errno.EINVAL, m18n.n(
+            'certmanager_cannot_read_cert', domain=domain, file=cert_file, reason=exception))
+
+    metadata = {
+        "file_key": file_key,
+        "subject": cert.get_subject().CN,
+        "issuer": cert.get_issuer().CN,
+        "not_after": cert.get_notAfter(),
+    }
+    metadata_cache[domain] = metadata
+
+    return metadata
+
 ###############################################################################
 #   Misc small stuff ...                                                      #
 ###############################################################################
@@ -763,13 +1131,165 @@ def _generate_account_key():
     _set_permissions(ACCOUNT_KEY_FILE, "root", "root", 0400)
 
 
-def _generate_key(destination_path):
+def _generate_key(destination_path, key_type="rsa"):
+    """
+    Generate a private key, taken from the key pool if it is enabled and
+    holds keys of the given type
+
+    Keyword argument:
+        destination_path -- Path of the key file to create
+        key_type -- Type of the key, 'rsa' or 'ecdsa'
+    """
+    key = None
+
+    if settings_get("certificate.key.pool_size") > 0:
+        key = _take_key_from_pool(key_type)
+        _fill_key_pool_in_background()
+
+    if key is None:
+        key = _generate_key_pem(key_type)
+
+    _write_private_key(destination_path, key)
+
+
+def _generate_key_pem(key_type="rsa"):
+    if key_type == "ecdsa":
+        # pyOpenSSL isn't able to generate EC keys
+        p = subprocess.Popen(["openssl", "ecparam", "-name", KEY_CURVE,
+                              "-genkey", "-noout"],
+                             stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        out, err = p.communicate()
+
+        if p.returncode != 0:
+            logger.warning(err)
+            raise MoulinetteError(errno.EIO, m18n.n(
+                'certmanager_key_generation_failed', type=key_type))
+
+        return out
+
     from OpenSSL import crypto # lazy loading this module for performance reasons
     k = crypto.PKey()
     k.generate_key(crypto.TYPE_RSA, KEY_SIZE)
 
-    with open(destination_path, "w") as f:
-        f.write(crypto.dump_privatekey(crypto.FILETYPE_PEM, k))
+    return crypto.dump_privatekey(crypto.FILETYPE_PEM, k)
+
+
+def _write_private_key(path, key):
+    # Create the file readable by root only, the caller setting the final
+    # permissions
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0600)
+    with os.fdopen(fd, "w") as f:
+        f.write(key)
+
+
+def _get_key_type(domain):
+    key_file = os.path.join(CERT_FOLDER, domain, "key.pem")
+
+    try:
+        with open(key_file) as f:
+            header = f.readline()
+    except IOError:
+        return settings_get("certificate.key.type")
+
+    # The EC keys are in the SEC 1 format while the RSA ones may be in the
+    # PKCS #1 or PKCS #8 formats
+    return "ecdsa" if "EC PRIVATE KEY" in header else "rsa"
+
+
+def _take_key_from_pool(key_type):
+    pool_folder = os.path.join(KEY_POOL_FOLDER, key_type)
+
+    try:
+        names = sorted(os.listdir(pool_folder))
+    except OSError:
+        return None
+
+    for name in names:
+        if not name.endswith(".pem"):
+            continue
+
+        # Renaming the key first ensures that no other process or thread
+        # takes it too
+        key_file = os.path.join(pool_folder, name)
+        taken_file = "%s.%d-%d" % (key_file, os.getpid(), threading.current_thread().ident)
+        try:
+            os.rename(key_file, taken_file)
+        except OSError:
+            continue
+
+        with open(taken_file) as f:
+            key = f.read()
+        os.remove(taken_file)
+
+        logger.debug("Taken the %s key %s from the key pool", key_type, name)
+        return key
+
+    return None
+
+
+def _fill_key_pool_in_background():
+    global _key_pool_filler
+
+    # One filler per process is enough since it fills the pool until it's full
+    if _key_pool_filler is not None and _key_pool_filler.poll() is None:
+        return
+
+    # The filler is this module run as an executable, which doesn't
+    # initialize moulinette, so it is given the settings as arguments
+    command = ["setsid", "nice", "-n", "19",
+               sys.executable, "-m", "yunohost.certificate",
+               settings_get("certificate.key.type"),
+               str(settings_get("certificate.key.pool_size")),
+               KEY_POOL_FOLDER]
+
+    # The yunohost package is installed out of the python path, in the
+    # directory moulinette.init() adds to it
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.pathsep.join(
+        [os.path.dirname(os.path.dirname(os.path.abspath(__file__)))] +
+        [p for p in [os.environ.get("PYTHONPATH")] if p])
+
+    if not os.path.isdir(os.path.dirname(KEY_POOL_LOG)):
+        os.makedirs(os.path.dirname(KEY_POOL_LOG))
+
+    with open(os.devnull, "w") as devnull, open(KEY_POOL_LOG, "a") as log:
+        _key_pool_filler = subprocess.Popen(command, stdout=devnull,
+                                            stderr=log, close_fds=True,
+                                            env=env)
+
+
+def _fill_key_pool(key_type, size, key_pool_folder):
+    """
+    Generate keys in the key pool until it holds size keys of a type
+
+    Keyword argument:
+        key_type -- Type of the keys, 'rsa' or 'ecdsa'
+        size -- Number of keys to keep in the pool
+        key_pool_folder -- Folder of the key pool, i.e. KEY_POOL_FOLDER
+    """
+    pool_folder = os.path.join(key_pool_folder, key_type)
+
+    if not os.path.isdir(pool_folder):
+        os.makedirs(pool_folder, 0700)
+
+    _set_permissions(key_pool_folder, "root", "root", 0700)
+    _set_permissions(pool_folder, "root", "root", 0700)
+
+    with open(os.path.join(key_pool_folder, ".lock"), "w") as lock:
+        # Let the pool be filled by another process if it is already
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError:
+            return
+
+        while len([name for name in os.listdir(pool_folder)
+                   if name.endswith(".pem")]) < size:
+            key_file = os.path.join(pool_folder, "%s.pem"
+                                    % binascii.hexlify(os.urandom(8)))
+
+            # Write the key aside, so that it is never taken partially written
+            _write_private_key(key_file + ".tmp", _generate_key_pem(key_type))
+            os.rename(key_file + ".tmp", key_file)
 
 
 def _set_permissions(path, user, group, permissions):
@@ -780,7 +1300,7 @@ def _set_permissions(path, user, group, permissions):
     os.chmod(path, permissions)
 
 
-def _enable_certificate(domain, new_cert_folder):
+def _enable_certificate(domain, new_cert_folder, reload_services=True):
     logger.debug("Enabling the certificate for domain %s ...", domain)
 
     live_link = os.path.join(CERT_FOLDER, domain)
@@ -798,6 +1318,11 @@ def _enable_certificate(domain, new_cert_folder):
 
     os.symlink(new_cert_folder, live_link)
 
+    if reload_services:
+        _reload_certificate_services([domain])
+
+
+def _reload_certificate_services(domains):
     logger.debug("Restarting services...")
 
     for service in ("postfix", "dovecot", "metronome"):
@@ -811,7 +1336,8 @@ def _enable_certificate(domain, new_cert_folder):
     _run_service_command("reload", "nginx")
 
     from yunohost.hook import hook_callback
-    hook_callback('post_cert_update', args=[domain])
+    for domain in domains:
+        hook_callback('post_cert_update', args=[domain])
 
 
 def _backup_current_cert(domain):
@@ -825,8 +1351,9 @@ def _backup_current_cert(domain):
     shutil.copytree(cert_folder_domain, backup_folder)
 
 
-def _check_domain_is_ready_for_ACME(domain):
-    public_ip = get_public_ip()
+def _check_domain_is_ready_for_ACME(domain, public_ip=None):
+    if public_ip is None:
+        public_ip = get_public_ip()
 
     # Check if IP from DNS matches public IP
     if not _dns_ip_match_public_ip(public_ip, domain):
@@ -839,6 +1366,195 @@ def _check_domain_is_ready_for_ACME(domain):
             'certmanager_domain_http_not_working', domain=domain))
 
 
+def _check_domains_are_ready_for_ACME(domains):
+    """
+    Check whether several domains are ready for ACME
+
+    The public IP is fetched once, then the DNS and HTTP checks of the
+    domains run concurrently in a bounded pool. Results are cached for
+    ACME_ELIGIBILITY_TTL seconds.
+
+    Returns:
+        A dict of booleans by domain
+    """
+    now = time.time()
+    cache = _get_json_cache(ACME_ELIGIBILITY_CACHE)
+
+    result = {}
+    for domain in domains:
+        cached = cache.get(domain)
+        if cached and 0 <= now - cached["checked_at"] < ACME_ELIGIBILITY_TTL:
+            result[domain] = cached["eligible"]
+
+    to_check = [domain for domain in domains if domain not in result]
+    if not to_check:
+        return result
+
+    public_ip = get_public_ip()
+
+    def _is_ready(domain):
+        try:
+            _check_domain_is_ready_for_ACME(domain, public_ip)
+        except Exception as e:
+            logger.debug("Domain '%s' is not ready for ACME: %s", domain, e)
+            return False
+        return True
+
+    pool = ThreadPool(min(ACME_CHECKS_POOL_SIZE, len(to_check)))
+    try:
+        checked = pool.map(_is_ready, to_check)
+    finally:
+        pool.close()
+        pool.join()
+
+    for domain, eligible in zip(to_check, checked):
+        result[domain] = eligible
+        cache[domain] = {"eligible": eligible, "checked_at": now}
+
+    _save_json_cache(ACME_ELIGIBILITY_CACHE, cache)
+
+    return result
+
+
+def _reserve_acme_order(domains, certification_authority):
+    """
+    Check that an order for a certificate of some domains doesn't hit a
+    rate limit of the certification authority, from the previous orders,
+    and reserve it in the log of the orders until its result is recorded
+    by _record_acme_order()
+
+    The check and the reservation are done at once, so that concurrent
+    orders count each other. A reserved order counts as an issued one.
+
+    Keyword argument:
+        domains -- Domains of the certificate
+        certification_authority -- URL of the certification authority
+
+    Returns:
+        The identifier of the reserved order
+    """
+    registered_domains = set(_get_registered_domain(d) for d in domains)
+
+    def _registered_domains(order):
+        return set(_get_registered_domain(d) for d in order["domains"])
+
+    matches = {
+        "certificates per registered domain": lambda order:
+            order["result"] in ("issued", "reserved") and
+            registered_domains & _registered_domains(order),
+        "duplicate certificate": lambda order:
+            order["result"] in ("issued", "reserved") and
+            set(order["domains"]) == set(domains),
+        "failed validation": lambda order:
+            order["result"] == "failed" and
+            set(order["domains"]) & set(domains),
+        "previous rate limit": lambda order:
+            order["result"] == "rate-limited" and
+            registered_domains & _registered_domains(order),
+    }
+
+    with _lock_acme_orders():
+        # Taken once locked, to be later than the orders already logged
+        now = time.time()
+        orders = _get_acme_orders(now)
+
+        for limit, (number, period) in ACME_RATE_LIMITS.items():
+            count = len([order for order in orders
+                         if order["CA"] == certification_authority and
+                         now - order["time"] < period and
+                         matches[limit](order)])
+
+            if count >= number:
+                raise MoulinetteError(errno.EINVAL, m18n.n(
+                    'certmanager_rate_limit_reached',
+                    domain=", ".join(domains), limit=limit))
+
+        order_id = binascii.hexlify(os.urandom(8))
+        orders.append({
+            "id": order_id,
+            "domains": domains,
+            "CA": certification_authority,
+            "result": "reserved",
+            "time": now,
+        })
+        _save_json_cache(ACME_ORDERS_LOG, {"orders": orders})
+
+    return order_id
+
+
+def _record_acme_order(order_id, result):
+    """
+    Record the result of an order reserved by _reserve_acme_order(), or
+    forget the order if result is None
+    """
+    with _lock_acme_orders():
+        orders = _get_acme_orders(time.time())
+
+        for order in orders:
+            if order.get("id") == order_id:
+                if result is None:
+                    orders.remove(order)
+                else:
+                    order["result"] = result
+                break
+
+        _save_json_cache(ACME_ORDERS_LOG, {"orders": orders})
+
+
+@contextmanager
+def _lock_acme_orders():
+    """
+    Lock the log of the ACME orders against the other threads and the other
+    processes, e.g. a manual renewal running along the daily one
+    """
+    with _acme_orders_lock:
+        if not os.path.isdir(os.path.dirname(ACME_ORDERS_LOG)):
+            os.makedirs(os.path.dirname(ACME_ORDERS_LOG))
+
+        # The log is replaced when saved, so the lock is another file
+        with open(ACME_ORDERS_LOG + ".lock", "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            yield
+
+
+def _get_acme_orders(now):
+    """ Return the logged orders which still count in the rate limits """
+    period = max(period for _, period in ACME_RATE_LIMITS.values())
+    orders = _get_json_cache(ACME_ORDERS_LOG).get("orders", [])
+    return [order for order in orders if now - order["time"] < period]
+
+
+def _get_registered_domain(domain):
+    # Without the public suffix list, assume the registered domain is made
+    # of the last two labels, or three under the known public suffixes of
+    # two labels
+    labels = domain.split(".")
+    if ".".join(labels[-2:]) in ACME_PUBLIC_SUFFIXES:
+        return ".".join(labels[-3:])
+    return ".".join(labels[-2:])
+
+
+def _get_json_cache(cache_file):
+    try:
+        with open(cache_file) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return {}
+
+
+def _save_json_cache(cache_file, cache):
+    tmp_file = "%s.%d" % (cache_file, os.getpid())
+    try:
+        cache_dir = os.path.dirname(cache_file)
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        with open(tmp_file, "w") as f:
+            json.dump(cache, f)
+        os.rename(tmp_file, cache_file)
+    except (IOError, OSError) as e:
+        logger.debug("Unable to save the cache %s: %s", cache_file, e)
+
+
 def _get_dns_ip(domain):
     try:
         resolver = dns.resolver.Resolver()
@@ -957,3 +1673,17 @@ def _tail(n, file_path):
     stdout.close()
 
     return "".join(lines)
+
+
+# This file is also run as an executable by _fill_key_pool_in_background(),
+# with the type and the number of keys to keep in the key pool, and its
+# folder
+if __name__ == "__main__":
+    import logging
+    logging.basicConfig(format="%(asctime)s %(levelname)s %(message)s")
+
+    try:
+        _fill_key_pool(sys.argv[1], int(sys.argv[2]), sys.argv[3])
+    except Exception:
+        logger.exception("Unable to fill the key pool")
+        sys.exit(1)
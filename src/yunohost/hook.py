@@ -26,18 +26,41 @@
 import os
 import re
 import errno
+import time
+import atexit
+import shutil
 import tempfile
+import threading
+import itertools
 from glob import iglob
 
 from moulinette import m18n
 from moulinette.core import MoulinetteError
 from moulinette.utils import log
 
+from yunohost.settings import settings_get
+
 HOOK_FOLDER = '/usr/share/yunohost/hooks/'
 CUSTOM_HOOK_FOLDER = '/etc/yunohost/hooks.d/'
 
 logger = log.getActionLogger('yunohost.hook')
 
+# Hooks registry of each action, see _get_hooks_registry()
+_hooks_registries = {}
+
+# Held while logging the output of a script executed from a worker thread,
+# so that outputs of concurrent scripts aren't interleaved
+_output_lock = threading.Lock()
+
+# Flagged in the threads of the pools executing scripts concurrently, see
+# _init_worker_thread()
+_worker_thread = threading.local()
+
+# Directory of the stdinfo FIFOs of the scripts, see _new_stdinfo_path()
+_stdinfo_dir = None
+_stdinfo_lock = threading.Lock()
+_stdinfo_counter = itertools.count()
+
 
 def hook_add(app, file):
     """
@@ -176,42 +199,23 @@ def hook_list(action, list_by='name', show_info=False):
     else:
         raise MoulinetteError(errno.EINVAL, m18n.n('hook_list_by_invalid'))
 
-    def _append_folder(d, folder):
-        # Iterate over and add hook from a folder
-        for f in os.listdir(folder + action):
-            if f[0] == '.' or f[-1] == '~':
-                continue
-            path = '%s%s/%s' % (folder, action, f)
-            priority, name = _extract_filename_parts(f)
-            _append_hook(d, priority, name, path)
+    if list_by == 'folder':
+        result['system'] = dict() if show_info else set()
+        result['custom'] = dict() if show_info else set()
 
-    try:
-        # Append system hooks first
+    # Append system hooks first, then custom hooks
+    for folder, priority, name, path in _get_hooks_registry(action)['entries']:
         if list_by == 'folder':
-            result['system'] = dict() if show_info else set()
-            _append_folder(result['system'], HOOK_FOLDER)
+            _append_hook(result[folder], priority, name, path)
         else:
-            _append_folder(result, HOOK_FOLDER)
-    except OSError:
-        logger.debug("system hook folder not found for action '%s' in %s",
-                     action, HOOK_FOLDER)
-
-    try:
-        # Append custom hooks
-        if list_by == 'folder':
-            result['custom'] = dict() if show_info else set()
-            _append_folder(result['custom'], CUSTOM_HOOK_FOLDER)
-        else:
-            _append_folder(result, CUSTOM_HOOK_FOLDER)
-    except OSError:
-        logger.debug("custom hook folder not found for action '%s' in %s",
-                     action, CUSTOM_HOOK_FOLDER)
+            _append_hook(result, priority, name, path)
 
     return {'hooks': result}
 
 
 def hook_callback(action, hooks=[], args=None, no_trace=False, chdir=None,
-                  env=None, pre_callback=None, post_callback=None):
+                  env=None, pre_callback=None, post_callback=None,
+                  skip_paths=None, jobs=None):
     """
     Execute all scripts binded to an action
 
@@ -227,44 +231,42 @@ def hook_callback(action, hooks=[], args=None, no_trace=False, chdir=None,
             the arguments to pass to the script
         post_callback -- An object to call after each script execution with
             (name, priority, path, succeed) as arguments
+        skip_paths -- List of scripts paths which must not be executed (e.g.
+            because they have already been executed)
+        jobs -- Number of scripts of the same priority to execute at the same
+            time, the scripts of a priority being all executed before the
+            next priority. The callbacks are called from the calling thread,
+            before and after the scripts of the priority. If None, the
+            "hooks.callback.parallel_jobs" setting is used
 
     """
     result = {'succeed': {}, 'failed': {}}
     hooks_dict = {}
+    registry = _get_hooks_registry(action)
+    hooks_names = registry['names']
 
     # Retrieve hooks
     if not hooks:
-        hooks_dict = hook_list(action, list_by='priority',
-                               show_info=True)['hooks']
+        all_hooks = hooks_names.keys()
     else:
-        hooks_names = hook_list(action, list_by='name',
-                                show_info=True)['hooks']
-
         # Add similar hooks to the list
         # For example: Having a 16-postfix hook in the list will execute a
         # xx-postfix_dkim as well
-        all_hooks = []
+        all_hooks = set()
         for n in hooks:
-            for key in hooks_names.keys():
-                if key == n or key.startswith("%s_" % n) \
-                        and key not in all_hooks:
-                    all_hooks.append(key)
-
-        # Iterate over given hooks names list
-        for n in all_hooks:
-            try:
-                hl = hooks_names[n]
-            except KeyError:
-                raise MoulinetteError(errno.EINVAL,
-                                      m18n.n('hook_name_unknown', n))
-            # Iterate over hooks with this name
-            for h in hl:
-                # Update hooks dict
-                d = hooks_dict.get(h['priority'], dict())
-                d.update({n: {'path': h['path']}})
-                hooks_dict[h['priority']] = d
+            all_hooks.update(registry['prefixes'].get(n, []))
+
+    # Iterate over given hooks names list
+    for n in all_hooks:
+        # Iterate over hooks with this name
+        for h in hooks_names[n]:
+            # Update hooks dict
+            d = hooks_dict.get(h['priority'], dict())
+            d.update({n: {'path': h['path']}})
+            hooks_dict[h['priority']] = d
     if not hooks_dict:
         return result
+    skip_paths = skip_paths or []
 
     # Validate callbacks
     if not callable(pre_callback):
@@ -274,9 +276,29 @@ def hook_callback(action, hooks=[], args=None, no_trace=False, chdir=None,
 
     # Iterate over hooks and execute them
     for priority in sorted(hooks_dict):
-        for name, info in iter(hooks_dict[priority].items()):
+        scripts = [(name, info['path'])
+                   for name, info in iter(hooks_dict[priority].items())
+                   if info['path'] not in skip_paths]
+
+        # The setting is only read when needed, most callbacks having one
+        # hook by priority
+        if jobs is None and len(scripts) > 1:
+            jobs = settings_get('hooks.callback.parallel_jobs')
+
+        if len(scripts) > 1 and jobs > 1:
+            states = _hook_exec_concurrently(
+                scripts, priority, jobs, args=args, no_trace=no_trace,
+                chdir=chdir, env=env, pre_callback=pre_callback,
+                post_callback=post_callback)
+            for (name, path), state in zip(scripts, states):
+                try:
+                    result[state][name].append(path)
+                except KeyError:
+                    result[state][name] = [path]
+            continue
+
+        for name, path in scripts:
             state = 'succeed'
-            path = info['path']
             try:
                 hook_args = pre_callback(name=name, priority=priority,
                                          path=path, args=args)
@@ -297,6 +319,67 @@ def hook_callback(action, hooks=[], args=None, no_trace=False, chdir=None,
     return result
 
 
+def _hook_exec_concurrently(scripts, priority, jobs, args, no_trace, chdir,
+                            env, pre_callback, post_callback):
+    """
+    Execute scripts of the same priority at the same time
+
+    The pre callbacks of all the scripts are called first, then up to 'jobs'
+    scripts are executed at the same time and the post callbacks are called
+    once they have all ended, in the order of the scripts. The output of each
+    script is logged at once when it ends, see hook_exec().
+
+    Keyword argument:
+        scripts -- List of (name, path) of the scripts to execute
+
+    Return:
+        (list) The state of each script, 'succeed' or 'failed'
+    """
+    from multiprocessing.pool import ThreadPool
+
+    states = []
+    scripts_args = []
+    for name, path in scripts:
+        try:
+            scripts_args.append(pre_callback(name=name, priority=priority,
+                                             path=path, args=args))
+        except MoulinetteError as e:
+            logger.error(e.strerror, exc_info=1)
+            scripts_args.append(None)
+            states.append('failed')
+        else:
+            states.append('succeed')
+
+    def _exec(i):
+        # hook_exec() adds variables to the environment, so each script needs
+        # its own copy
+        try:
+            hook_exec(scripts[i][1], args=scripts_args[i], chdir=chdir,
+                      env=dict(env) if env else None, no_trace=no_trace,
+                      raise_on_error=True)
+        except MoulinetteError as e:
+            logger.error(e.strerror, exc_info=1)
+            return 'failed'
+        return 'succeed'
+
+    to_exec = [i for i, state in enumerate(states) if state == 'succeed']
+    pool = ThreadPool(min(jobs, len(to_exec)) or 1,
+                      initializer=_init_worker_thread)
+    try:
+        # map() keeps the order of the scripts
+        for i, state in zip(to_exec, pool.map(_exec, to_exec)):
+            states[i] = state
+    finally:
+        pool.close()
+        pool.join()
+
+    for (name, path), state in zip(scripts, states):
+        post_callback(name=name, priority=priority, path=path,
+                      succeed=(state == 'succeed'))
+
+    return states
+
+
 def hook_exec(path, args=None, raise_on_error=False, no_trace=False,
               chdir=None, env=None, user="root", stdout_callback=None,
               stderr_callback=None):
@@ -338,26 +421,44 @@ def hook_exec(path, args=None, raise_on_error=False, no_trace=False,
         env = {}
     env['YNH_CWD'] = chdir
 
-    stdinfo = os.path.join(tempfile.mkdtemp(), "stdinfo")
+    stdinfo = _new_stdinfo_path()
     env['YNH_STDINFO'] = stdinfo
 
     # Construct command to execute
     if user == "root":
-        command = ['sh', '-c']
+        # Execute bash directly with the environment of this process and the
+        # given variables, without an intermediate shell
+        process_env = dict(os.environ)
+        process_env.update((str(k), str(v)) for k, v in env.items())
+
+        if no_trace:
+            command = ['/bin/bash', cmd_script]
+        else:
+            # use xtrace on fd 7 which is redirected to stdout by a bash
+            # wrapper, which is replaced by the script with exec
+            command = ['/bin/bash', '-c',
+                       'exec 7>&1 && '
+                       'BASH_XTRACEFD=7 exec /bin/bash -x "$0" "$@"',
+                       cmd_script]
+        if args and isinstance(args, list):
+            command.extend(str(s) for s in args)
     else:
+        # sudo resets the environment and closes the file descriptors, so
+        # they are set up by a shell run by sudo
         command = ['sudo', '-n', '-u', user, '-H', 'sh', '-c']
+        process_env = None
 
-    if no_trace:
-        cmd = '/bin/bash "{script}" {args}'
-    else:
-        # use xtrace on fd 7 which is redirected to stdout
-        cmd = 'BASH_XTRACEFD=7 /bin/bash -x "{script}" {args} 7>&1'
+        if no_trace:
+            cmd = '/bin/bash "{script}" {args}'
+        else:
+            # use xtrace on fd 7 which is redirected to stdout
+            cmd = 'BASH_XTRACEFD=7 /bin/bash -x "{script}" {args} 7>&1'
 
-    # prepend environment variables
-    cmd = '{0} {1}'.format(
-        ' '.join(['{0}={1}'.format(k, shell_quote(v))
-                for k, v in env.items()]), cmd)
-    command.append(cmd.format(script=cmd_script, args=cmd_args))
+        # prepend environment variables
+        cmd = '{0} {1}'.format(
+            ' '.join(['{0}={1}'.format(k, shell_quote(v))
+                    for k, v in env.items()]), cmd)
+        command.append(cmd.format(script=cmd_script, args=cmd_args))
 
     if logger.isEnabledFor(log.DEBUG):
         logger.debug(m18n.n('executing_command', command=' '.join(command)))
@@ -374,13 +475,30 @@ def hook_exec(path, args=None, raise_on_error=False, no_trace=False,
         callbacks = ( callbacks[0], callbacks[1],
                        lambda l: logger.info(l.rstrip()))
 
+    # When run from a worker thread (e.g. during a parallel restore), buffer
+    # the output and replay it from this thread once the script has ended, so
+    # that the logs of concurrent scripts don't get mixed up
+    output = None
+    if _in_worker_thread():
+        output = []
+
+        def _buffer(callback):
+            return lambda l: output.append((callback, l))
+
+        callbacks = tuple(_buffer(c) for c in callbacks)
+
     logger.debug("About to run the command '%s'" % command)
 
     returncode = call_async_output(
         command, callbacks, shell=False, cwd=chdir,
-        stdinfo=stdinfo
+        stdinfo=stdinfo, env=process_env
     )
 
+    if output is not None:
+        with _output_lock:
+            for callback, line in output:
+                callback(line)
+
     # Check and return process' return code
     if returncode is None:
         if raise_on_error:
@@ -395,6 +513,127 @@ def hook_exec(path, args=None, raise_on_error=False, no_trace=False,
     return returncode
 
 
+def _init_worker_thread():
+    """
+    Flag the current thread as a worker of a pool executing scripts
+    concurrently, whose output is buffered and whose operations only log
+    their own records, see hook_exec() and OperationLogger
+
+    To be given as the initializer of such a pool.
+    """
+    _worker_thread.enabled = True
+
+
+def _in_worker_thread():
+    """Return whether the current thread was flagged by _init_worker_thread()"""
+    return getattr(_worker_thread, 'enabled', False)
+
+
+def _new_stdinfo_path():
+    """
+    Return a new path for the stdinfo FIFO of a script
+
+    The FIFO is created and removed by call_async_output(). They are all put
+    in a directory created once per process, which is removed when the
+    process exits.
+    """
+    global _stdinfo_dir
+
+    with _stdinfo_lock:
+        if _stdinfo_dir is None or _stdinfo_dir[0] != os.getpid() or \
+                not os.path.isdir(_stdinfo_dir[1]):
+            _stdinfo_dir = (os.getpid(),
+                            tempfile.mkdtemp(prefix='yunohost-stdinfo-'))
+            atexit.register(_remove_stdinfo_dir, *_stdinfo_dir)
+        return os.path.join(_stdinfo_dir[1],
+                            'stdinfo-%d' % next(_stdinfo_counter))
+
+
+def _remove_stdinfo_dir(pid, path):
+    """Remove the stdinfo directory of a process, but not from its forks"""
+    if os.getpid() == pid:
+        shutil.rmtree(path, ignore_errors=True)
+
+
+def _get_hooks_registry(action):
+    """
+    Return the registry of the available hooks for an action
+
+    The hooks folders are only listed again when they have been modified
+    since the previous call, which is known from their inode and mtime. The
+    registry is a dict with:
+
+        entries -- (folder, priority, name, path) tuples of the hooks, system
+                   hooks first, folder being 'system' or 'custom'
+        names -- The hooks of each name as a list of {'priority', 'path'},
+                 a custom hook overwriting the system one of same priority
+        prefixes -- The names matched by each name given to hook_callback(),
+                    i.e. the name itself and the names starting with it
+                    followed by "_"
+
+    It must not be modified by callers.
+    """
+    folders = [('system', HOOK_FOLDER), ('custom', CUSTOM_HOOK_FOLDER)]
+
+    stamps = []
+    for _, folder in folders:
+        try:
+            st = os.stat(folder + action)
+        except OSError:
+            stamps.append(None)
+        else:
+            stamps.append((st.st_ino, st.st_mtime))
+    stamps = tuple(stamps)
+
+    cached = _hooks_registries.get(action)
+    if cached is not None and cached[0] == stamps:
+        return cached[1]
+
+    entries = []
+    for kind, folder in folders:
+        try:
+            files = os.listdir(folder + action)
+        except OSError:
+            logger.debug("%s hook folder not found for action '%s' in %s",
+                         kind, action, folder)
+            continue
+        for f in files:
+            if f[0] == '.' or f[-1] == '~':
+                continue
+            priority, name = _extract_filename_parts(f)
+            entries.append((kind, priority, name,
+                            '%s%s/%s' % (folder, action, f)))
+
+    names = {}
+    for _, priority, name, path in entries:
+        hooks = names.setdefault(name, [])
+        for h in hooks:
+            # Only one priority for the hook is accepted, custom hooks are
+            # listed last and overwrite system ones
+            if h['priority'] == priority:
+                h['path'] = path
+                break
+        else:
+            hooks.append({'priority': priority, 'path': path})
+
+    prefixes = {}
+    for name in names:
+        prefixes.setdefault(name, set()).add(name)
+        for i, c in enumerate(name):
+            if c == '_':
+                prefixes.setdefault(name[:i], set()).add(name)
+
+    registry = {'entries': entries, 'names': names, 'prefixes': prefixes}
+
+    # A folder modified within the mtime granularity after being listed
+    # would keep the same mtime, so only cache folders modified a while ago
+    recent = time.time() - 2
+    if all(stamp is None or stamp[1] < recent for stamp in stamps):
+        _hooks_registries[action] = (stamps, registry)
+
+    return registry
+
+
 def _extract_filename_parts(filename):
     """Extract hook parts from filename"""
     if '-' in filename:
@@ -27,10 +27,11 @@
 import os
 import yaml
 import errno
+import threading
 import collections
 
 from datetime import datetime
-from logging import FileHandler, getLogger, Formatter
+from logging import FileHandler, getLogger, Formatter, Filter
 from sys import exc_info
 
 from moulinette import m18n, msettings
@@ -330,6 +331,13 @@ class OperationLogger(object):
         self.file_handler = FileHandler(filename)
         self.file_handler.formatter = Formatter('%(asctime)s: %(levelname)s - %(message)s')
 
+        # Operations started from a worker thread (e.g. parallel restore of
+        # apps) only record the logs of their own thread
+        from yunohost.hook import _in_worker_thread
+        if _in_worker_thread():
+            self.file_handler.addFilter(
+                _ThreadFilter(threading.current_thread().ident))
+
         # Listen to the root logger
         self.logger = getLogger('yunohost')
         self.logger.addHandler(self.file_handler)
@@ -442,6 +450,19 @@ class OperationLogger(object):
         self.error(m18n.n('log_operation_unit_unclosed_properly'))
 
 
+class _ThreadFilter(Filter):
+    """
+    Logging filter which only accept records emitted by a given thread
+    """
+
+    def __init__(self, thread_ident):
+        super(_ThreadFilter, self).__init__()
+        self.thread_ident = thread_ident
+
+    def filter(self, record):
+        return record.thread == self.thread_ident
+
+
 def _get_description_from_name(name):
     """
     Return the translated description from the filename
@@ -25,17 +25,31 @@
 """
 import re
 import json
+import math
 import time
+import fcntl
 import psutil
+import signal
+import socket
+import struct
+import urllib
 import calendar
+import platform
+import threading
 import subprocess
-import xmlrpclib
+import SocketServer
+import BaseHTTPServer
 import os.path
 import errno
 import os
+import pwd
 import dns.resolver
 import cPickle as pickle
+from array import array
+from collections import deque
+from copy import deepcopy
 from datetime import datetime
+from itertools import izip, islice
 
 from moulinette import m18n
 from moulinette.core import MoulinetteError
@@ -46,9 +60,19 @@ from yunohost.domain import _get_maindomain
 
 logger = getActionLogger('yunohost.monitor')
 
-GLANCES_URI = 'http://127.0.0.1:61209'
 STATS_PATH = '/var/lib/yunohost/stats'
+STATS_PERIODS = {'day': 86400, 'week': 604800, 'month': 2419200}  # In s
+STATS_STATIC_KEYS = ('time_since_update', 'fs_type', 'mnt_point')
+STATS_PERCENTILES = (50, 95)
+STATS_UPDATE_INTERVALS = {'day': 300, 'week': 3600, 'month': 14400}  # In s
+STATS_DELTA_KEYS = ('read_count', 'write_count', 'read_bytes', 'write_bytes',
+                    'rx', 'tx', 'cx')
+SAMPLER_SOCKET_PATH = '/var/run/yunohost-monitor.sock'
+SAMPLER_BUFFER_SIZE = 3600
+EXPORT_REFRESH_INTERVALS = {'services': 30, 'backups': 60, 'regen_conf': 300,
+                            'certificates': 3600, 'apps': 3600}  # In s
 CRONTAB_PATH = '/etc/cron.d/yunohost-monitor'
+COUNTERS_PATH = '/var/cache/yunohost/monitor/counters.json'
 
 
 def monitor_disk(units=None, mountpoint=None, human_readable=False):
@@ -61,7 +85,7 @@ def monitor_disk(units=None, mountpoint=None, human_readable=False):
         human_readable -- Print sizes in human readable format
 
     """
-    glances = _get_glances_api()
+    collector = _get_collector()
     result_dname = None
     result = {}
 
@@ -102,7 +126,7 @@ def monitor_disk(units=None, mountpoint=None, human_readable=False):
 
             # Iterate over values
             devices_names = devices.keys()
-            for d in json.loads(glances.getDiskIO()):
+            for d in collector.disk_io():
                 dname = d.pop('disk_name')
                 try:
                     devices_names.remove(dname)
@@ -126,7 +150,7 @@ def monitor_disk(units=None, mountpoint=None, human_readable=False):
 
             # Iterate over values
             devices_names = devices.keys()
-            for d in json.loads(glances.getFs()):
+            for d in collector.filesystems():
                 dname = _format_dname(d.pop('device_name'))
                 try:
                     devices_names.remove(dname)
@@ -157,7 +181,7 @@ def monitor_network(units=None, human_readable=False):
         human_readable -- Print sizes in human readable format
 
     """
-    glances = _get_glances_api()
+    collector = _get_collector()
     result = {}
 
     if units is None:
@@ -200,7 +224,7 @@ def monitor_network(units=None, human_readable=False):
             }
         elif u == 'usage':
             result[u] = {}
-            for i in json.loads(glances.getNetwork()):
+            for i in collector.network():
                 iname = i['interface_name']
                 if iname in devices.keys():
                     del i['interface_name']
@@ -253,7 +277,7 @@ def monitor_system(units=None, human_readable=False):
         human_readable -- Print sizes in human readable format
 
     """
-    glances = _get_glances_api()
+    collector = _get_collector()
     result = {}
 
     if units is None:
@@ -262,8 +286,8 @@ def monitor_system(units=None, human_readable=False):
     # Retrieve monitoring for unit(s)
     for u in units:
         if u == 'memory':
-            ram = json.loads(glances.getMem())
-            swap = json.loads(glances.getMemSwap())
+            ram = collector.memory()
+            swap = collector.swap()
             if human_readable:
                 for i in ram.keys():
                     if i != 'percent':
@@ -277,15 +301,15 @@ def monitor_system(units=None, human_readable=False):
             }
         elif u == 'cpu':
             result[u] = {
-                'load': json.loads(glances.getLoad()),
-                'usage': json.loads(glances.getCpu())
+                'load': collector.load(),
+                'usage': collector.cpu()
             }
         elif u == 'process':
-            result[u] = json.loads(glances.getProcessCount())
+            result[u] = collector.process_count()
         elif u == 'uptime':
             result[u] = (str(datetime.now() - datetime.fromtimestamp(psutil.boot_time())).split('.')[0])
         elif u == 'infos':
-            result[u] = json.loads(glances.getSystem())
+            result[u] = collector.system_infos()
         else:
             raise MoulinetteError(errno.EINVAL, m18n.n('unit_unknown', unit=u))
 
@@ -294,6 +318,31 @@ def monitor_system(units=None, human_readable=False):
     return result
 
 
+def monitor_apps(apps=None, human_readable=False):
+    """
+    Monitor the CPU, memory and I/O usage of apps
+
+    Keyword argument:
+        apps -- App(s) to monitor
+        human_readable -- Print sizes in human readable format
+
+    """
+    result = _get_collector().apps()
+
+    if apps:
+        for app in apps:
+            if app not in result:
+                raise MoulinetteError(errno.EINVAL,
+                                      m18n.n('app_not_installed', app=app))
+        result = dict((app, result[app]) for app in apps)
+
+    if human_readable:
+        for usage in result.values():
+            for i in ['memory', 'read_bytes', 'write_bytes']:
+                usage[i] = binary_to_human(usage[i]) + 'B'
+    return result
+
+
 def monitor_update_stats(period):
     """
     Update monitoring statistics
@@ -305,90 +354,62 @@ def monitor_update_stats(period):
     if period not in ['day', 'week', 'month']:
         raise MoulinetteError(errno.EINVAL, m18n.n('monitor_period_invalid'))
 
-    stats = _retrieve_stats(period)
-    if not stats:
-        stats = {'disk': {}, 'network': {}, 'system': {}, 'timestamp': []}
+    store = _StatsStore(period)
+    _import_legacy_stats(store)
 
-    monitor = None
     # Get monitoring stats
     if period == 'day':
-        monitor = _monitor_all('day')
+        values, statics = _flatten_stats(_monitor_all())
     else:
-        t = stats['timestamp']
+        # Roll up the stats of the shorter period recorded since the last
+        # update
         p = 'day' if period == 'week' else 'week'
-        if len(t) > 0:
-            monitor = _monitor_all(p, t[len(t) - 1])
-        else:
-            monitor = _monitor_all(p, 0)
-    if not monitor:
-        raise MoulinetteError(errno.ENODATA, m18n.n('monitor_stats_no_update'))
-
-    stats['timestamp'].append(time.time())
-
-    # Append disk stats
-    for dname, units in monitor['disk'].items():
-        disk = {}
-        # Retrieve current stats for disk name
-        if dname in stats['disk'].keys():
-            disk = stats['disk'][dname]
-
-        for unit, values in units.items():
-            # Continue if unit doesn't contain stats
-            if not isinstance(values, dict):
-                continue
-
-            # Retrieve current stats for unit and append new ones
-            curr = disk[unit] if unit in disk.keys() else {}
-            if unit == 'io':
-                disk[unit] = _append_to_stats(curr, values, 'time_since_update')
-            elif unit == 'filesystem':
-                disk[unit] = _append_to_stats(curr, values, ['fs_type', 'mnt_point'])
-        stats['disk'][dname] = disk
-
-    # Append network stats
-    net_usage = {}
-    for iname, values in monitor['network']['usage'].items():
-        # Continue if units doesn't contain stats
-        if not isinstance(values, dict):
-            continue
-
-        # Retrieve current stats and append new ones
-        curr = {}
-        if 'usage' in stats['network'] and iname in stats['network']['usage']:
-            curr = stats['network']['usage'][iname]
-        net_usage[iname] = _append_to_stats(curr, values, 'time_since_update')
-    stats['network'] = {'usage': net_usage, 'infos': monitor['network']['infos']}
-
-    # Append system stats
-    for unit, values in monitor['system'].items():
-        # Continue if units doesn't contain stats
-        if not isinstance(values, dict):
-            continue
-
-        # Set static infos unit
-        if unit == 'infos':
-            stats['system'][unit] = values
-            continue
-
-        # Retrieve current stats and append new ones
-        curr = stats['system'][unit] if unit in stats['system'].keys() else {}
-        stats['system'][unit] = _append_to_stats(curr, values)
+        stats = _summarize_stats(p, store.last_timestamp() or 0)
+        if not stats:
+            raise MoulinetteError(errno.ENODATA,
+                                  m18n.n('monitor_stats_no_update'))
+        values = dict((name, aggregates['mean'])
+                      for name, aggregates in stats['values'].items())
+        statics = stats['statics']
 
-    _save_stats(stats, period)
+    _update_stats(store, time.time(), values, statics)
 
 
-def monitor_show_stats(period, date=None):
+def monitor_show_stats(period, date=None, summary=False):
     """
     Show monitoring statistics
 
     Keyword argument:
-        period -- Time period to show (day, week, month)
+        period -- Time period to show (live, day, week, month)
+        summary -- Show the mean, min, max and percentiles of each statistic
+            instead of its values
 
     """
-    if period not in ['day', 'week', 'month']:
+    if period not in ['live', 'day', 'week', 'month']:
         raise MoulinetteError(errno.EINVAL, m18n.n('monitor_period_invalid'))
 
-    result = _retrieve_stats(period, date)
+    t_begin = t_end = None
+    if date is not None:
+        t_begin = calendar.timegm(date)
+        if period != 'live':
+            t_end = t_begin + STATS_PERIODS[period]
+
+    if period == 'live':
+        # Ask the sampler for the samples of its ring buffer
+        timestamps, columns, statics = _query_sampler(t_begin, t_end)
+        if not timestamps:
+            result = None
+        elif summary:
+            result = _summary_to_dict(
+                _summarize_columns(timestamps, columns, statics))
+        else:
+            result = _stats_to_dict(timestamps, columns, statics)
+    elif summary:
+        result = _summarize_stats(period, t_begin, t_end)
+        if result:
+            result = _summary_to_dict(result)
+    else:
+        result = _retrieve_stats(period, t_begin, t_end)
     if result is False:
         raise MoulinetteError(errno.ENOENT,
                               m18n.n('monitor_stats_file_not_found'))
@@ -398,6 +419,19 @@ def monitor_show_stats(period, date=None):
     return result
 
 
+def monitor_export():
+    """
+    Export the monitoring metrics and the state of the server in the
+    OpenMetrics text format
+
+    This action isn't in the API, which would encode the text as JSON. The
+    metrics are served over HTTP on http://localhost:PORT/metrics by the
+    sampler run with a metrics port, see run_sampler().
+
+    """
+    return _request_sampler({'export': True})
+
+
 def monitor_enable(with_stats=False):
     """
     Enable server monitoring
@@ -409,21 +443,17 @@ def monitor_enable(with_stats=False):
     from yunohost.service import (service_status, service_enable,
         service_start)
 
-    glances = service_status('glances')
-    if glances['status'] != 'running':
-        service_start('glances')
-    if glances['loaded'] != 'enabled':
-        service_enable('glances')
-
-    # Install crontab
+    # Start the sampler, which updates the statistics
     if with_stats:
-        #  day: every 5 min  #  week: every 1 h  #  month: every 4 h  #
-        rules = ('*/5 * * * * root {cmd} day >> /dev/null\n'
-                 '3 * * * * root {cmd} week >> /dev/null\n'
-                 '6 */4 * * * root {cmd} month >> /dev/null').format(
-            cmd='/usr/bin/yunohost --quiet monitor update-stats')
-        with open(CRONTAB_PATH, 'w') as f:
-            f.write(rules)
+        sampler = service_status('yunohost-monitor')
+        if sampler['status'] != 'running':
+            service_start('yunohost-monitor')
+        if sampler['loaded'] != 'enabled':
+            service_enable('yunohost-monitor')
+
+        # Remove the crontab which was updating them before
+        if os.path.isfile(CRONTAB_PATH):
+            os.remove(CRONTAB_PATH)
 
     logger.success(m18n.n('monitor_enabled'))
 
@@ -436,12 +466,12 @@ def monitor_disable():
     from yunohost.service import (service_status, service_disable,
         service_stop)
 
-    glances = service_status('glances')
-    if glances['status'] != 'inactive':
-        service_stop('glances')
-    if glances['loaded'] != 'disabled':
+    sampler = service_status('yunohost-monitor')
+    if sampler['status'] != 'inactive':
+        service_stop('yunohost-monitor')
+    if sampler['loaded'] != 'disabled':
         try:
-            service_disable('glances')
+            service_disable('yunohost-monitor')
         except MoulinetteError as e:
             logger.warning(e.strerror)
 
@@ -454,24 +484,355 @@ def monitor_disable():
     logger.success(m18n.n('monitor_disabled'))
 
 
-def _get_glances_api():
+_collector = None
+_apps_owners = None
+
+
+def _get_collector():
     """
-    Retrieve Glances API running on the local server
+    Retrieve the collector of the system metrics of this process
+
+    """
+    global _collector
+    if _collector is None:
+        _collector = _MetricsCollector(COUNTERS_PATH)
+    return _collector
+
+
+def _get_apps_owners():
+    """
+    Retrieve what the processes of the installed apps can be identified by
+
+    Returns:
+        A tuple of the list of app ids, a dict of app by systemd unit (the
+        services added by the app), a dict of app by uid (its system user)
+        and a list of (path, app) of the app directories
 
     """
+    global _apps_owners
+    from yunohost.app import APPS_SETTING_PATH, _get_app_settings
+    from yunohost.service import _get_services
+
+    # Check whether an app, one of its settings or a service has changed
     try:
-        p = xmlrpclib.ServerProxy(GLANCES_URI)
-        p.system.methodHelp('getAll')
-    except (xmlrpclib.ProtocolError, IOError):
-        pass
-    else:
-        return p
+        app_ids = sorted(os.listdir(APPS_SETTING_PATH))
+    except OSError:
+        app_ids = []
+    files = [os.path.join(APPS_SETTING_PATH, app, 'settings.yml')
+             for app in app_ids] + ['/etc/yunohost/services.yml']
+    key = tuple((f, os.path.getmtime(f)) for f in files
+                if os.path.isfile(f))
+    if _apps_owners is not None and _apps_owners[0] == key:
+        return _apps_owners[1]
+
+    units = {}
+    for service in _get_services():
+        # Services are named after their app, the longest id matching
+        matching = [app for app in app_ids
+                    if service == app or service.startswith(app + '-')]
+        if matching:
+            units[service] = max(matching, key=len)
+
+    users = {}
+    paths = []
+    for app in app_ids:
+        try:
+            users[pwd.getpwnam(app).pw_uid] = app
+        except KeyError:
+            pass
+        try:
+            final_path = _get_app_settings(app).get('final_path')
+        except MoulinetteError:
+            final_path = None
+        if final_path:
+            paths.append((final_path.rstrip('/'), app))
 
-    from yunohost.service import service_status
+    _apps_owners = (key, (app_ids, units, users, paths))
+    return _apps_owners[1]
+
+
+class _MetricsCollector(object):
+    """
+    Collect the system metrics from /proc and psutil
+
+    The values are returned with the same keys as the Glances API. Disk I/O,
+    network and CPU counters are given as their difference since the
+    previous sample of the same counters, along with the time elapsed since
+    then in 'time_since_update'. Previous samples are kept in memory and, if
+    a state path is given, in a file so that successive commands compute the
+    differences over the time between them. Counters which weren't sampled
+    yet since the boot are given since the boot.
+
+    Keyword argument:
+        state_path -- Path of the file of the previous samples
+
+    """
+
+    def __init__(self, state_path=None):
+        self.state_path = state_path
+        self._samples = None
+
+    def disk_io(self):
+        """ Return the I/O of each disk """
+        counters = {}
+        with open('/proc/diskstats') as f:
+            for line in f:
+                # Fields are documented in Documentation/iostats.txt of
+                # the kernel, sectors are always of 512 bytes
+                fields = line.split()
+                counters[fields[2]] = {
+                    'read_count': int(fields[3]),
+                    'read_bytes': int(fields[5]) * 512,
+                    'write_count': int(fields[7]),
+                    'write_bytes': int(fields[9]) * 512,
+                }
+        result = []
+        samples = self._sample('disk_io', counters)
+        for name, (elapsed, deltas) in samples.items():
+            deltas.update(disk_name=name, time_since_update=elapsed)
+            result.append(deltas)
+        return result
+
+    def filesystems(self):
+        """ Return the usage of each mounted filesystem """
+        result = []
+        for p in psutil.disk_partitions(all=False):
+            try:
+                usage = psutil.disk_usage(p.mountpoint)
+            except OSError:
+                continue
+            result.append({
+                'device_name': p.device,
+                'fs_type': p.fstype,
+                'mnt_point': p.mountpoint,
+                'size': usage.total,
+                'used': usage.used,
+                'free': usage.free,
+                'percent': usage.percent,
+            })
+        return result
+
+    def network(self):
+        """ Return the traffic of each network interface """
+        counters = dict(
+            (name, {'rx': c.bytes_recv, 'tx': c.bytes_sent})
+            for name, c in psutil.net_io_counters(pernic=True).items())
+        result = []
+        samples = self._sample('network', counters)
+        for name, (elapsed, deltas) in samples.items():
+            result.append({
+                'interface_name': name,
+                'time_since_update': elapsed,
+                'rx': deltas['rx'],
+                'tx': deltas['tx'],
+                'cx': deltas['rx'] + deltas['tx'],
+                'cumulative_rx': counters[name]['rx'],
+                'cumulative_tx': counters[name]['tx'],
+                'cumulative_cx': counters[name]['rx'] + counters[name]['tx'],
+            })
+        return result
+
+    def memory(self):
+        """ Return the usage of the memory """
+        return dict(psutil.virtual_memory()._asdict())
+
+    def swap(self):
+        """ Return the usage of the swap """
+        return dict(psutil.swap_memory()._asdict())
+
+    def load(self):
+        """ Return the load average """
+        min1, min5, min15 = os.getloadavg()
+        return {
+            'min1': min1,
+            'min5': min5,
+            'min15': min15,
+            'cpucore': psutil.cpu_count(),
+        }
+
+    def cpu(self):
+        """ Return the percentage of CPU time spent in each mode """
+        counters = {'cpu': dict(psutil.cpu_times()._asdict())}
+        elapsed, deltas = self._sample('cpu', counters)['cpu']
+
+        # Guest times are already counted in the user ones
+        total = sum(v for k, v in deltas.items()
+                    if k not in ('guest', 'guest_nice'))
+        if total <= 0:
+            # No time elapsed since the previous sample
+            return dict.fromkeys(deltas.keys() + ['total'], 0.0)
+        result = dict((k, round(100.0 * v / total, 1))
+                      for k, v in deltas.items())
+        result['total'] = round(100.0 - result['idle'], 1)
+        return result
 
-    if service_status('glances')['status'] != 'running':
-        raise MoulinetteError(errno.EPERM, m18n.n('monitor_not_enabled'))
-    raise MoulinetteError(errno.EIO, m18n.n('monitor_glances_con_failed'))
+    def process_count(self):
+        """ Return the number of processes by state and of threads """
+        result = {'total': 0, 'running': 0, 'sleeping': 0, 'thread': 0}
+        for pid in psutil.pids():
+            try:
+                with open('/proc/%d/stat' % pid) as f:
+                    stat = f.read()
+            except IOError:
+                # The process has ended
+                continue
+            # Fields following the command name, from the state one
+            fields = stat[stat.rfind(')') + 2:].split()
+            result['total'] += 1
+            result['thread'] += int(fields[17])
+            if fields[0] == 'R':
+                result['running'] += 1
+            elif fields[0] == 'S':
+                result['sleeping'] += 1
+        return result
+
+    def apps(self):
+        """
+        Return the CPU, memory and I/O usage of each app
+
+        The processes of an app are the ones of its services, i.e. of their
+        systemd cgroup, the ones of its system user and the ones working in
+        its directory. As systemd doesn't account the resources of each
+        unit by default, counters are read for each process and added up.
+
+        """
+        app_ids, units, users, paths = _get_apps_owners()
+        page_size = os.sysconf('SC_PAGE_SIZE')
+        clock_ticks = os.sysconf('SC_CLK_TCK')
+
+        result = dict((app, {'cpu': 0.0, 'memory': 0, 'read_bytes': 0,
+                             'write_bytes': 0, 'processes': 0})
+                      for app in app_ids)
+        counters = {}
+        processes = {}
+        for pid in psutil.pids():
+            try:
+                with open('/proc/%d/stat' % pid) as f:
+                    stat = f.read()
+                with open('/proc/%d/cgroup' % pid) as f:
+                    m = re.search(r'/([^/\s]+)\.service$', f.read(), re.M)
+                uid = os.stat('/proc/%d' % pid).st_uid
+            except (IOError, OSError):
+                # The process has ended
+                continue
+
+            app = units.get(m.group(1)) if m else None
+            if app is None:
+                app = users.get(uid)
+            if app is None and paths:
+                try:
+                    cwd = os.readlink('/proc/%d/cwd' % pid)
+                except OSError:
+                    cwd = ''
+                for path, a in paths:
+                    if cwd == path or cwd.startswith(path + '/'):
+                        app = a
+                        break
+            if app is None:
+                continue
+
+            # Fields following the command name, from the state one
+            fields = stat[stat.rfind(')') + 2:].split()
+            io = {'read_bytes': 0, 'write_bytes': 0}
+            try:
+                with open('/proc/%d/io' % pid) as f:
+                    for line in f:
+                        k, v = line.split(':')
+                        if k in io:
+                            io[k] = int(v)
+            except IOError:
+                pass
+
+            # Identify the process by its start time too as PIDs are reused
+            key = '%d-%s' % (pid, fields[19])
+            counters[key] = dict(io, cpu=int(fields[11]) + int(fields[12]))
+            processes[key] = app
+            result[app]['memory'] += int(fields[21]) * page_size
+            result[app]['processes'] += 1
+
+        samples = self._sample('apps', counters)
+        # Processes which weren't sampled yet have started since the
+        # previous sample, unless there is none
+        elapsed = min([e for e, _ in samples.values()] or
+                      [time.time() - psutil.boot_time()])
+        for key, (_, deltas) in samples.items():
+            usage = result[processes[key]]
+            usage['cpu'] += deltas['cpu']
+            usage['read_bytes'] += deltas['read_bytes']
+            usage['write_bytes'] += deltas['write_bytes']
+        for usage in result.values():
+            # CPU time is in clock ticks, the percentage is of one CPU
+            usage['cpu'] = round(100.0 * usage['cpu'] / clock_ticks / elapsed,
+                                 1) if elapsed > 0 else 0.0
+            usage['time_since_update'] = elapsed
+        return result
+
+    def system_infos(self):
+        """ Return informations about the operating system """
+        linux_distro = ' '.join(platform.linux_distribution()[:2])
+        arch = platform.architecture()[0]
+        return {
+            'os_name': platform.system(),
+            'hostname': platform.node(),
+            'platform': arch,
+            'linux_distro': linux_distro,
+            'os_version': platform.release(),
+            'hr_name': '%s %s' % (linux_distro, arch),
+        }
+
+    def _sample(self, kind, counters):
+        """
+        Record a sample of some counters by name and return, for each name,
+        the time elapsed and the difference of the counters since the
+        previous sample
+
+        """
+        now = time.time()
+        boot_time = psutil.boot_time()
+        samples = self._load_samples()
+        previous = samples.get(kind)
+        samples[kind] = {'time': now, 'counters': counters}
+        self._save_samples()
+
+        if previous is None or previous['time'] < boot_time:
+            previous = {'time': boot_time, 'counters': {}}
+        result = {}
+        for name, values in counters.items():
+            last = previous['counters'].get(name)
+            if last is None or any(v < last.get(k, 0)
+                                   for k, v in values.items()):
+                # Counters which weren't sampled yet or have been reset
+                result[name] = (now - boot_time, dict(values))
+            else:
+                result[name] = (now - previous['time'],
+                                dict((k, v - last.get(k, 0))
+                                     for k, v in values.items()))
+        return result
+
+    def _load_samples(self):
+        # Reload the file each time since other processes update it
+        if self.state_path is not None:
+            try:
+                with open(self.state_path) as f:
+                    self._samples = json.load(f)
+            except (IOError, ValueError):
+                pass
+        if self._samples is None:
+            self._samples = {}
+        return self._samples
+
+    def _save_samples(self):
+        if self.state_path is None:
+            return
+        try:
+            if not os.path.isdir(os.path.dirname(self.state_path)):
+                os.makedirs(os.path.dirname(self.state_path))
+            tmp_path = '%s.%d' % (self.state_path, os.getpid())
+            with open(tmp_path, 'w') as f:
+                json.dump(self._samples, f)
+            os.rename(tmp_path, self.state_path)
+        except (IOError, OSError) as e:
+            logger.debug('unable to save the monitoring counters: %s', e)
 
 
 def _extract_inet(string, skip_netmask=False, skip_loopback=True):
@@ -538,206 +899,1094 @@ def binary_to_human(n, customary=False):
     return "%s" % n
 
 
-def _retrieve_stats(period, date=None):
+def _retrieve_stats(period, t_begin=None, t_end=None, missing=None):
     """
-    Retrieve statistics from pickle file
+    Retrieve statistics from the stats store
 
     Keyword argument:
         period -- Time period to retrieve (day, week, month)
-        date -- Date of stats to retrieve
+        t_begin -- Beginning timestamp (default: the beginning of the period
+            before the last statistics)
+        t_end -- Ending timestamp
+        missing -- Value of the missing statistics
+
+    Returns:
+        A dict of stats with a list of values for each statistic and a
+        'timestamp' list, False if there is no stats for this period or None
+        if there is no stats in the range
 
     """
-    pkl_file = None
+    store = _StatsStore(period)
+    _import_legacy_stats(store)
+    if not store.exists():
+        return False
 
-    # Retrieve pickle file
-    if date is not None:
-        timestamp = calendar.timegm(date)
-        pkl_file = '%s/%d_%s.pkl' % (STATS_PATH, timestamp, period)
-    else:
-        pkl_file = '%s/%s.pkl' % (STATS_PATH, period)
-    if not os.path.isfile(pkl_file):
+    timestamps, columns, statics = _read_stats(store, t_begin, t_end)
+    if not timestamps:
+        return None
+    return _stats_to_dict(timestamps, columns, statics, missing)
+
+
+def _summarize_stats(period, t_begin=None, t_end=None):
+    """
+    Calculate the mean, min, max and percentiles of each statistic
+
+    Keyword argument:
+        period -- Time period of the stats (day, week, month)
+        t_begin -- Beginning timestamp (default: the beginning of the period
+            before the last statistics)
+        t_end -- Ending timestamp
+
+    Returns:
+        A dict with the aggregates of each column in 'values', the static
+        values in 'statics' and the first and last timestamps, False if
+        there is no stats for this period or None if there is no stats in
+        the range
+
+    """
+    store = _StatsStore(period)
+    _import_legacy_stats(store)
+    if not store.exists():
         return False
 
-    # Read file and process its content
-    with open(pkl_file, 'r') as f:
-        result = pickle.load(f)
-    if not isinstance(result, dict):
+    timestamps, columns, statics = _read_stats(store, t_begin, t_end)
+    if not timestamps:
         return None
-    return result
+    # The first row is measured since the row before the range
+    previous = store.timestamp_before(timestamps[0])
+    return _summarize_columns(timestamps, columns, statics, previous)
+
+
+def _summarize_columns(timestamps, columns, statics, previous=None):
+    """ Calculate the aggregates of each column of stats """
+    # The weights are the same for all the columns
+    weights = _interval_weights(timestamps, previous)
+    values = {}
+    for name, column in columns.items():
+        aggregates = _aggregate(column, weights)
+        if aggregates is not None:
+            values[name] = aggregates
+
+    return {
+        'values': values,
+        'statics': statics,
+        'begin': timestamps[0],
+        'end': timestamps[-1],
+    }
 
 
-def _save_stats(stats, period, date=None):
+def _update_stats(store, timestamp, values, statics):
+    """ Append a row of stats to a store and limit it to its period """
+    store.append(timestamp, values, statics)
+    store.trim(STATS_PERIODS[store.period])
+
+
+def _read_stats(store, t_begin=None, t_end=None):
+    """ Read the stats of a range, by default the last period """
+    if t_begin is None and t_end is None:
+        last = store.last_timestamp()
+        if last is not None:
+            t_begin = last - STATS_PERIODS[store.period]
+    return store.read(t_begin, t_end)
+
+
+def _interval_weights(timestamps, previous=None):
     """
-    Save statistics to pickle file
+    Return the weight of each row of statistics, i.e. the time since the
+    previous row, as the values are measured over this interval. Without
+    the timestamp of the row before the first one, the first row is
+    weighted as the next interval.
 
     Keyword argument:
-        stats -- Stats dict to save
-        period -- Time period of stats (day, week, month)
-        date -- Date of stats
+        timestamps -- Array of the timestamps
+        previous -- Timestamp of the row before the first one, if any
 
     """
-    pkl_file = None
+    if previous is not None and timestamps:
+        weights = array('d', [timestamps[0] - previous])
+    elif len(timestamps) < 2:
+        return array('d', [1.0] * len(timestamps))
+    else:
+        weights = array('d', [timestamps[1] - timestamps[0]])
+    weights.extend(b - a for a, b in izip(timestamps,
+                                          islice(timestamps, 1, None)))
+    return weights
 
-    # Set pickle file name
-    if date is not None:
-        timestamp = calendar.timegm(date)
-        pkl_file = '%s/%d_%s.pkl' % (STATS_PATH, timestamp, period)
+
+def _aggregate(values, weights, percentiles=STATS_PERCENTILES):
+    """
+    Calculate the interval-weighted mean, the min, the max and the weighted
+    percentiles of a column, missing values (NaN) being ignored
+
+    Keyword argument:
+        values -- Array of the values
+        weights -- Array of the weight of each value
+        percentiles -- Percentiles to calculate
+
+    Returns:
+        A dict of aggregates, with a 'pXX' key for each percentile, or None
+        if there is no value
+
+    """
+    pairs = sorted((v, w) for v, w in izip(values, weights) if v == v)
+    if not pairs:
+        return None
+
+    total = sum(w for _, w in pairs)
+    if total > 0:
+        mean = sum(v * w for v, w in pairs) / total
     else:
-        pkl_file = '%s/%s.pkl' % (STATS_PATH, period)
-    if not os.path.isdir(STATS_PATH):
-        os.makedirs(STATS_PATH)
+        mean = sum(v for v, _ in pairs) / len(pairs)
+
+    result = {'mean': mean, 'min': pairs[0][0], 'max': pairs[-1][0]}
+
+    # The pXX percentile is the first value for which XX% of the time is
+    # covered by this value or lower ones
+    cumulated = 0.0
+    remaining = sorted(percentiles)
+    for v, w in pairs:
+        cumulated += w
+        while remaining and cumulated >= total * remaining[0] / 100.0:
+            result['p%d' % remaining.pop(0)] = v
+    for p in remaining:
+        result['p%d' % p] = pairs[-1][0]
+
+    return result
 
-    # Limit stats
-    if date is None:
-        t = stats['timestamp']
-        limit = {'day': 86400, 'week': 604800, 'month': 2419200}
-        if (t[len(t) - 1] - t[0]) > limit[period]:
-            begin = t[len(t) - 1] - limit[period]
-            stats = _filter_stats(stats, begin)
 
-    # Write file content
-    with open(pkl_file, 'w') as f:
-        pickle.dump(stats, f)
-    return True
+def _summary_to_dict(summary):
+    """ Build the stats dict with the aggregates of each statistic """
+    result = {'disk': {}, 'network': {}, 'system': {}}
+    _merge_nested(result, summary['statics'])
+    for name, aggregates in summary['values'].items():
+        _set_nested(result, _column_keys(name), aggregates)
+    result['timestamp'] = [summary['begin'], summary['end']]
+    return result
 
 
-def _monitor_all(period=None, since=None):
+def _import_legacy_stats(store):
     """
-    Monitor all units (disk, network and system) for the given period
-    If since is None, real-time monitoring is returned. Otherwise, the
-    mean of stats since this timestamp is calculated and returned.
+    Import statistics of a period from its legacy pickle file into the store
 
     Keyword argument:
-        period -- Time period to monitor (day, week, month)
-        since -- Timestamp of the stats beginning
+        store -- The _StatsStore of the period
 
     """
-    result = {'disk': {}, 'network': {}, 'system': {}}
+    pkl_file = '%s/%s.pkl' % (STATS_PATH, store.period)
+    if store.exists() or not os.path.isfile(pkl_file):
+        return
 
-    # Real-time stats
-    if period == 'day' and since is None:
-        result['disk'] = monitor_disk()
-        result['network'] = monitor_network()
-        result['system'] = monitor_system()
-        return result
+    try:
+        with open(pkl_file, 'r') as f:
+            stats = pickle.load(f)
+        timestamps = stats.pop('timestamp')
+    except Exception:
+        logger.warning("unable to import legacy statistics from '%s'",
+                       pkl_file, exc_info=1)
+        return
+
+    columns = {}
+    statics = {}
+
+    def _import(keys, value):
+        if isinstance(value, dict):
+            for k, v in value.items():
+                _import(keys + (k,), v)
+        elif isinstance(value, list) and all(_is_number(v) for v in value):
+            # Statistics which appeared later have less values, the values
+            # are the ones of the last timestamps
+            nan = float('nan')
+            values = [nan] * (len(timestamps) - len(value)) + value
+            columns[_column_name(keys)] = array(
+                'd', [float(v) for v in values[len(values) - len(timestamps):]])
+        else:
+            _set_nested(statics, keys, value)
 
-    # Retrieve stats and calculate mean
-    stats = _retrieve_stats(period)
-    if not stats:
-        return None
-    stats = _filter_stats(stats, since)
-    if not stats:
-        return None
-    result = _calculate_stats_mean(stats)
+    _import((), stats)
+    store.write(array('d', timestamps), columns, statics)
+    os.remove(pkl_file)
+
+
+def _flatten_stats(monitor):
+    """
+    Split monitoring statistics into numeric values and static values
+
+    Keyword argument:
+        monitor -- Monitoring statistics of disk, network, system and apps
+            units
+
+    Returns:
+        A tuple of a dict of values by column name, and a dict of static
+        values (like the filesystem type) with the same layout as monitor
+
+    """
+    values = {}
+    statics = {}
+
+    def _flatten(keys, value):
+        if isinstance(value, dict):
+            for k, v in value.items():
+                _flatten(keys + (k,), v)
+        elif keys[-1] in STATS_STATIC_KEYS or not _is_number(value):
+            _set_nested(statics, keys, value)
+        else:
+            values[_column_name(keys)] = float(value)
+
+    # Units which don't contain stats (e.g. 'not-available') are skipped
+    for dname, units in monitor['disk'].items():
+        for unit, unit_values in units.items():
+            if isinstance(unit_values, dict):
+                _flatten(('disk', dname, unit), unit_values)
+    for iname, usage in monitor['network'].get('usage', {}).items():
+        if isinstance(usage, dict):
+            _flatten(('network', 'usage', iname), usage)
+    if 'infos' in monitor['network']:
+        _set_nested(statics, ('network', 'infos'), monitor['network']['infos'])
+    for unit, unit_values in monitor['system'].items():
+        if not isinstance(unit_values, dict):
+            continue
+        if unit == 'infos':
+            _set_nested(statics, ('system', unit), unit_values)
+        else:
+            _flatten(('system', unit), unit_values)
+    for app, usage in monitor.get('apps', {}).items():
+        _flatten(('apps', app), usage)
+
+    return values, statics
+
+
+def _stats_to_dict(timestamps, columns, statics, missing=None):
+    """
+    Build the stats dict from the columns of the stats store
+
+    Keyword argument:
+        timestamps -- Array of the timestamps
+        columns -- Dict of arrays of values by column name
+        statics -- Dict of static values
+        missing -- Value of the missing statistics (NaN in the store)
+
+    """
+    result = {'disk': {}, 'network': {}, 'system': {}}
+    _merge_nested(result, statics)
+
+    for name, column in columns.items():
+        values = [missing if math.isnan(v) else v for v in column]
+        _set_nested(result, _column_keys(name), values)
+    result['timestamp'] = list(timestamps)
 
     return result
 
 
-def _filter_stats(stats, t_begin=None, t_end=None):
+def _column_name(keys):
+    """ Return the name of the column of a statistic from its keys """
+    return '.'.join(urllib.quote(str(k), safe='').replace('.', '%2E')
+                    for k in keys)
+
+
+def _column_keys(name):
+    """ Return the keys of a statistic from the name of its column """
+    return tuple(urllib.unquote(k) for k in name.split('.'))
+
+
+def _is_number(value):
+    """ Return whether a value is a number, booleans not being numbers """
+    return isinstance(value, (int, long, float)) and not isinstance(value, bool)
+
+
+def _set_nested(d, keys, value):
+    """ Set a value in nested dicts by its keys, creating the missing ones """
+    for k in keys[:-1]:
+        d = d.setdefault(k, {})
+    d[keys[-1]] = value
+
+
+def _merge_nested(d, other):
+    """ Recursively merge the nested dicts of other into d """
+    for k, v in other.items():
+        if isinstance(v, dict) and isinstance(d.get(k), dict):
+            _merge_nested(d[k], v)
+        else:
+            d[k] = v
+
+
+class _StatsStore(object):
+    """
+    Columnar store of the statistics of a period
+
+    Each statistic is a column, i.e. a file of fixed-width doubles in the
+    directory of the period, as well as their timestamps. A row of values is
+    appended to every column at once, so that the Nth value of each column
+    was recorded at the Nth timestamp, and a missing value is stored as NaN.
+    Appending a row doesn't depend on the size of the history, and ranges of
+    rows are found by binary search on the timestamps.
+
+    Non-numeric values, like the filesystem type, are only kept for the last
+    row in a static.json file.
+
+    """
+
+    TIMESTAMP = 'timestamp'
+    ITEM_SIZE = array('d').itemsize
+
+    def __init__(self, period):
+        self.period = period
+        self.path = os.path.join(STATS_PATH, period)
+
+    def exists(self):
+        return os.path.isfile(self._column_path(self.TIMESTAMP))
+
+    def columns(self):
+        """ Return the names of the columns of statistics """
+        if not os.path.isdir(self.path):
+            return []
+        return [f[:-len('.col')] for f in os.listdir(self.path)
+                if f.endswith('.col') and f != self.TIMESTAMP + '.col']
+
+    def last_timestamp(self):
+        """ Return the timestamp of the last row, or None """
+        with self._lock(shared=True):
+            rows = self._rows(self.TIMESTAMP)
+            if rows == 0:
+                return None
+            with open(self._column_path(self.TIMESTAMP), 'rb') as f:
+                return self._value_at(f, rows - 1)
+
+    def timestamp_before(self, t):
+        """ Return the timestamp of the last row before t, or None """
+        with self._lock(shared=True):
+            rows = self._rows(self.TIMESTAMP)
+            if rows == 0:
+                return None
+            with open(self._column_path(self.TIMESTAMP), 'rb') as f:
+                i = self._bisect(f, rows, t, right=False)
+                if i == 0:
+                    return None
+                return self._value_at(f, i - 1)
+
+    def append(self, timestamp, values, statics):
+        """
+        Append a row of statistics
+
+        Keyword argument:
+            timestamp -- Timestamp of the statistics
+            values -- Dict of values by column name
+            statics -- Dict of static values, replacing the previous ones
+
+        """
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+
+        nan = float('nan')
+        with self._lock():
+            rows = self._rows(self.TIMESTAMP)
+            for name in set(self.columns()) | set(values):
+                # New columns (and columns of an interrupted append) are
+                # padded, so that all the columns have the same rows
+                with open(self._column_path(name), 'ab') as f:
+                    self._resize(f, name, rows)
+                    array('d', [values.get(name, nan)]).tofile(f)
+            with open(self._column_path(self.TIMESTAMP), 'ab') as f:
+                array('d', [timestamp]).tofile(f)
+            self._write_statics(statics)
+
+    def read(self, t_begin=None, t_end=None):
+        """
+        Read the rows of statistics recorded between two timestamps
+
+        Keyword argument:
+            t_begin -- Beginning timestamp (included)
+            t_end -- Ending timestamp (included)
+
+        Returns:
+            A tuple of the timestamps array, a dict of values arrays by
+            column name and the dict of static values
+
+        """
+        with self._lock(shared=True):
+            rows = self._rows(self.TIMESTAMP)
+            with open(self._column_path(self.TIMESTAMP), 'rb') as f:
+                i = 0 if t_begin is None else \
+                    self._bisect(f, rows, t_begin, right=False)
+                j = rows if t_end is None else \
+                    self._bisect(f, rows, t_end, right=True)
+                timestamps = self._read_column(f, i, max(i, j))
+
+            columns = {}
+            for name in self.columns():
+                with open(self._column_path(name), 'rb') as f:
+                    columns[name] = self._read_column(f, i, max(i, j))
+
+            statics = {}
+            if os.path.isfile(self._statics_path()):
+                with open(self._statics_path()) as f:
+                    statics = json.load(f)
+
+        return timestamps, columns, statics
+
+    def write(self, timestamps, columns, statics):
+        """
+        Replace all the statistics
+
+        Keyword argument:
+            timestamps -- Array of the timestamps
+            columns -- Dict of values arrays by column name, of the same
+                length as timestamps
+            statics -- Dict of static values
+
+        """
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+
+        with self._lock():
+            for name in self.columns():
+                if name not in columns:
+                    os.remove(self._column_path(name))
+            for name, values in columns.items() + [(self.TIMESTAMP,
+                                                    timestamps)]:
+                tmp_path = self._column_path(name) + '.tmp'
+                with open(tmp_path, 'wb') as f:
+                    values.tofile(f)
+                os.rename(tmp_path, self._column_path(name))
+            self._write_statics(statics)
+
+    def trim(self, retention):
+        """
+        Remove the rows older than the retention before the last row
+
+        To keep appending cheap, the columns are only rewritten once the rows
+        to remove span the retention, i.e. they are at most twice as long as
+        needed.
+
+        Keyword argument:
+            retention -- Duration to keep, in seconds
+
+        """
+        with self._lock():
+            rows = self._rows(self.TIMESTAMP)
+            if rows == 0:
+                return
+            with open(self._column_path(self.TIMESTAMP), 'rb') as f:
+                first = self._value_at(f, 0)
+                last = self._value_at(f, rows - 1)
+                if last - first <= 2 * retention:
+                    return
+                i = self._bisect(f, rows, last - retention, right=False)
+
+            for name in self.columns() + [self.TIMESTAMP]:
+                path = self._column_path(name)
+                with open(path, 'rb') as f:
+                    values = self._read_column(f, i, rows)
+                with open(path + '.tmp', 'wb') as f:
+                    values.tofile(f)
+                os.rename(path + '.tmp', path)
+
+    def _column_path(self, name):
+        return os.path.join(self.path, name + '.col')
+
+    def _statics_path(self):
+        return os.path.join(self.path, 'static.json')
+
+    def _rows(self, name):
+        try:
+            return os.path.getsize(self._column_path(name)) // self.ITEM_SIZE
+        except OSError:
+            return 0
+
+    def _resize(self, f, name, rows):
+        """ Pad with NaN or truncate a column opened for appending """
+        current = self._rows(name)
+        if current < rows:
+            (array('d', [float('nan')]) * (rows - current)).tofile(f)
+        elif current > rows:
+            f.truncate(rows * self.ITEM_SIZE)
+
+    def _value_at(self, f, i):
+        f.seek(i * self.ITEM_SIZE)
+        return struct.unpack('d', f.read(self.ITEM_SIZE))[0]
+
+    def _bisect(self, f, rows, t, right):
+        """ Return the index where to insert t in the timestamps column """
+        lo, hi = 0, rows
+        while lo < hi:
+            mid = (lo + hi) // 2
+            v = self._value_at(f, mid)
+            if v < t or (right and v == t):
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def _read_column(self, f, i, j):
+        """ Read rows [i, j) of a column, padding it with NaN if needed """
+        values = array('d')
+        f.seek(i * self.ITEM_SIZE)
+        try:
+            values.fromfile(f, j - i)
+        except EOFError:
+            values.extend([float('nan')] * (j - i - len(values)))
+        return values
+
+    def _write_statics(self, statics):
+        with open(self._statics_path() + '.tmp', 'w') as f:
+            json.dump(statics, f)
+        os.rename(self._statics_path() + '.tmp', self._statics_path())
+
+    def _lock(self, shared=False):
+        return _FileLock(os.path.join(self.path, '.lock'), shared)
+
+
+class _FileLock(object):
+    """ Context manager holding a flock on a file """
+
+    def __init__(self, path, shared=False):
+        self.path = path
+        self.shared = shared
+        self.file = None
+
+    def __enter__(self):
+        if not os.path.isdir(os.path.dirname(self.path)):
+            return self
+        self.file = open(self.path, 'a')
+        fcntl.flock(self.file, fcntl.LOCK_SH if self.shared else fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, *args):
+        if self.file is not None:
+            fcntl.flock(self.file, fcntl.LOCK_UN)
+            self.file.close()
+
+
+def _monitor_all():
+    """
+    Monitor all units (disk, network, system and apps) in real-time
+
+    """
+    return {
+        'disk': monitor_disk(),
+        'network': monitor_network(),
+        'system': monitor_system(),
+        'apps': monitor_apps(),
+    }
+
+
+def _sample_monitor():
+    """
+    Monitor the disk, network, system and apps usage without spawning any
+    process
+
+    """
+    collector = _get_collector()
+    return {
+        'disk': monitor_disk(),
+        'network': {
+            'usage': dict((i.pop('interface_name'), i)
+                          for i in collector.network()),
+        },
+        'system': monitor_system(units=['memory', 'cpu', 'process']),
+        'apps': monitor_apps(),
+    }
+
+
+def run_sampler(interval=1, metrics_port=None):
+    """
+    Run the monitoring sampler until it is terminated
+
+    The disk, network and system usage is sampled every interval into a ring
+    buffer, which is served on the sampler socket, and the statistics are
+    updated from the samples. The state of the server is refreshed in the
+    background to be exported with the last sample.
+
+    Keyword argument:
+        interval -- Time between two samples, in seconds
+        metrics_port -- Port on which to also serve the exported metrics over
+            HTTP on localhost
+
+    """
+    sampler = _Sampler(interval, metrics_port=metrics_port)
+    signal.signal(signal.SIGTERM, lambda signum, frame: sampler.stop())
+    sampler.run()
+
+
+def _request_sampler(request):
     """
-    Filter statistics by beginning and/or ending timestamp
+    Send a request to the sampler and return its response
+
+    Keyword argument:
+        request -- Dict of the request
+
+    """
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.settimeout(10)
+    try:
+        sock.connect(SAMPLER_SOCKET_PATH)
+        sock.sendall(json.dumps(request) + '\n')
+        return sock.makefile('r').read()
+    except socket.error as e:
+        logger.debug('unable to query the monitoring sampler: %s', e)
+        raise MoulinetteError(errno.ECONNREFUSED,
+                              m18n.n('monitor_sampler_not_running'))
+    finally:
+        sock.close()
+
+
+def _query_sampler(t_begin=None, t_end=None):
+    """
+    Retrieve the samples of a range from the ring buffer of the sampler
 
     Keyword argument:
-        stats -- Dict stats to filter
         t_begin -- Beginning timestamp
         t_end -- Ending timestamp
 
+    Returns:
+        A tuple of the array of the timestamps, the dict of arrays of values
+        by column name and the dict of static values of the last sample
+
     """
-    if t_begin is None and t_end is None:
-        return stats
-
-    i_begin = i_end = None
-    # Look for indexes of timestamp interval
-    for i, t in enumerate(stats['timestamp']):
-        if t_begin and i_begin is None and t >= t_begin:
-            i_begin = i
-        if t_end and i != 0 and i_end is None and t > t_end:
-            i_end = i
-    # Check indexes
-    if i_begin is None:
-        if t_begin and t_begin > stats['timestamp'][0]:
-            return None
-        i_begin = 0
-    if i_end is None:
-        if t_end and t_end < stats['timestamp'][0]:
-            return None
-        i_end = len(stats['timestamp'])
-    if i_begin == 0 and i_end == len(stats['timestamp']):
-        return stats
-
-    # Filter function
-    def _filter(s, i, j):
-        for k, v in s.items():
-            if isinstance(v, dict):
-                s[k] = _filter(v, i, j)
-            elif isinstance(v, list):
-                s[k] = v[i:j]
-        return s
-
-    stats = _filter(stats, i_begin, i_end)
-    return stats
-
-
-def _calculate_stats_mean(stats):
-    """
-    Calculate the weighted mean for each statistic
+    try:
+        response = json.loads(_request_sampler({'begin': t_begin,
+                                                'end': t_end}))
+    except ValueError:
+        # The sampler has been stopped while answering
+        raise MoulinetteError(errno.ECONNREFUSED,
+                              m18n.n('monitor_sampler_not_running'))
+
+    columns = dict((name, array('d', values))
+                   for name, values in response['columns'].items())
+    return array('d', response['timestamps']), columns, response['statics']
+
+
+class _Sampler(object):
+    """
+    Sample the monitoring statistics in a ring buffer
+
+    The last samples are kept in memory and served on a local socket. Every
+    interval of the day statistics, the samples since the previous update
+    are summed up - for counters of the time since the previous sample - or
+    averaged into a new row of statistics. The week and month statistics
+    are then rolled up at their own interval.
+
+    The state of the server - services, certificates, backups... - is also
+    refreshed in a thread to be exported with the last sample, since getting
+    it may take some time and spawn processes.
 
     Keyword argument:
-        stats -- Stats dict to process
+        interval -- Time between two samples, in seconds
+        size -- Maximum number of samples to keep in memory
+        metrics_port -- Port on which to serve the exported metrics over
+            HTTP on localhost, if any
 
     """
-    timestamp = stats['timestamp']
-    t_sum = sum(timestamp)
-    del stats['timestamp']
 
-    # Weighted mean function
-    def _mean(s, t, ts):
-        for k, v in s.items():
-            if isinstance(v, dict):
-                s[k] = _mean(v, t, ts)
-            elif isinstance(v, list):
-                try:
-                    nums = [float(x * t[i]) for i, x in enumerate(v)]
-                except:
-                    pass
+    def __init__(self, interval=1, size=SAMPLER_BUFFER_SIZE,
+                 metrics_port=None):
+        self.interval = interval
+        self.samples = deque(maxlen=size)
+        self.lock = threading.Lock()
+        self.last_update = time.time()
+        self.stopped = False
+        self.metrics_port = metrics_port
+        self.exports = {}
+
+    def run(self):
+        global _collector
+
+        # Counters are sampled in memory, between two samples rather than
+        # two commands
+        _collector = _MetricsCollector()
+        # Sample them once so that the first sample isn't since the boot
+        _sample_monitor()
+
+        server = _SamplerServer(SAMPLER_SOCKET_PATH, self)
+        servers = [server]
+        if self.metrics_port:
+            servers.append(_MetricsServer(('127.0.0.1', self.metrics_port),
+                                          self))
+        for target in [s.serve_forever for s in servers] + \
+                [self._refresh_exports_forever]:
+            thread = threading.Thread(target=target)
+            thread.daemon = True
+            thread.start()
+
+        logger.info('sampling monitoring statistics every %ss',
+                    self.interval)
+        try:
+            next_sample = time.time()
+            while not self.stopped:
+                self.sample()
+                if time.time() - self.last_update >= \
+                        STATS_UPDATE_INTERVALS['day']:
+                    self.update_stats()
+
+                next_sample += self.interval
+                delay = next_sample - time.time()
+                if delay > 0:
+                    time.sleep(delay)
                 else:
-                    s[k] = sum(nums) / float(ts)
-        return s
+                    # Don't try to catch up on missed samples
+                    next_sample = time.time()
+        finally:
+            for s in servers:
+                s.shutdown()
+                s.server_close()
+            try:
+                os.remove(SAMPLER_SOCKET_PATH)
+            except OSError:
+                pass
+            self.update_stats()
 
-    stats = _mean(stats, timestamp, t_sum)
-    return stats
+    def stop(self):
+        self.stopped = True
 
+    def sample(self):
+        """ Append a sample of the statistics to the ring buffer """
+        timestamp = time.time()
+        try:
+            values, statics = _flatten_stats(_sample_monitor())
+        except Exception:
+            logger.warning('unable to sample the monitoring statistics',
+                           exc_info=1)
+            return
+        with self.lock:
+            self.samples.append((timestamp, values, statics))
+
+    def export(self):
+        """
+        Return the last sample and the state of the server in the
+        OpenMetrics text format
+
+        """
+        families = {}
+        with self.lock:
+            values = self.samples[-1][1] if self.samples else {}
+            for source in sorted(self.exports):
+                families.update(self.exports[source][1])
+        for name, value in values.items():
+            metric, labels = _column_metric(name)
+            if metric not in families:
+                families[metric] = ('Monitoring statistic %s' %
+                                    _column_keys(name)[-1], [])
+            families[metric][1].append((labels, value))
+        return _format_openmetrics(families)
+
+    def refresh_exports(self):
+        """ Refresh the state of the server whose interval has elapsed """
+        for source in sorted(EXPORT_REFRESH_INTERVALS):
+            last = self.exports.get(source, (None,))[0]
+            now = time.time()
+            if last is not None and \
+                    now - last < EXPORT_REFRESH_INTERVALS[source]:
+                continue
+            try:
+                families = _EXPORTERS[source]()
+            except Exception:
+                logger.warning("unable to export the state of '%s'", source,
+                               exc_info=1)
+                # Try again at the next interval, without the stale state
+                families = {}
+            with self.lock:
+                self.exports[source] = (now, families)
+
+    def _refresh_exports_forever(self):
+        while not self.stopped:
+            self.refresh_exports()
+            time.sleep(1)
+
+    def select(self, t_begin=None, t_end=None):
+        """
+        Return the timestamps, the columns of values and the statics of the
+        samples from t_begin (included) to t_end (excluded)
+
+        """
+        with self.lock:
+            samples = [s for s in self.samples
+                       if (t_begin is None or s[0] >= t_begin) and
+                       (t_end is None or s[0] < t_end)]
+
+        nan = float('nan')
+        names = set()
+        for _, values, _ in samples:
+            names.update(values)
+        columns = dict((name, array('d', [v.get(name, nan)
+                                          for _, v, _ in samples]))
+                       for name in names)
+        statics = deepcopy(samples[-1][2]) if samples else {}
+        return array('d', [s[0] for s in samples]), columns, statics
+
+    def update_stats(self):
+        """ Update the statistics with the samples since the last update """
+        now = time.time()
+        timestamps, columns, statics = self.select(self.last_update, now)
+        elapsed = now - self.last_update
+        self.last_update = now
+        if not timestamps:
+            return
+
+        weights = _interval_weights(timestamps)
+        values = {}
+        for name, column in columns.items():
+            present = [v for v in column if v == v]
+            if not present:
+                continue
+            if _column_keys(name)[-1] in STATS_DELTA_KEYS:
+                values[name] = math.fsum(present)
+            else:
+                values[name] = _aggregate(column, weights)['mean']
+        _set_static_key(statics, 'time_since_update', elapsed)
+
+        try:
+            store = _StatsStore('day')
+            _import_legacy_stats(store)
+            _update_stats(store, now, values, statics)
+
+            for period in ('week', 'month'):
+                last = _StatsStore(period).last_timestamp()
+                if last is None or \
+                        now - last >= STATS_UPDATE_INTERVALS[period]:
+                    monitor_update_stats(period)
+        except MoulinetteError as e:
+            logger.warning(e.strerror)
+        except Exception:
+            logger.warning('unable to update the monitoring statistics',
+                           exc_info=1)
+
+
+class _SamplerRequestHandler(SocketServer.StreamRequestHandler):
+    """
+    Answer a JSON request of a range of samples by the samples, or a request
+    of the export by the exported metrics
 
-def _append_to_stats(stats, monitor, statics=[]):
     """
-    Append monitoring statistics to current statistics
+
+    def handle(self):
+        try:
+            request = json.loads(self.rfile.readline())
+        except ValueError:
+            return
+        if request.get('export'):
+            self.wfile.write(self.server.sampler.export())
+            return
+        timestamps, columns, statics = self.server.sampler.select(
+            request.get('begin'), request.get('end'))
+        json.dump({
+            'timestamps': list(timestamps),
+            'columns': dict((name, list(values))
+                            for name, values in columns.items()),
+            'statics': statics,
+        }, self.wfile)
+
+
+class _SamplerServer(SocketServer.ThreadingUnixStreamServer):
+    """ Serve the samples of a sampler on a socket only root can use """
+
+    daemon_threads = True
+
+    def __init__(self, path, sampler):
+        self.sampler = sampler
+        if os.path.exists(path):
+            os.remove(path)
+        umask = os.umask(0077)
+        try:
+            SocketServer.ThreadingUnixStreamServer.__init__(
+                self, path, _SamplerRequestHandler)
+        finally:
+            os.umask(umask)
+
+
+class _MetricsRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """ Answer the requests of /metrics by the exported metrics """
+
+    def do_GET(self):
+        if self.path != '/metrics':
+            self.send_error(404)
+            return
+        body = self.server.sampler.export()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/openmetrics-text; '
+                         'version=1.0.0; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.debug('metrics request: ' + format, *args)
+
+
+class _MetricsServer(SocketServer.ThreadingMixIn,
+                     BaseHTTPServer.HTTPServer):
+    """ Serve the exported metrics of a sampler over HTTP """
+
+    daemon_threads = True
+
+    def __init__(self, address, sampler):
+        self.sampler = sampler
+        BaseHTTPServer.HTTPServer.__init__(self, address,
+                                           _MetricsRequestHandler)
+
+
+def _export_services():
+    """ Return the metric families of the state of the services """
+    from yunohost.service import service_status
+
+    running = []
+    enabled = []
+    for name, status in service_status().items():
+        labels = {'service': name}
+        running.append((labels, int(status['status'] == 'running')))
+        enabled.append((labels, int(status['loaded'] == 'enabled')))
+    return {
+        'yunohost_service_running': ('Whether the service is running',
+                                     running),
+        'yunohost_service_enabled': ('Whether the service is enabled',
+                                     enabled),
+    }
+
+
+def _export_certificates():
+    """ Return the metric families of the certificates of the domains """
+    from yunohost.certificate import CERT_FOLDER, _get_statuses
+
+    validity = []
+    eligible = []
+    domains = [domain for domain in sorted(os.listdir(CERT_FOLDER))
+               if os.path.isfile(os.path.join(CERT_FOLDER, domain, 'crt.pem'))]
+    statuses = _get_statuses(domains)
+    for domain in domains:
+        status = statuses[domain]
+        labels = {'domain': domain, 'ca_type': status['CA_type']['code']}
+        validity.append((labels, status['validity']))
+        eligible.append(({'domain': domain}, int(status['ACME_eligible'])))
+    return {
+        'yunohost_certificate_validity_days': (
+            'Days remaining before the certificate expires', validity),
+        'yunohost_certificate_acme_eligible': (
+            "Whether the domain is ready for a Let's Encrypt certificate",
+            eligible),
+    }
+
+
+def _export_backups():
+    """ Return the metric families of the local backup archives """
+    from yunohost.backup import backup_list
+
+    now = time.time()
+    ages = []
+    for name, info in backup_list(with_info=True)['archives'].items():
+        created_at = calendar.timegm(info['created_at'].utctimetuple())
+        ages.append(({'archive': name}, now - created_at))
+    families = {
+        'yunohost_backup_archives': ('Number of local backup archives',
+                                     [({}, len(ages))]),
+        'yunohost_backup_age_seconds': ('Age of the backup archive', ages),
+    }
+    if ages:
+        families['yunohost_backup_newest_age_seconds'] = (
+            'Age of the newest backup archive',
+            [({}, min(age for _, age in ages))])
+    return families
+
+
+def _export_regen_conf():
+    """ Return the metric families of the pending configuration files """
+    from yunohost.service import _get_pending_conf
+
+    pending = [({'service': service}, len(conf_files))
+               for service, conf_files in _get_pending_conf().items()]
+    return {
+        'yunohost_regenconf_pending_files': (
+            'Number of pending configuration files of the service', pending),
+    }
+
+
+def _export_apps():
+    """ Return the metric families of the upgradability of the apps """
+    from yunohost.app import APPS_SETTING_PATH, app_info
+
+    upgradable = []
+    for app in sorted(os.listdir(APPS_SETTING_PATH)):
+        try:
+            info = app_info(app, raw=True)
+        except MoulinetteError as e:
+            logger.debug("unable to export the state of app '%s': %s", app,
+                         e.strerror)
+            continue
+        upgradable.append(({'app': app}, int(info['upgradable'] == 'yes')))
+    return {
+        'yunohost_app_upgradable': ('Whether an upgrade of the app is '
+                                    'available', upgradable),
+    }
+
+
+_EXPORTERS = {
+    'services': _export_services,
+    'certificates': _export_certificates,
+    'backups': _export_backups,
+    'regen_conf': _export_regen_conf,
+    'apps': _export_apps,
+}
+
+
+def _column_metric(name):
+    """
+    Return the metric name and labels of a column of stats, the disk,
+    interface and app of the column being labels
+
+    """
+    keys = _column_keys(name)
+    labels = {}
+    if keys[0] == 'disk':
+        labels['device'] = keys[1]
+        keys = keys[:1] + keys[2:]
+    elif keys[0] == 'network' and keys[1] == 'usage':
+        labels['interface'] = keys[2]
+        keys = keys[:2] + keys[3:]
+    elif keys[0] == 'apps':
+        labels['app'] = keys[1]
+        keys = keys[:1] + keys[2:]
+    return 'yunohost_' + re.sub(r'[^a-zA-Z0-9_]', '_', '_'.join(keys)), labels
+
+
+def _format_openmetrics(families):
+    """
+    Format metric families as gauges in the OpenMetrics text format
 
     Keyword argument:
-        stats -- Current stats dict
-        monitor -- Monitoring statistics
-        statics -- List of stats static keys
-
-    """
-    if isinstance(statics, str):
-        statics = [statics]
-
-    # Appending function
-    def _append(s, m, st):
-        for k, v in m.items():
-            if k in st:
-                s[k] = v
-            elif isinstance(v, dict):
-                if k not in s:
-                    s[k] = {}
-                s[k] = _append(s[k], v, st)
-            else:
-                if k not in s:
-                    s[k] = []
-                if isinstance(v, list):
-                    s[k].extend(v)
-                else:
-                    s[k].append(v)
-        return s
+        families -- Dict of (help, samples) by metric name, samples being a
+            list of (labels, value)
 
-    stats = _append(stats, monitor, statics)
-    return stats
+    """
+    def _escape(value):
+        return unicode(value).replace('\\', '\\\\').replace(
+            '"', '\\"').replace('\n', '\\n')
+
+    def _format_value(value):
+        value = float(value)
+        if math.isnan(value):
+            return 'NaN'
+        elif math.isinf(value):
+            return '+Inf' if value > 0 else '-Inf'
+        return repr(value)
+
+    lines = []
+    for name in sorted(families):
+        help, samples = families[name]
+        lines.append(u'# TYPE %s gauge' % name)
+        lines.append(u'# HELP %s %s' % (name, _escape(help)))
+        for labels, value in samples:
+            if labels:
+                name_labels = u'%s{%s}' % (name, u','.join(
+                    u'%s="%s"' % (k, _escape(v))
+                    for k, v in sorted(labels.items())))
+            else:
+                name_labels = name
+            lines.append(u'%s %s' % (name_labels, _format_value(value)))
+    lines.append(u'# EOF')
+    return (u'\n'.join(lines) + u'\n').encode('utf-8')
+
+
+def _set_static_key(statics, key, value):
+    """ Set all the static values of a key in nested statics """
+    for k, v in statics.items():
+        if k == key:
+            statics[k] = value
+        elif isinstance(v, dict):
+            _set_static_key(v, key, value)
@@ -40,6 +40,40 @@ DEFAULTS = OrderedDict([
     ("security.password.admin.strength", {"type": "int", "default": 1}),
     ("security.password.user.strength", {"type": "int", "default": 1}),
     ("service.ssh.allow_deprecated_dsa_hostkey", {"type": "bool", "default": False}),
+
+    # Backup
+    # Number of app backup scripts run at the same time while collecting files
+    # (1 means no concurrency)
+    ("backup.collect.parallel_jobs", {"type": "int", "default": 1}),
+    # Number of apps restored at the same time (1 means no concurrency)
+    ("backup.restore.parallel_jobs", {"type": "int", "default": 1}),
+    # Priority of the backup processes, so that they don't slow down services
+    # (0 and "none" keep the priority of the caller)
+    ("backup.throttle.nice", {"type": "int", "default": 0}),
+    ("backup.throttle.ionice_class", {"type": "enum", "default": "none",
+                                      "choices": ["none", "best-effort", "idle"]}),
+    # Maximum speed at which files are read to be archived, in MB/s (0 means
+    # no limit)
+    ("backup.throttle.read_bandwidth", {"type": "int", "default": 0}),
+
+    # Hooks
+    # Number of hooks of the same priority run at the same time (1 means no
+    # concurrency)
+    ("hooks.callback.parallel_jobs", {"type": "int", "default": 1}),
+
+    # Certificates
+    # Number of Let's Encrypt orders run at the same time when renewing
+    # certificates
+    ("certificate.renew.parallel_jobs", {"type": "int", "default": 4}),
+    # Renew the subdomains in a single SAN certificate with their parent domain
+    ("certificate.renew.group_subdomains", {"type": "bool", "default": False}),
+    # Type of the private keys of new certificates, the renewed ones keeping
+    # the type of their current key
+    ("certificate.key.type", {"type": "enum", "default": "rsa",
+                              "choices": ["rsa", "ecdsa"]}),
+    # Number of private keys generated in advance, in background (0 means no
+    # key pool)
+    ("certificate.key.pool_size", {"type": "int", "default": 0}),
 ])
 
 
@@ -0,0 +1,255 @@
+import hashlib
+import os
+import shutil
+import subprocess
+import tarfile
+import tempfile
+import threading
+import time
+from datetime import datetime
+
+import yunohost.backup
+from yunohost.backup import _extract_tar_stream, _extract_link_targets, \
+    _read_samples, _ChecksumTarFile, _get_catalog, _update_catalog, \
+    _remove_from_catalog, _backup_schedule_archive_date, \
+    _select_backups_to_keep
+
+
+def setup_function(function):
+
+    global tmp_dir
+    tmp_dir = tempfile.mkdtemp()
+
+
+def teardown_function(function):
+    shutil.rmtree(tmp_dir)
+
+
+def write_file(path, content):
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    with open(path, "w") as f:
+        f.write(content)
+
+
+def read_file(path):
+    with open(path) as f:
+        return f.read()
+
+
+###############################################################################
+#   Stream extraction                                                         #
+###############################################################################
+
+def make_archive_with_links():
+    """
+    Make an archive whose data/ directory holds hardlinks to a file of conf/,
+    stored before them
+    """
+    src = os.path.join(tmp_dir, "src")
+    write_file(os.path.join(src, "backup.csv"),
+               "/etc/x,conf\n/home/y,data\n/var/z,zz\n")
+    write_file(os.path.join(src, "conf", "a"), "A" * 1000)
+    os.makedirs(os.path.join(src, "data"))
+    os.link(os.path.join(src, "conf", "a"), os.path.join(src, "data", "b"))
+    os.link(os.path.join(src, "conf", "a"), os.path.join(src, "data", "b2"))
+    write_file(os.path.join(src, "data", "c"), "C")
+    write_file(os.path.join(src, "zz", "z"), "Z")
+
+    archive = os.path.join(tmp_dir, "archive.tar.gz")
+    tar = tarfile.open(archive, "w:gz")
+    for name in ["backup.csv", "conf", "data", "zz"]:
+        tar.add(os.path.join(src, name), name)
+    tar.close()
+
+    return archive
+
+
+def test_extract_tar_stream_link_across_prefixes():
+
+    archive = make_archive_with_links()
+    assert tarfile.open(archive).getmember("data/b").islnk()
+    out = os.path.join(tmp_dir, "out")
+
+    tar = tarfile.open(archive, "r|gz")
+    try:
+        links = _extract_tar_stream(tar, out, ["data"])
+        # The archive wasn't loaded to look for the target of the links
+        assert not tar._loaded
+    finally:
+        tar.close()
+
+    # The members after the links are extracted, the links are left for a
+    # second reading
+    assert read_file(os.path.join(out, "data", "c")) == "C"
+    assert sorted(l.name for l in links["conf/a"]) == ["data/b", "data/b2"]
+    assert not os.path.exists(os.path.join(out, "conf"))
+    assert not os.path.exists(os.path.join(out, "zz"))
+
+    tar = tarfile.open(archive, "r|gz")
+    try:
+        _extract_link_targets(tar, out, links)
+    finally:
+        tar.close()
+
+    for name in ["b", "b2"]:
+        path = os.path.join(out, "data", name)
+        assert read_file(path) == "A" * 1000
+        assert os.stat(path).st_nlink == 2
+    assert not os.path.exists(os.path.join(out, "conf"))
+
+
+def test_extract_tar_stream_link_in_prefix():
+
+    archive = make_archive_with_links()
+    out = os.path.join(tmp_dir, "out")
+
+    tar = tarfile.open(archive, "r|gz")
+    try:
+        links = _extract_tar_stream(tar, out, ["conf", "data"])
+    finally:
+        tar.close()
+
+    # The target was extracted first, the links are extracted as links
+    assert links == {}
+    assert os.stat(os.path.join(out, "data", "b")).st_nlink == 3
+
+
+###############################################################################
+#   Sparse files                                                              #
+###############################################################################
+
+def make_sparse_file(path):
+    """
+    Make a sparse file with more data regions than fit in the header of a
+    GNU sparse member, starting and ending with a hole
+    """
+    with open(path, "w") as f:
+        for i in range(30):
+            f.seek(i * 1024 * 1024 + 4096)
+            f.write(chr(ord("a") + i % 26) * (i + 1) * 100)
+        f.truncate(31 * 1024 * 1024)
+
+
+def test_add_sparse_file():
+
+    src = os.path.join(tmp_dir, "src")
+    os.makedirs(src)
+    make_sparse_file(os.path.join(src, "sparse"))
+    content = read_file(os.path.join(src, "sparse"))
+
+    archive = os.path.join(tmp_dir, "archive.tar.gz")
+    tar = _ChecksumTarFile.open(archive, "w:gz")
+    tar.add(os.path.join(src, "sparse"), "sparse")
+    tar.close()
+
+    # The holes are in the checksum, not in the archive
+    assert tar.checksums["sparse"] == hashlib.sha256(content).hexdigest()
+    assert os.path.getsize(archive) < 1024 * 1024
+
+    # Extracted by tarfile
+    tar = tarfile.open(archive, "r:gz")
+    try:
+        assert tar.getmember("sparse").issparse()
+        tar.extractall(os.path.join(tmp_dir, "tarfile"))
+    finally:
+        tar.close()
+    assert read_file(os.path.join(tmp_dir, "tarfile", "sparse")) == content
+
+    # Extracted by GNU tar
+    os.makedirs(os.path.join(tmp_dir, "gnutar"))
+    subprocess.check_call(["tar", "-xzf", archive,
+                           "-C", os.path.join(tmp_dir, "gnutar")])
+    assert read_file(os.path.join(tmp_dir, "gnutar", "sparse")) == content
+
+
+###############################################################################
+#   Catalog                                                                   #
+###############################################################################
+
+def test_update_catalog_concurrently(monkeypatch):
+
+    monkeypatch.setattr("yunohost.backup.ARCHIVES_PATH", tmp_dir)
+    monkeypatch.setattr("yunohost.backup.CATALOG_PATH",
+                        os.path.join(tmp_dir, "catalog.json"))
+    monkeypatch.setattr("yunohost.backup.CATALOG_LOCK_PATH",
+                        os.path.join(tmp_dir, "catalog.json.lock"))
+
+    # Slow down the saving, for the updates to overlap if not locked
+    save_catalog = yunohost.backup._save_catalog
+
+    def slow_save_catalog(catalog):
+        time.sleep(0.05)
+        save_catalog(catalog)
+    monkeypatch.setattr("yunohost.backup._save_catalog", slow_save_catalog)
+
+    names = ["archive%d" % i for i in range(8)]
+    for name in names:
+        write_file(os.path.join(tmp_dir, name + ".tar.gz"), name)
+
+    threads = [threading.Thread(target=_update_catalog,
+                                args=({name: {"size": len(name)}},))
+               for name in names]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert sorted(_get_catalog()) == names
+
+    _remove_from_catalog("archive0")
+    assert sorted(_get_catalog()) == names[1:]
+
+
+###############################################################################
+#   Schedules                                                                 #
+###############################################################################
+
+def test_schedule_archives_kept_by_local_day(monkeypatch):
+
+    # 10 hours ahead of UTC
+    monkeypatch.setenv("TZ", "UTC-10")
+    time.tzset()
+    try:
+        archives = [(_backup_schedule_archive_date("s", archive), archive)
+                    for archive in ["s-20240101-100000", "s-20240101-200000",
+                                    "s-20240102-100000"]]
+    finally:
+        monkeypatch.undo()
+        time.tzset()
+
+    # Archive names are in UTC, 20:00 UTC is already the next day
+    assert [date for date, _ in archives] == [datetime(2024, 1, 1, 20, 0),
+                                             datetime(2024, 1, 2, 6, 0),
+                                             datetime(2024, 1, 2, 20, 0)]
+
+    kept = _select_backups_to_keep(archives, {"daily": 2, "weekly": 0,
+                                              "monthly": 0})
+    assert sorted(set(kept)) == ["s-20240101-100000", "s-20240102-100000"]
+
+
+###############################################################################
+#   Size estimation                                                           #
+###############################################################################
+
+def test_read_samples_skips_vanished_files(monkeypatch):
+
+    for name in ["a", "b", "c"]:
+        write_file(os.path.join(tmp_dir, "dir", name), name * 100)
+    expected_size, _ = _read_samples(os.path.join(tmp_dir, "dir"))
+
+    # A file removed during the walk
+    lstat = os.lstat
+
+    def custom_lstat(path):
+        if path.endswith("/b"):
+            raise OSError(2, "No such file or directory", path)
+        return lstat(path)
+
+    monkeypatch.setattr("os.lstat", custom_lstat)
+
+    size, samples = _read_samples(os.path.join(tmp_dir, "dir"))
+
+    # The other files are still counted and sampled
+    assert size == expected_size - 100
+    assert sorted(sample[0] for sample, _ in samples) == ["a", "c"]
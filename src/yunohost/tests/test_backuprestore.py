@@ -10,7 +10,8 @@ from moulinette import m18n
 from moulinette.core import init_authenticator
 from yunohost.app import app_install, app_remove, app_ssowatconf
 from yunohost.app import _is_installed
-from yunohost.backup import backup_create, backup_restore, backup_list, backup_info, backup_delete
+from yunohost.backup import backup_create, backup_restore, backup_list, backup_info, backup_delete, backup_verify
+from yunohost.backup import backup_schedule_add, backup_schedule_remove, backup_schedule_run
 from yunohost.domain import _get_maindomain
 from moulinette.core import MoulinetteError
 
@@ -209,6 +210,70 @@ def test_backup_only_ldap():
     assert "conf_ldap" in archives_info["system"].keys()
 
 
+def test_backup_verify():
+
+    # Create the backup
+    backup_create(system=["conf_ssh"], apps=None)
+
+    archives = backup_list()["archives"]
+    assert len(archives) == 1
+
+    result = backup_verify()
+    assert result["archives"][archives[0]]["status"] == "ok"
+
+
+def test_backup_resume(monkeypatch):
+
+    import yunohost.backup
+    TarBackupMethod = yunohost.backup.TarBackupMethod
+
+    # Save a checkpoint after each file, and interrupt the backup after the
+    # second one, without cleaning anything as when the server goes down
+    checkpoint_archive = TarBackupMethod._checkpoint_archive
+    checkpoints = []
+
+    def interrupted_checkpoint_archive(self, tar, tarinfo):
+        checkpoint_archive(self, tar, tarinfo)
+        checkpoints.append(tarinfo.name)
+        if len(checkpoints) == 2:
+            raise KeyboardInterrupt()
+
+    monkeypatch.setattr("yunohost.backup.ARCHIVE_CHECKPOINT_SIZE", 0)
+    monkeypatch.setattr(TarBackupMethod, "_checkpoint_archive",
+                        interrupted_checkpoint_archive)
+    monkeypatch.setattr(TarBackupMethod, "clean", lambda self: None)
+
+    with pytest.raises(KeyboardInterrupt):
+        backup_create(name="resumed", system=["conf_ssh", "conf_ldap"],
+                      apps=None)
+
+    assert backup_list()["archives"] == []
+    assert os.path.exists(
+        "/home/yunohost.backup/archives/resumed.tar.gz.part")
+
+    # The archive is continued from the last checkpoint
+    monkeypatch.undo()
+    open_archive = TarBackupMethod._open_archive
+    resumed_from = []
+
+    def custom_open_archive(self, checkpoint=None):
+        resumed_from.append(checkpoint)
+        return open_archive(self, checkpoint)
+
+    monkeypatch.setattr(TarBackupMethod, "_open_archive", custom_open_archive)
+
+    backup_create(name="resumed", resume=True)
+
+    assert resumed_from[0]["member"] == checkpoints[1]
+    assert backup_list()["archives"] == ["resumed"]
+
+    archives_info = backup_info("resumed", with_details=True)
+    assert sorted(archives_info["system"].keys()) == ["conf_ldap", "conf_ssh"]
+
+    result = backup_verify()
+    assert result["archives"]["resumed"]["status"] == "ok"
+
+
 def test_backup_system_part_that_does_not_exists(mocker):
 
     mocker.spy(m18n, "n")
@@ -220,6 +285,35 @@ def test_backup_system_part_that_does_not_exists(mocker):
     m18n.n.assert_any_call('backup_hook_unknown', hook="yolol")
     m18n.n.assert_any_call('backup_nothings_done')
 
+
+def test_backup_schedule_prunes_old_archives():
+
+    backup_schedule_add("test-schedule", system=["conf_ssh"], apps=None,
+                        keep_daily=1, keep_weekly=0, keep_monthly=0)
+
+    try:
+        first = backup_schedule_run("test-schedule", force=True)
+        # Archive names contain the creation time with a precision of 1s
+        time.sleep(1)
+        second = backup_schedule_run("test-schedule", force=True)
+    finally:
+        backup_schedule_remove("test-schedule")
+
+    # Both archives are of the same day, only the newest one is kept
+    assert second["pruned"] == [first["archive"]]
+    assert backup_list()["archives"] == [second["archive"]]
+
+
+def test_backup_schedule_requires_tar_method(mocker):
+
+    mocker.spy(m18n, "n")
+
+    with pytest.raises(MoulinetteError):
+        backup_schedule_add("test-schedule", system=["conf_ssh"], apps=None,
+                            methods=["copy"])
+
+    m18n.n.assert_any_call('backup_schedule_tar_method_required')
+
 ###############################################################################
 #  System backup and restore                                                  #
 ###############################################################################
@@ -508,10 +602,40 @@ def test_backup_and_restore_with_ynh_restore():
     _test_backup_and_restore_app("backup_recommended_app")
 
 
+@pytest.mark.with_backup_legacy_app_installed
+def test_backup_apps_concurrently(monkeypatch):
+
+    install_app("backup_recommended_app_ynh", "/yolo2",
+                "&helper_to_test=ynh_restore_file")
+    assert _is_installed("backup_recommended_app")
+
+    import yunohost.backup
+    settings_get = yunohost.backup.settings_get
+
+    def custom_settings_get(key):
+        if key == "backup.collect.parallel_jobs":
+            return 2
+        return settings_get(key)
+
+    monkeypatch.setattr("yunohost.backup.settings_get", custom_settings_get)
+
+    # Both app backup scripts run at the same time
+    apps = ["backup_legacy_app", "backup_recommended_app"]
+    result = backup_create(system=None, apps=apps)
+    assert sorted(result["durations"]["apps"].keys()) == apps
+
+    archives = backup_list()["archives"]
+    assert len(archives) == 1
+
+    archives_info = backup_info(archives[0], with_details=True)
+    assert sorted(archives_info["apps"].keys()) == apps
+
+
 def _test_backup_and_restore_app(app):
 
     # Create a backup of this app
-    backup_create(system=None, apps=[app])
+    result = backup_create(system=None, apps=[app])
+    assert app in result["durations"]["apps"]
 
     archives = backup_list()["archives"]
     assert len(archives) == 1
@@ -0,0 +1,146 @@
+import os
+import time
+import tempfile
+import threading
+
+from multiprocessing.pool import ThreadPool
+
+import yunohost.hook
+from yunohost.hook import hook_exec, hook_callback, _init_worker_thread
+
+SCRIPT = """echo "out $1 $FOO"
+echo err >&2
+echo info >> "$YNH_STDINFO"
+exit 3
+"""
+
+# Number of scripts executed by the benchmark
+BENCHMARK_CALLS = 200
+
+
+def setup_function(function):
+
+    global script_dir
+    script_dir = tempfile.mkdtemp()
+    with open(os.path.join(script_dir, "50-test"), "w") as f:
+        f.write(SCRIPT)
+
+
+def teardown_function(function):
+    os.system("rm -rf %s" % script_dir)
+
+
+def run_script(**kwargs):
+
+    lines = []
+    returncode = hook_exec(os.path.join(script_dir, "50-test"),
+                           args=["a b'c"], env={"FOO": "bar baz"},
+                           stdout_callback=lambda l: lines.append(("out", l)),
+                           stderr_callback=lambda l: lines.append(("err", l)),
+                           **kwargs)
+    return returncode, lines
+
+
+def test_hook_exec_output():
+
+    returncode, lines = run_script(no_trace=True)
+
+    assert returncode == 3
+    assert ("out", "out a b'c bar baz") in lines
+    assert ("err", "err") in lines
+    # Nothing else is printed, e.g. by the xtrace setup
+    assert len(lines) == 2
+
+
+def test_hook_exec_xtrace_to_stdout():
+
+    returncode, lines = run_script()
+
+    assert returncode == 3
+    assert ("out", "out a b'c bar baz") in lines
+    assert ("err", "err") in lines
+    # xtrace goes to stdout, not to stderr
+    assert ("out", "+ exit 3") in lines
+    assert [l for s, l in lines if s == "err"] == ["err"]
+
+
+def test_hook_exec_buffering_in_worker_threads():
+
+    def _exec(i):
+        # The output is only buffered and replayed while holding the lock in
+        # the worker threads flagged by the pool
+        lines = []
+        hook_exec(os.path.join(script_dir, "50-test"), no_trace=True,
+                  stdout_callback=lambda l: lines.append(
+                      yunohost.hook._output_lock.locked()))
+        return lines
+
+    pool = ThreadPool(2, initializer=_init_worker_thread)
+    try:
+        assert pool.map(_exec, range(2)) == [[True], [True]]
+    finally:
+        pool.close()
+        pool.join()
+
+    # Other threads, e.g. the ones of the API server, aren't buffered
+    results = []
+    thread = threading.Thread(target=lambda: results.append(_exec(0)))
+    thread.start()
+    thread.join()
+    assert results == [[False]]
+
+
+def test_hook_callback_parallel_jobs_setting(monkeypatch):
+
+    monkeypatch.setattr("yunohost.hook.HOOK_FOLDER", script_dir + "/")
+    monkeypatch.setattr("yunohost.hook.CUSTOM_HOOK_FOLDER",
+                        os.path.join(script_dir, "custom") + "/")
+    settings_reads = []
+
+    def settings_get(key):
+        settings_reads.append(key)
+        return 2
+    monkeypatch.setattr("yunohost.hook.settings_get", settings_get)
+
+    os.mkdir(os.path.join(script_dir, "test_action"))
+    for hook in ["10-a", "20-b"]:
+        with open(os.path.join(script_dir, "test_action", hook), "w") as f:
+            f.write("exit 0\n")
+
+    # The setting isn't read with a single hook by priority
+    result = hook_callback("test_action", no_trace=True)
+    assert sorted(result["succeed"]) == ["a", "b"]
+    assert settings_reads == []
+
+    with open(os.path.join(script_dir, "test_action", "20-c"), "w") as f:
+        f.write("exit 0\n")
+
+    result = hook_callback("test_action", no_trace=True)
+    assert sorted(result["succeed"]) == ["a", "b", "c"]
+    assert settings_reads == ["hooks.callback.parallel_jobs"]
+
+
+def test_hook_exec_benchmark():
+
+    # The first script creates the directory of the stdinfo FIFOs of the
+    # process, which is kept until it exits
+    run_script()
+    stdinfo_dir = yunohost.hook._stdinfo_dir[1]
+    tmp_entries = set(os.listdir(tempfile.gettempdir()))
+
+    for no_trace in [True, False]:
+        start = time.time()
+        for i in range(BENCHMARK_CALLS):
+            returncode, lines = run_script(no_trace=no_trace)
+            assert returncode == 3
+            assert ("out", "out a b'c bar baz") in lines
+        duration = (time.time() - start) / BENCHMARK_CALLS
+
+        print("hook_exec (no_trace=%s): %.2f ms per script"
+              % (no_trace, duration * 1000))
+
+    # The stdinfo FIFOs don't leave anything behind, and the directory of
+    # the process is reused
+    assert yunohost.hook._stdinfo_dir[1] == stdinfo_dir
+    assert os.listdir(stdinfo_dir) == []
+    assert set(os.listdir(tempfile.gettempdir())) == tmp_entries
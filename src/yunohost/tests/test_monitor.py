@@ -0,0 +1,346 @@
+import os
+import math
+import time
+import shutil
+import threading
+import pickle
+import tempfile
+from array import array
+
+import yunohost.monitor
+from yunohost.monitor import _StatsStore, _import_legacy_stats, \
+    _interval_weights, _aggregate, _summarize_stats, _Sampler, \
+    _SamplerServer, _query_sampler
+
+STATS_PATH = yunohost.monitor.STATS_PATH
+
+
+def setup_function(function):
+    yunohost.monitor.STATS_PATH = tempfile.mkdtemp()
+
+
+def teardown_function(function):
+    shutil.rmtree(yunohost.monitor.STATS_PATH)
+    yunohost.monitor.STATS_PATH = STATS_PATH
+
+
+def fill_store(timestamps):
+    store = _StatsStore("day")
+    for t in timestamps:
+        store.append(t, {"cpu": t * 2}, {"fs_type": "ext4"})
+    return store
+
+
+###############################################################################
+#   Stats store                                                               #
+###############################################################################
+
+def test_stats_store_append():
+
+    store = _StatsStore("day")
+    assert not store.exists()
+    assert store.last_timestamp() is None
+
+    store.append(100, {"cpu": 1.0}, {"fs_type": "ext4"})
+    store.append(200, {"cpu": 2.0, "ram": 3.0}, {"fs_type": "xfs"})
+    store.append(300, {"ram": 4.0}, {"fs_type": "xfs"})
+
+    assert store.exists()
+    assert store.last_timestamp() == 300
+    assert sorted(store.columns()) == ["cpu", "ram"]
+
+    timestamps, columns, statics = store.read()
+    assert list(timestamps) == [100, 200, 300]
+    # Missing values are NaN, for the columns which appear later too
+    assert columns["cpu"][:2] == array("d", [1.0, 2.0])
+    assert math.isnan(columns["cpu"][2])
+    assert math.isnan(columns["ram"][0])
+    assert columns["ram"][1:] == array("d", [3.0, 4.0])
+    # Only the last statics are kept
+    assert statics == {"fs_type": "xfs"}
+
+
+def test_stats_store_read_range():
+
+    store = fill_store([100, 200, 300, 400, 500])
+
+    # Both bounds are included
+    timestamps, columns, _ = store.read(200, 400)
+    assert list(timestamps) == [200, 300, 400]
+    assert list(columns["cpu"]) == [400, 600, 800]
+
+    # Bounds between rows
+    assert list(store.read(150, 450)[0]) == [200, 300, 400]
+    assert list(store.read(t_begin=450)[0]) == [500]
+    assert list(store.read(t_end=150)[0]) == [100]
+
+    # Empty ranges
+    assert list(store.read(600)[0]) == []
+    assert list(store.read(t_end=50)[0]) == []
+    assert list(store.read(250, 260)[0]) == []
+
+
+def test_stats_store_bisect():
+
+    store = fill_store([100, 200, 200, 300])
+    rows = 4
+
+    with open(store._column_path(store.TIMESTAMP), "rb") as f:
+        assert store._bisect(f, rows, 50, right=False) == 0
+        assert store._bisect(f, rows, 200, right=False) == 1
+        assert store._bisect(f, rows, 200, right=True) == 3
+        assert store._bisect(f, rows, 250, right=False) == 3
+        assert store._bisect(f, rows, 400, right=True) == 4
+        assert store._bisect(f, 0, 200, right=False) == 0
+
+
+def test_stats_store_trim():
+
+    store = fill_store(range(0, 1000, 100))
+
+    # The rows are only removed once they span twice the retention
+    store.trim(500)
+    assert len(store.read()[0]) == 10
+
+    store.trim(400)
+    timestamps, columns, _ = store.read()
+    assert list(timestamps) == [500, 600, 700, 800, 900]
+    assert list(columns["cpu"]) == [1000, 1200, 1400, 1600, 1800]
+
+    # The store can still be appended to
+    store.append(1000, {"cpu": 0.0}, {})
+    assert store.read(900)[0][-1] == 1000
+
+
+def test_stats_store_write():
+
+    store = fill_store([100, 200])
+    store.write(array("d", [300, 400]), {"ram": array("d", [1.0, 2.0])},
+                {"fs_type": "xfs"})
+
+    timestamps, columns, statics = store.read()
+    assert list(timestamps) == [300, 400]
+    assert columns.keys() == ["ram"]
+    assert statics == {"fs_type": "xfs"}
+
+
+def test_stats_store_timestamp_before():
+
+    store = fill_store([100, 200, 300])
+
+    assert store.timestamp_before(100) is None
+    assert store.timestamp_before(200) == 100
+    assert store.timestamp_before(250) == 200
+    assert store.timestamp_before(1000) == 300
+
+
+###############################################################################
+#   Aggregates                                                                #
+###############################################################################
+
+def test_interval_weights():
+
+    # The first row is weighted as the next interval
+    assert list(_interval_weights(array("d", [100, 110, 130]))) == \
+        [10, 10, 20]
+    # ... or as the time since the row before it
+    assert list(_interval_weights(array("d", [100, 110, 130]), 40)) == \
+        [60, 10, 20]
+    assert list(_interval_weights(array("d", [100]), 40)) == [60]
+    assert list(_interval_weights(array("d", [100]))) == [1]
+    assert list(_interval_weights(array("d"))) == []
+
+
+def test_aggregate():
+
+    values = array("d", [1, 2, 3, float("nan"), 4])
+    weights = array("d", [1, 1, 1, 100, 7])
+
+    result = _aggregate(values, weights)
+
+    # Missing values and their weight are ignored
+    assert result["mean"] == (1 + 2 + 3 + 4 * 7) / 10.0
+    assert result["min"] == 1
+    assert result["max"] == 4
+    # 4 covers 70% of the time
+    assert result["p50"] == 4
+    assert result["p95"] == 4
+
+    result = _aggregate(values, weights, percentiles=(10, 20, 30))
+    assert (result["p10"], result["p20"], result["p30"]) == (1, 2, 3)
+
+
+def test_aggregate_no_values():
+
+    assert _aggregate(array("d", [float("nan")]), array("d", [1])) is None
+    # Without weights, the mean isn't weighted
+    assert _aggregate(array("d", [1, 3]), array("d", [0, 0]))["mean"] == 2
+
+
+def test_summarize_stats_first_row_weight():
+
+    store = _StatsStore("day")
+    # A 1 hour interval before the range, then 5 minutes ones
+    for t, cpu in [(0, 0), (3600, 10), (3900, 20), (4200, 20)]:
+        store.append(t, {"cpu": cpu}, {})
+
+    summary = _summarize_stats("day", 3600)
+
+    # The first row of the range is measured over the hour before it
+    assert summary["values"]["cpu"]["mean"] == \
+        (10 * 3600 + 20 * 300 + 20 * 300) / 4200.0
+    assert summary["begin"] == 3600
+
+
+###############################################################################
+#   Legacy pickle files                                                       #
+###############################################################################
+
+def test_import_legacy_stats():
+
+    pkl_file = os.path.join(yunohost.monitor.STATS_PATH, "day.pkl")
+    with open(pkl_file, "w") as f:
+        pickle.dump({
+            "timestamp": [100, 200, 300],
+            "disk": {"sda1": {"io": {"read_bytes": [1, 2, 3]},
+                              "filesystem": {"fs_type": "ext4"}}},
+            # A statistic which appeared later has less values
+            "system": {"cpu": {"load": {"min1": [0.5, 1.5]}}},
+        }, f)
+
+    store = _StatsStore("day")
+    _import_legacy_stats(store)
+
+    assert not os.path.exists(pkl_file)
+    timestamps, columns, statics = store.read()
+    assert list(timestamps) == [100, 200, 300]
+    assert list(columns["disk.sda1.io.read_bytes"]) == [1, 2, 3]
+    assert math.isnan(columns["system.cpu.load.min1"][0])
+    assert list(columns["system.cpu.load.min1"][1:]) == [0.5, 1.5]
+    assert statics == {"disk": {"sda1": {"filesystem": {"fs_type": "ext4"}}}}
+
+
+def test_import_legacy_stats_existing_store():
+
+    store = fill_store([100])
+    pkl_file = os.path.join(yunohost.monitor.STATS_PATH, "day.pkl")
+    with open(pkl_file, "w") as f:
+        pickle.dump({"timestamp": [50], "cpu": [1]}, f)
+
+    # The store isn't overwritten by a legacy file
+    _import_legacy_stats(store)
+
+    assert os.path.exists(pkl_file)
+    assert list(store.read()[0]) == [100]
+
+
+###############################################################################
+#   Sampler                                                                   #
+###############################################################################
+
+def make_sampler(samples):
+    sampler = _Sampler()
+    sampler.samples.extend(samples)
+    return sampler
+
+
+def test_sampler_select():
+
+    sampler = make_sampler([
+        (10, {"cpu": 1.0}, {"fs_type": "ext4"}),
+        (20, {"cpu": 2.0, "ram": 5.0}, {"fs_type": "ext4"}),
+        (30, {"ram": 6.0}, {"fs_type": "xfs"}),
+    ])
+
+    timestamps, columns, statics = sampler.select()
+    assert list(timestamps) == [10, 20, 30]
+    assert list(columns["cpu"][:2]) == [1.0, 2.0]
+    assert math.isnan(columns["cpu"][2])
+    assert math.isnan(columns["ram"][0])
+    assert statics == {"fs_type": "xfs"}
+
+    # The beginning is included and the end excluded
+    timestamps, columns, statics = sampler.select(20, 30)
+    assert list(timestamps) == [20]
+    assert sorted(columns) == ["cpu", "ram"]
+    assert statics == {"fs_type": "ext4"}
+
+    # The statics are a copy of the ones of the sample
+    statics["fs_type"] = "btrfs"
+    assert sampler.samples[1][2] == {"fs_type": "ext4"}
+
+
+def test_sampler_select_empty():
+
+    timestamps, columns, statics = make_sampler([]).select()
+    assert (list(timestamps), columns, statics) == ([], {}, {})
+
+
+def test_sampler_update_stats():
+
+    now = time.time()
+    sampler = make_sampler([
+        # Before the last update, already in the stats
+        (now - 10, {"disk.sda.io.read_bytes": 1000, "cpu": 100}, {}),
+        (now - 3, {"disk.sda.io.read_bytes": 10, "cpu": 10},
+         {"io": {"time_since_update": 1}}),
+        (now - 2, {"disk.sda.io.read_bytes": 20, "cpu": 20},
+         {"io": {"time_since_update": 1}}),
+        (now - 1, {"disk.sda.io.read_bytes": 30, "cpu": 60},
+         {"io": {"time_since_update": 1}}),
+    ])
+    sampler.last_update = now - 5
+
+    sampler.update_stats()
+
+    assert sampler.last_update >= now
+    timestamps, columns, statics = _StatsStore("day").read()
+    assert len(timestamps) == 1
+    # The counters since the previous sample are summed up, the other
+    # values are averaged
+    assert list(columns["disk.sda.io.read_bytes"]) == [60]
+    assert list(columns["cpu"]) == [30]
+    assert statics["io"]["time_since_update"] >= 5
+
+    # The week and month stats are rolled up from the new stats
+    assert list(_StatsStore("week").read()[1]["cpu"]) == [30]
+    assert list(_StatsStore("month").read()[1]["cpu"]) == [30]
+
+
+def test_sampler_update_stats_no_samples():
+
+    sampler = make_sampler([(time.time() - 10, {"cpu": 1.0}, {})])
+    sampler.last_update = time.time() - 5
+
+    sampler.update_stats()
+
+    assert not _StatsStore("day").exists()
+
+
+def test_sampler_server():
+
+    sampler = make_sampler([
+        (10, {"cpu": 1.0}, {"fs_type": "ext4"}),
+        (20, {"cpu": 2.0}, {"fs_type": "xfs"}),
+    ])
+    socket_path = os.path.join(yunohost.monitor.STATS_PATH, "sampler.sock")
+    server = _SamplerServer(socket_path, sampler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+
+    sampler_socket_path = yunohost.monitor.SAMPLER_SOCKET_PATH
+    yunohost.monitor.SAMPLER_SOCKET_PATH = socket_path
+    try:
+        # Only root can use the socket
+        assert os.stat(socket_path).st_mode & 0777 == 0700
+
+        timestamps, columns, statics = _query_sampler(15)
+    finally:
+        yunohost.monitor.SAMPLER_SOCKET_PATH = sampler_socket_path
+        server.shutdown()
+        server.server_close()
+
+    assert list(timestamps) == [20]
+    assert list(columns["cpu"]) == [2.0]
+    assert statics == {"fs_type": "xfs"}